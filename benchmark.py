@@ -0,0 +1,238 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import shelve
+import string
+import time
+from types import SimpleNamespace
+from nltk.corpus import stopwords
+from nltk.stem.porter import PorterStemmer
+from nltk.tokenize import sent_tokenize, TreebankWordTokenizer
+from indexer import create_index_from_dir, read_crawled_document, ShelveIndexes, CompactIndexes
+from lang_proc import Analyzer, Term
+from crawl_storage import iter_crawled_posts
+from searcher import Searcher, generate_snippet
+from segment import SegmentIndexes, create_segments
+from snippets import SnippetGenerator
+
+
+# size in bytes of all files of given index in index directory (all dbm backends files)
+def index_files_size(index_dir, index_name):
+    size = 0
+    for filename in os.listdir(index_dir):
+        if filename == index_name or filename.startswith(index_name + "."):
+            size += os.path.getsize(os.path.join(index_dir, filename))
+    return size
+
+
+# time function call for each of given arguments
+def time_calls(function, arguments):
+    start_time = time.perf_counter()
+    for argument in arguments:
+        function(argument)
+    return time.perf_counter() - start_time
+
+
+# compare shelve (list of (position, docid)) and compact (binary grouped by docid) posting lists on same crawl
+def benchmark_postings(crawled_data_dir, work_dir):
+    results = {}
+    for name, IndexesImplementation in (("shelve", ShelveIndexes), ("compact", CompactIndexes)):
+        index_dir = os.path.join(work_dir, name)
+        os.mkdir(index_dir)
+        create_index_from_dir(crawled_data_dir, index_dir, IndexesImplementation)
+        indexes = IndexesImplementation()
+        indexes.load_from_disk(index_dir)
+        query_terms = [SimpleNamespace(stem=stem) for stem in indexes.inverted_index.keys()]
+        results[name] = {
+            "inverted_index_bytes": index_files_size(index_dir, "inverted_index"),
+            "terms": len(query_terms),
+            # docids only (used by bm25 ranking)
+            "decode_docids_seconds": time_calls(indexes.get_document_ids, query_terms),
+            # whole posting lists with positions
+            "decode_postings_seconds": time_calls(indexes.get_postings, query_terms),
+        }
+    return results
+
+
+# compare size and load time of forward index with documents stored as lists of terms and as StoredDocument
+def benchmark_forward_index(crawled_data_dir, work_dir):
+    index_dir = os.path.join(work_dir, "indexes")
+    os.mkdir(index_dir)
+    create_index_from_dir(crawled_data_dir, index_dir)
+    indexes = ShelveIndexes()
+    indexes.load_from_disk(index_dir)
+    # the same documents stored with lists of terms
+    with shelve.open(os.path.join(work_dir, "terms_forward_index"), "n") as terms_forward_index:
+        for post in iter_crawled_posts(crawled_data_dir):
+            doc = read_crawled_document(post)
+            doc.raw_text = None
+            terms_forward_index[str(indexes.url_to_id[doc.url])] = doc
+    with shelve.open(os.path.join(work_dir, "terms_forward_index"), "r") as terms_forward_index:
+        docids = list(terms_forward_index.keys())
+        terms_load_seconds = time_calls(lambda docid: terms_forward_index[docid].text, docids)
+    return {"docs": len(docids),
+            "terms_forward_index_bytes": index_files_size(work_dir, "terms_forward_index"),
+            "forward_index_bytes": index_files_size(index_dir, "forward_index"),
+            "terms_load_seconds": terms_load_seconds,
+            "load_seconds": time_calls(lambda docid: indexes.forward_index[docid], docids),
+            "load_with_terms_rebuild_seconds": time_calls(indexes.get_document_text, docids)}
+
+
+# analysis as it was before Analyzer: new stemmer per token, new tokenizer per sentence, stop words list
+def _analyze_without_analyzer(raw_text, stop_words):
+    sents = sent_tokenize(raw_text)
+    tokens = list(itertools.chain(*[TreebankWordTokenizer().tokenize(sent) for sent in sents]))
+    terms = [Term(token, PorterStemmer().stem(token).lower()) for token in tokens]
+    return [term for term in terms if term.stem not in string.punctuation or term.full_word not in stop_words]
+
+
+# tokens per second of analysis of all crawled texts before and after Analyzer
+def benchmark_analyzer(crawled_data_dir):
+    raw_texts = [post["text"] for post in iter_crawled_posts(crawled_data_dir)]
+    stop_words = stopwords.words('english')
+    start_time = time.perf_counter()
+    tokens_num = sum(len(_analyze_without_analyzer(raw_text, stop_words)) for raw_text in raw_texts)
+    seconds_before = time.perf_counter() - start_time
+    analyzer = Analyzer()
+    start_time = time.perf_counter()
+    analyzer.analyze_many(raw_texts)
+    seconds_after = time.perf_counter() - start_time
+    return {"texts": len(raw_texts),
+            "tokens": tokens_num,
+            "tokens_per_second_before": tokens_num / seconds_before,
+            "tokens_per_second_after": tokens_num / seconds_after,
+            "stem_cache": analyzer.stem_cache_info()._asdict()}
+
+
+# fixed log of queries of 1-3 stems chosen from frequent stems of index
+def _query_log(indexes, queries_num=200, seed=0):
+    stems = sorted(indexes.term_stats.keys(), key=lambda stem: (-indexes.term_stats[stem][0], stem))[:300]
+    generator = random.Random(seed)
+    return [[Term(stem, stem) for stem in generator.sample(stems, generator.randint(1, 3))]
+            for _ in range(queries_num)]
+
+
+# throughput of scalar (doc by doc) and vectorized NumPy bm25 ranking on the same queries, and largest
+# difference of their ranks
+def benchmark_scoring(crawled_data_dir, work_dir, k=25):
+    from numpy_searcher import NumpySearcher
+    index_dir = os.path.join(work_dir, "indexes")
+    os.mkdir(index_dir)
+    create_index_from_dir(crawled_data_dir, index_dir, CompactIndexes)
+    searchers = {"scalar": Searcher(index_dir, CompactIndexes), "numpy": NumpySearcher(index_dir, CompactIndexes)}
+    queries = _query_log(searchers["scalar"].indexes)
+    results = {"queries": len(queries), "k": k}
+    for name, searcher in searchers.items():
+        for method in ("find_documents_and_rank_by_bm25", "find_documents_top_k"):
+            arguments = (lambda query: (query,)) if method == "find_documents_and_rank_by_bm25" else (
+                lambda query: (query, k))
+            seconds = time_calls(lambda query: getattr(searcher, method)(*arguments(query)), queries)
+            results["{}_{}_queries_per_second".format(name, method)] = len(queries) / seconds
+    max_rank_difference = 0
+    same_order = True
+    for query in queries:
+        scalar = searchers["scalar"].find_documents_and_rank_by_bm25(query)
+        vectorized = searchers["numpy"].find_documents_and_rank_by_bm25(query)
+        same_order = same_order and list(scalar.docids) == list(vectorized.docids) and list(
+            searchers["numpy"].find_documents_top_k(query, k).docids) == list(scalar.docids[:k])
+        max_rank_difference = max([max_rank_difference] + [abs(a - b) for a, b in zip(scalar.relevances,
+                                                                                      vectorized.relevances)])
+    results["max_rank_difference"] = max_rank_difference
+    results["same_order"] = same_order
+    return results
+
+
+# render time of snippets of result pages: doc by doc (title, url and whole text read separately, text scanned)
+# and by SnippetGenerator (record read once, window found by positions, only its words decoded)
+def benchmark_snippets(crawled_data_dir, work_dir, page_size=25):
+    index_dir = os.path.join(work_dir, "indexes")
+    os.mkdir(index_dir)
+    create_index_from_dir(crawled_data_dir, index_dir, CompactIndexes)
+    indexes = CompactIndexes()
+    indexes.load_from_disk(index_dir)
+    create_segments(indexes, SegmentIndexes.segments_dir(index_dir))
+    searcher = Searcher(index_dir, SegmentIndexes)
+    pages = [(query, searcher.find_documents_top_k(query, page_size).get_page(1, page_size))
+             for query in _query_log(indexes, 100)]
+
+    def render_doc_by_doc(page):
+        query, docids = page
+        return [(searcher.indexes.get_title(docid), generate_snippet(query, searcher.indexes.get_document_text(docid)),
+                 searcher.indexes.get_url(docid)) for docid in docids]
+
+    snippet_generator = SnippetGenerator(searcher)
+    cached_snippet_generator = SnippetGenerator(searcher, cache_size=10000)
+    for page in pages:
+        cached_snippet_generator.get_snippets(*page)
+    docs_num = sum(len(docids) for query, docids in pages)
+    return {"pages": len(pages),
+            "average_doc_len": searcher.indexes.average_doc_len(),
+            "doc_by_doc_ms_per_page": time_calls(render_doc_by_doc, pages) / len(pages) * 1000,
+            "snippet_generator_ms_per_page": time_calls(lambda page: snippet_generator.get_snippets(*page),
+                                                        pages) / len(pages) * 1000,
+            "cached_snippet_generator_ms_per_page": time_calls(lambda page: cached_snippet_generator.get_snippets(
+                *page), pages) / len(pages) * 1000,
+            "docs": docs_num}
+
+
+# latency of multi-term queries as AND of their terms (boolean engine) and as union ranked by bm25
+def benchmark_boolean(crawled_data_dir, work_dir, k=25):
+    from boolean_query import AndNode, TermNode
+    index_dir = os.path.join(work_dir, "indexes")
+    os.mkdir(index_dir)
+    create_index_from_dir(crawled_data_dir, index_dir, CompactIndexes)
+    searcher = Searcher(index_dir, CompactIndexes)
+    queries = [query for query in _query_log(searcher.indexes, 300) if len(query) > 1]
+    boolean_queries = [AndNode([TermNode(term) for term in query]) for query in queries]
+    return {"queries": len(queries),
+            "k": k,
+            "and_ms_per_query": time_calls(lambda boolean_query: searcher.find_documents_by_boolean_query(
+                boolean_query, k), boolean_queries) / len(queries) * 1000,
+            "union_top_k_ms_per_query": time_calls(lambda query: searcher.find_documents_top_k(query, k),
+                                                   queries) / len(queries) * 1000,
+            "union_all_ms_per_query": time_calls(searcher.find_documents_and_rank_by_bm25, queries) / len(
+                queries) * 1000,
+            "and_average_candidates": sum(len(boolean_query.evaluate(searcher)) for boolean_query in
+                                          boolean_queries) / len(queries),
+            "union_average_candidates": sum(searcher.find_documents_top_k(query, k).total_doc_num() for query in
+                                            queries) / len(queries)}
+
+
+def main():
+    # get arguments
+    parser = argparse.ArgumentParser(description="Surfearch benchmarks")
+    parser.add_argument("benchmark", choices=["postings", "analyzer", "forward_index", "scoring", "snippets",
+                                              "boolean"],
+                        help="Benchmark to run")
+    parser.add_argument("--crawled_data", dest="crawled_data", required=True, help="Crawled data directory")
+    parser.add_argument("--work_dir", dest="work_dir", help="Directory for indexes built by benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark == "analyzer":
+        results = benchmark_analyzer(args.crawled_data)
+    else:
+        # check if work directory already created
+        if not args.work_dir:
+            parser.error("--work_dir is required by {} benchmark".format(args.benchmark))
+        try:
+            os.mkdir(args.work_dir)
+        except FileExistsError:
+            print("Folder is already created")
+            exit()
+        if args.benchmark == "postings":
+            results = benchmark_postings(args.crawled_data, args.work_dir)
+        elif args.benchmark == "scoring":
+            results = benchmark_scoring(args.crawled_data, args.work_dir)
+        elif args.benchmark == "snippets":
+            results = benchmark_snippets(args.crawled_data, args.work_dir)
+        elif args.benchmark == "boolean":
+            results = benchmark_boolean(args.crawled_data, args.work_dir)
+        else:
+            results = benchmark_forward_index(args.crawled_data, args.work_dir)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import time
+from crawl_storage import ChunkedPostsWriter
+from indexer import create_index_from_dir, INDEXES_IMPLEMENTATIONS
+from lang_proc import parse_query
+from searcher import Searcher
+from segment import SegmentIndexes, create_segments
+
+# End to end benchmark: synthetic crawl -> indexing -> searcher startup -> query latency.
+# Every stage runs in fresh process, so its peak memory and startup are not affected by other stages.
+
+# frequent english words (incl. stop words) put at the top of synthetic vocabulary
+_COMMON_WORDS = ("the be to of and a in that have i it for not on with he as you do at this but his by from they "
+                 "we say her she or an will my one all would there their what so up out if about who get which go "
+                 "me when make can like time no just him know take people into year your good some could them see "
+                 "other than then now look only come its over think also back after use two how our work first well "
+                 "way even new want because any these give day most us game play music help code python night sky "
+                 "star king queen water build phone screen movie book team season week post question").split()
+_SYLLABLES = ("ba be bi bo bu ca ce ci co cu da de di do du fa fe fi fo ga ge go ka ke ki ko la le li lo lu ma me "
+              "mi mo mu na ne ni no nu pa pe pi po pu ra re ri ro ru sa se si so su ta te ti to tu va ve vi vo za "
+              "ze zi zo ar er in on an or en al el st th ch sh").split()
+DEFAULT_VOCABULARY_SIZE = 30000
+
+
+# vocabulary of synthetic posts (the same for the same seed) and cumulative zipf weights of its words
+def synthetic_vocabulary(seed=0, vocabulary_size=DEFAULT_VOCABULARY_SIZE):
+    generator = random.Random(seed)
+    words = list(_COMMON_WORDS)
+    seen = set(words)
+    while len(words) < vocabulary_size:
+        word = "".join(generator.choice(_SYLLABLES) for _ in range(generator.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    cumulative_weights = []
+    total = 0
+    for rank in range(len(words)):
+        total += 1 / (rank + 1)
+        cumulative_weights.append(total)
+    return words, cumulative_weights
+
+
+# generate posts_num reddit style posts in crawler format (chunks of JSON lines, see crawl_storage.py):
+# zipf distributed words, some link posts without text, long tail of long self-posts
+def generate_posts(storage_dir, posts_num, seed=0, subreddit="synthetic"):
+    words, cumulative_weights = synthetic_vocabulary(seed)
+    generator = random.Random(seed)
+    os.mkdir(storage_dir)
+    writer = ChunkedPostsWriter(storage_dir)
+    for post_number in range(posts_num):
+        title_words = generator.choices(words, cum_weights=cumulative_weights, k=generator.randint(3, 12))
+        sentences = []
+        # link posts have no text
+        if generator.random() > 0.15:
+            for _ in range(max(1, int(generator.lognormvariate(1.2, 0.9)))):
+                sentence_words = generator.choices(words, cum_weights=cumulative_weights,
+                                                   k=generator.randint(4, 25))
+                sentences.append(" ".join(sentence_words).capitalize() + generator.choice(".!?"))
+        post_id = "{:x}".format(post_number + 1000000)
+        writer.write({"url": "https://www.reddit.com/r/{}/comments/{}/{}/".format(subreddit, post_id,
+                                                                                  "_".join(title_words[:5])),
+                      "text": " ".join(sentences),
+                      "title": " ".join(title_words).capitalize(),
+                      "score": int(generator.paretovariate(1.2)) - 1})
+    writer.close()
+
+
+# fixed query log: queries of 1-3 words of synthetic vocabulary (frequent words are queried more often)
+def synthetic_query_log(queries_num, seed=0):
+    words, cumulative_weights = synthetic_vocabulary(seed)
+    generator = random.Random(seed + 1)
+    return [" ".join(generator.choices(words[20:5000], cum_weights=cumulative_weights[20:5000],
+                                       k=generator.randint(1, 3))) for _ in range(queries_num)]
+
+
+# size in bytes of all files in directory and its subdirectories
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(path, filename))
+               for path, _, filenames in os.walk(directory) for filename in filenames)
+
+
+# value at given percent of sorted values (nearest rank)
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+
+def _latency_stats(latencies_ms):
+    latencies_ms = sorted(latencies_ms)
+    return {"p50_ms": percentile(latencies_ms, 50),
+            "p90_ms": percentile(latencies_ms, 90),
+            "p99_ms": percentile(latencies_ms, 99),
+            "max_ms": latencies_ms[-1] if latencies_ms else 0,
+            "mean_ms": sum(latencies_ms) / len(latencies_ms) if latencies_ms else 0}
+
+
+# peak resident memory of this process in MB (ru_maxrss is in kilobytes on linux)
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# run function in fresh process and return its result
+def _run_in_process(function, *args):
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(function, args)
+
+
+def _generate_stage(storage_dir, posts_num, seed):
+    start_time = time.perf_counter()
+    generate_posts(storage_dir, posts_num, seed)
+    return {"posts": posts_num, "seconds": time.perf_counter() - start_time,
+            "crawl_bytes": directory_size(storage_dir)}
+
+
+def _index_stage(storage_dir, index_dir, index_format, block_size, workers):
+    IndexesImplementation = INDEXES_IMPLEMENTATIONS[index_format]
+    statistics = create_index_from_dir(storage_dir, index_dir, IndexesImplementation, block_size, workers)
+    start_time = time.perf_counter()
+    indexes = IndexesImplementation()
+    indexes.load_from_disk(index_dir)
+    create_segments(indexes, SegmentIndexes.segments_dir(index_dir))
+    statistics["segment_seconds"] = time.perf_counter() - start_time
+    statistics["peak_rss_mb"] = _peak_rss_mb()
+    return statistics
+
+
+def _search_stage(index_dir, searcher_indexes, queries, k):
+    IndexesImplementation = SegmentIndexes if searcher_indexes == "segment" else INDEXES_IMPLEMENTATIONS[
+        searcher_indexes]
+    # cold: first searcher of fresh process and its first query
+    start_time = time.perf_counter()
+    searcher = Searcher(index_dir, IndexesImplementation)
+    cold_startup_seconds = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    searcher.find_documents_by_query(parse_query(queries[0]), k)
+    cold_first_query_ms = (time.perf_counter() - start_time) * 1000
+    # warm: searcher created again in the same process
+    start_time = time.perf_counter()
+    searcher = Searcher(index_dir, IndexesImplementation)
+    warm_startup_seconds = time.perf_counter() - start_time
+    results = {"cold_startup_seconds": cold_startup_seconds,
+               "cold_first_query_ms": cold_first_query_ms,
+               "warm_startup_seconds": warm_startup_seconds}
+    # query log is run twice: first run reads index pages from disk, second one finds them in memory
+    for run in ("first_run", "second_run"):
+        latencies_ms = []
+        for query in queries:
+            start_time = time.perf_counter()
+            searcher.find_documents_by_query(parse_query(query), k)
+            latencies_ms.append((time.perf_counter() - start_time) * 1000)
+        results[run] = _latency_stats(latencies_ms)
+    results["peak_rss_mb"] = _peak_rss_mb()
+    return results
+
+
+# run all stages, crawl and indexes are created in work_dir
+def run_suite(work_dir, posts_num, queries, seed=0, index_format="compact", searcher_indexes="segment",
+              block_size=200, workers=1, k=25):
+    storage_dir = os.path.join(work_dir, "crawled_data")
+    index_dir = os.path.join(work_dir, "indexes")
+    os.mkdir(index_dir)
+    results = {"config": {"posts": posts_num, "queries": len(queries), "seed": seed, "index_format": index_format,
+                          "searcher_indexes": searcher_indexes, "block_size": block_size, "workers": workers,
+                          "k": k},
+               "started": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    results["generation"] = _run_in_process(_generate_stage, storage_dir, posts_num, seed)
+    results["indexing"] = _run_in_process(_index_stage, storage_dir, index_dir, index_format, block_size, workers)
+    results["index_bytes"] = directory_size(index_dir)
+    results["segments_bytes"] = directory_size(SegmentIndexes.segments_dir(index_dir))
+    results["search"] = _run_in_process(_search_stage, index_dir, searcher_indexes, queries, k)
+    return results
+
+
+def main():
+    # get arguments
+    parser = argparse.ArgumentParser(description="Surfearch indexing and query latency benchmark suite")
+    parser.add_argument("--work_dir", dest="work_dir", required=True, help="Directory for synthetic crawl and indexes")
+    parser.add_argument("--posts", dest="posts", type=int, default=10000, help="Number of synthetic posts")
+    parser.add_argument("--queries", dest="queries", type=int, default=500, help="Number of queries in query log")
+    parser.add_argument("--query_log", dest="query_log", help="File with query per line used instead of synthetic log")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="Seed of synthetic posts and queries")
+    parser.add_argument("--index_format", dest="index_format", default="compact",
+                        choices=sorted(INDEXES_IMPLEMENTATIONS), help="Format of indexes")
+    parser.add_argument("--searcher_indexes", dest="searcher_indexes", default="segment",
+                        choices=sorted(INDEXES_IMPLEMENTATIONS) + ["segment"], help="Indexes used by searcher")
+    parser.add_argument("--block_size", dest="block_size", type=int, default=200, help="Indexer block size")
+    parser.add_argument("--workers", dest="workers", type=int, default=1, help="Indexer worker processes")
+    parser.add_argument("--output", dest="output", help="File to write JSON results to")
+    args = parser.parse_args()
+
+    # check if work directory already created
+    try:
+        os.mkdir(args.work_dir)
+    except FileExistsError:
+        print("Folder is already created")
+        exit()
+    if args.query_log:
+        with open(args.query_log, encoding="utf-8") as query_log_file:
+            queries = [line.strip() for line in query_log_file if line.strip()]
+    else:
+        queries = synthetic_query_log(args.queries, args.seed)
+    results = run_suite(args.work_dir, args.posts, queries, args.seed, args.index_format, args.searcher_indexes,
+                        args.block_size, args.workers)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(results, output_file, indent=4)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+import re
+import metrics
+from lang_proc import stem_and_tokenize_text
+from positions import intersect, union, difference
+
+# Boolean query: words and "quoted phrases" combined with AND, OR, NOT (upper case) and brackets,
+# words without operator between them are combined with AND, AND binds stronger than OR:
+#   python AND (django OR flask) NOT "stack overflow"
+# Words which are not indexed (stop words) are ignored.
+
+OPERATORS = ("AND", "OR", "NOT")
+_TOKEN_RE = re.compile(r'\(|\)|"[^"]*"?|[^\s()"]+')
+
+
+# query term, matching docs are docs of its posting list
+class TermNode(object):
+    def __init__(self, term):
+        self.term = term
+
+    # estimated number of matching docs (used to evaluate rarest parts of query first)
+    def cost(self, indexes):
+        return indexes.get_document_frequency(self.term)
+
+    # sorted docids of matching docs
+    def evaluate(self, searcher):
+        return searcher.indexes.get_document_ids(self.term)
+
+    # terms used for ranking of matching docs
+    def positive_terms(self):
+        return [self.term]
+
+    # hashable normalized form of query (used as cache key)
+    def key(self):
+        return "term", self.term.stem
+
+
+# phrase, matching docs contain its terms one after another (see lang_proc.ParsedQuery)
+class PhraseNode(object):
+    def __init__(self, phrase):
+        self.phrase = phrase
+
+    def cost(self, indexes):
+        return min(indexes.get_document_frequency(term) for (offset, term) in self.phrase)
+
+    def evaluate(self, searcher):
+        return searcher.get_phrase_document_ids(self.phrase)
+
+    def positive_terms(self):
+        return [term for (offset, term) in self.phrase]
+
+    def key(self):
+        return "phrase", tuple((offset, term.stem) for (offset, term) in self.phrase)
+
+
+# docs matching all children, children are evaluated from the rarest one, so intersection is small from start
+class AndNode(object):
+    def __init__(self, children):
+        self.children = children
+
+    def cost(self, indexes):
+        costs = [child.cost(indexes) for child in self.children if not isinstance(child, NotNode)]
+        return min(costs) if costs else indexes.total_doc_count()
+
+    def evaluate(self, searcher):
+        positive_children = sorted((child for child in self.children if not isinstance(child, NotNode)),
+                                   key=lambda child: child.cost(searcher.indexes))
+        excluded_children = [child.child for child in self.children if isinstance(child, NotNode)]
+        if positive_children:
+            docids = positive_children[0].evaluate(searcher)
+            for child in positive_children[1:]:
+                # nothing matches anymore, the rest of children is not evaluated
+                if not docids:
+                    return []
+                docids = intersect([docids, child.evaluate(searcher)])
+        else:
+            docids = searcher.all_document_ids()
+        for child in excluded_children:
+            if not docids:
+                return []
+            docids = difference(docids, child.evaluate(searcher))
+        return list(docids)
+
+    def positive_terms(self):
+        return [term for child in self.children for term in child.positive_terms()]
+
+    def key(self):
+        return ("and",) + tuple(sorted((child.key() for child in self.children), key=repr))
+
+
+# docs matching any of children
+class OrNode(object):
+    def __init__(self, children):
+        self.children = children
+
+    def cost(self, indexes):
+        return min(sum(child.cost(indexes) for child in self.children), indexes.total_doc_count())
+
+    def evaluate(self, searcher):
+        return union([child.evaluate(searcher) for child in self.children])
+
+    def positive_terms(self):
+        return [term for child in self.children for term in child.positive_terms()]
+
+    def key(self):
+        return ("or",) + tuple(sorted((child.key() for child in self.children), key=repr))
+
+
+# docs not matching child
+class NotNode(object):
+    def __init__(self, child):
+        self.child = child
+
+    def cost(self, indexes):
+        return indexes.total_doc_count() - self.child.cost(indexes)
+
+    def evaluate(self, searcher):
+        return difference(searcher.all_document_ids(), self.child.evaluate(searcher))
+
+    # terms of excluded docs are not used for ranking
+    def positive_terms(self):
+        return []
+
+    def key(self):
+        return "not", self.child.key()
+
+
+# combine nodes with AND (nested AND nodes are flattened, missing nodes of ignored words are skipped)
+def _and(nodes):
+    children = []
+    for node in nodes:
+        if isinstance(node, AndNode):
+            children.extend(node.children)
+        elif node is not None:
+            children.append(node)
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else AndNode(children)
+
+
+# combine nodes with OR
+def _or(nodes):
+    children = []
+    for node in nodes:
+        if isinstance(node, OrNode):
+            children.extend(node.children)
+        elif node is not None:
+            children.append(node)
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else OrNode(children)
+
+
+# recursive descent parser of boolean query, unbalanced brackets and operators without operands are ignored
+class _BooleanQueryParser(object):
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        nodes = []
+        while self._peek() is not None:
+            # unmatched closing bracket
+            if self._peek() == ")":
+                self._next()
+                continue
+            nodes.append(self._parse_or())
+        return _and(nodes)
+
+    def _parse_or(self):
+        nodes = [self._parse_and()]
+        while self._peek() == "OR":
+            self._next()
+            nodes.append(self._parse_and())
+        return _or(nodes)
+
+    def _parse_and(self):
+        nodes = [self._parse_not()]
+        while self._peek() not in (None, ")", "OR"):
+            if self._peek() == "AND":
+                self._next()
+                continue
+            nodes.append(self._parse_not())
+        return _and(nodes)
+
+    def _parse_not(self):
+        if self._peek() == "NOT":
+            self._next()
+            node = self._parse_not()
+            return NotNode(node) if node is not None else None
+        return self._parse_primary()
+
+    def _parse_primary(self):
+        token = self._peek()
+        if token in (None, ")", "AND", "OR"):
+            return None
+        self._next()
+        if token == "(":
+            node = self._parse_or()
+            if self._peek() == ")":
+                self._next()
+            return node
+        if token.startswith('"'):
+            phrase = [(offset, term) for offset, term in enumerate(stem_and_tokenize_text(token.strip('"')))
+                      if not term.is_stop_word()]
+            if len(phrase) > 1:
+                return PhraseNode(phrase)
+            return TermNode(phrase[0][1]) if phrase else None
+        # word can be split to several terms by tokenizer (e.g. "don't")
+        return _and([TermNode(term) for term in stem_and_tokenize_text(token) if not term.is_stop_word()])
+
+
+# tokens of query: brackets, quoted phrases, operators and words
+def _tokenize(raw_query):
+    return _TOKEN_RE.findall(raw_query)
+
+
+# check if query uses boolean operators or brackets
+def is_boolean_query(raw_query):
+    return any(token in OPERATORS or token == "(" for token in _tokenize(raw_query))
+
+
+# parse boolean query to tree of nodes, None if query has no indexed words
+def parse_boolean_query(raw_query):
+    with metrics.stage("analyze"):
+        return _BooleanQueryParser(_tokenize(raw_query)).parse()
@@ -0,0 +1,133 @@
+import argparse
+import gzip
+import json
+import os.path
+import re
+
+# crawled posts are stored in append only chunks of JSON lines (one post per line):
+# posts-00000.jsonl, posts-00001.jsonl, ... (or posts-00000.jsonl.gz, ... when compressed)
+# old layout (one JSON file per post named with base64 encoded url) is still readable
+CHUNK_FILENAME_FORMAT = "posts-{:05d}.jsonl"
+_CHUNK_FILENAME_RE = re.compile(r"^posts-(\d{5})\.jsonl(\.gz)?$")
+DEFAULT_POSTS_PER_CHUNK = 10000
+
+
+def _is_chunk(filename):
+    return _CHUNK_FILENAME_RE.match(filename) is not None
+
+
+# chunk filenames of storage dir in order they were written
+def _chunk_filenames(storage_dir):
+    return sorted(filename for filename in os.listdir(storage_dir) if _is_chunk(filename))
+
+
+# writer of crawled posts to chunks of storage dir, new chunks are added after existing ones
+class ChunkedPostsWriter(object):
+    def __init__(self, storage_dir, posts_per_chunk=DEFAULT_POSTS_PER_CHUNK, compress=False):
+        self.storage_dir = storage_dir
+        self.posts_per_chunk = posts_per_chunk
+        self.compress = compress
+        chunk_filenames = _chunk_filenames(storage_dir)
+        self._chunk_number = int(_CHUNK_FILENAME_RE.match(chunk_filenames[-1]).group(1)) + 1 if chunk_filenames else 0
+        self._chunk_file = None
+        self._chunk_posts_num = 0
+
+    def _open_chunk(self):
+        chunk_path = os.path.join(self.storage_dir, CHUNK_FILENAME_FORMAT.format(self._chunk_number))
+        if self.compress:
+            self._chunk_file = gzip.open(chunk_path + ".gz", "wt", encoding="utf-8")
+        else:
+            self._chunk_file = open(chunk_path, "w", encoding="utf-8")
+        self._chunk_number += 1
+        self._chunk_posts_num = 0
+
+    # append post (dict with url, text, title and score)
+    def write(self, post):
+        if self._chunk_file is None:
+            self._open_chunk()
+        self._chunk_file.write(json.dumps(post) + "\n")
+        self._chunk_posts_num += 1
+        if self._chunk_posts_num == self.posts_per_chunk:
+            self._chunk_file.close()
+            self._chunk_file = None
+
+    # make written posts durable (e.g. before crawl checkpoint is saved)
+    def flush(self):
+        if self._chunk_file is not None:
+            self._chunk_file.flush()
+
+    def close(self):
+        if self._chunk_file is not None:
+            self._chunk_file.close()
+            self._chunk_file = None
+
+
+# read posts of one chunk, unfinished last line (or compressed block) of interrupted crawl is skipped
+def _read_chunk(chunk_path):
+    open_chunk = gzip.open if chunk_path.endswith(".gz") else open
+    with open_chunk(chunk_path, "rt", encoding="utf-8") as chunk_file:
+        try:
+            for line in chunk_file:
+                try:
+                    yield json.loads(line)
+                except json.decoder.JSONDecodeError:
+                    if line.endswith("\n"):
+                        raise
+        except EOFError:
+            return
+
+
+# stream posts of storage dir one by one, only the first post of each url is returned: chunks are append only, so
+# posts written after the last checkpoint of interrupted crawl are fetched and appended again when it is resumed
+def iter_crawled_posts(storage_dir):
+    seen_urls = set()
+    for post in _iter_stored_posts(storage_dir):
+        if post["url"] not in seen_urls:
+            seen_urls.add(post["url"])
+            yield post
+
+
+# stream stored posts of storage dir one by one (chunks or old layout with file per post)
+def _iter_stored_posts(storage_dir):
+    chunk_filenames = _chunk_filenames(storage_dir)
+    if chunk_filenames:
+        for filename in chunk_filenames:
+            yield from _read_chunk(os.path.join(storage_dir, filename))
+        return
+    for filename in os.listdir(storage_dir):
+        with open(os.path.join(storage_dir, filename), encoding="utf-8") as doc:
+            yield json.load(doc)
+
+
+# convert storage dir of old layout (file per post) to chunks in new storage dir
+def convert_legacy_dir(legacy_dir, storage_dir, posts_per_chunk=DEFAULT_POSTS_PER_CHUNK, compress=False):
+    os.mkdir(storage_dir)
+    writer = ChunkedPostsWriter(storage_dir, posts_per_chunk, compress)
+    posts_num = 0
+    for post in iter_crawled_posts(legacy_dir):
+        writer.write(post)
+        posts_num += 1
+    writer.close()
+    return posts_num
+
+
+def main():
+    # get arguments
+    parser = argparse.ArgumentParser(description="Convert crawled data with file per post to chunks of JSON lines")
+    parser.add_argument("--legacy_dir", dest="legacy_dir", required=True, help="Crawled data directory (old layout)")
+    parser.add_argument("--storage_dir", dest="storage_dir", required=True, help="Directory to store chunks")
+    parser.add_argument("--posts_per_chunk", dest="posts_per_chunk", type=int, default=DEFAULT_POSTS_PER_CHUNK,
+                        help="Number of posts in one chunk")
+    parser.add_argument("--compress", dest="compress", action="store_true", help="Compress chunks with gzip")
+    args = parser.parse_args()
+
+    # check if storage directory already created
+    if os.path.exists(args.storage_dir):
+        print("Folder is already created")
+        exit()
+    posts_num = convert_legacy_dir(args.legacy_dir, args.storage_dir, args.posts_per_chunk, args.compress)
+    print("Success! Converted {} posts".format(posts_num))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,79 @@
+import asyncio
+import random
 import requests
 from datetime import datetime
 import time
 import json
 import os.path
-from base64 import b64encode
 import argparse
+from crawl_storage import ChunkedPostsWriter, DEFAULT_POSTS_PER_CHUNK
+
+# pushshift API, local stub server can be used instead of it
+DEFAULT_API_URL = "https://api.pushshift.io/reddit"
+# epoch of the first reddit posts (default start of time windows of async crawl)
+REDDIT_START_EPOCH = 1119484800
+# suffix of file next to storage dir with state of async crawl (storage dir has only posts)
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+
+
+# token bucket rate limiter: rate requests per second on average, at most capacity requests at once
+class TokenBucket(object):
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last_time = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    # wait until request can be sent
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_time) * self.rate)
+                self._last_time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
 
 
 class RedditCrawler(object):
-    def __init__(self, subreddit, storage_dir):
+    # resume - continue crawl into existing storage dir (async crawl continues from its checkpoint)
+    # posts are appended to chunks of JSON lines in storage dir (see crawl_storage.py)
+    def __init__(self, subreddit, storage_dir, api_url=DEFAULT_API_URL, resume=False,
+                 posts_per_chunk=DEFAULT_POSTS_PER_CHUNK, compress=False):
         # start url is which url we start crawl from
         self.start_url = "subreddit=" + subreddit
+        # url of pushshift API
+        self.api_url = api_url
         # directory we write all crawled data to
         self.storage_dir = storage_dir
+        self.checkpoint_path = os.path.normpath(storage_dir) + CHECKPOINT_SUFFIX
+        self.resume = resume
         # try to create a directory
         try:
             os.mkdir(storage_dir)
         except FileExistsError:
-            print("Folder is already created")
-            exit()
+            if not resume:
+                print("Folder is already created")
+                exit()
+        self.posts_writer = ChunkedPostsWriter(storage_dir, posts_per_chunk, compress)
+
+    # append data from post to storage
+    def _store_post(self, data):
+        # get data from post on subreddit
+        title = data['title']
+        try:
+            text = data['selftext']
+        except Exception:
+            text = ""
+        link = data['full_link']
+        score = data['score']
+        self.posts_writer.write({"url": link,
+                                 "text": text,
+                                 "title": title,
+                                 "score": score})
 
     # crawl function to crawl given subreddit
     def crawl(self, num_of_posts):
@@ -26,7 +81,7 @@ class RedditCrawler(object):
         start_time = datetime.utcnow()
         previous_epoch = int(start_time.timestamp())
         # url to use pushshift API
-        url = "https://api.pushshift.io/reddit/{}/search?limit=1000&sort=desc&{}&before="
+        url = self.api_url + "/{}/search?limit=1000&sort=desc&{}&before="
         # number of crawled data
         count = 0
 
@@ -62,27 +117,121 @@ class RedditCrawler(object):
                 # update time variables appropriately
                 previous_epoch = data['created_utc'] - 1
                 count += 1
-                # get data from post on subreddit
-                title = data['title']
-                try:
-                    text = data['selftext']
-                except Exception:
-                    text = ""
-                link = data['full_link']
-                score = data['score']
-                # write data from post to file with name of 64encoded link
-                stored_text_file_name = os.path.join(self.storage_dir,
-                                                     str(b64encode(link.encode("utf-8")).decode("utf-8")))
-                with open(stored_text_file_name, "w", encoding="utf-8") as stored_text_file:
-                    stored_text_file.write(json.dumps({"url": link,
-                                                       "text": text,
-                                                       "title": title,
-                                                       "score": score}))
-                    stored_text_file.close()
-                    print("Crawled: {:.2f}%".format((count / num_of_posts) * 100))
-
-                    print("Success crawled: " + str(count))
+                self._store_post(data)
+                print("Crawled: {:.2f}%".format((count / num_of_posts) * 100))
+
+                print("Success crawled: " + str(count))
+        self.posts_writer.close()
+        print("Crawled: 100%")
+
+    # write state of async crawl (atomically, so crash never leaves half written checkpoint)
+    def _save_checkpoint(self, checkpoint):
+        with open(self.checkpoint_path + ".tmp", "w", encoding="utf-8") as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(self.checkpoint_path + ".tmp", self.checkpoint_path)
+
+    # state of async crawl: number of crawled posts and time windows [after, before) left to crawl
+    # (boundary_urls - urls of stored posts created in the last second of window, see _crawl_window)
+    def _load_checkpoint(self, num_of_posts, windows_num, after_epoch, before_epoch):
+        if self.resume and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, encoding="utf-8") as checkpoint_file:
+                return json.load(checkpoint_file)
+        window_len = (before_epoch - after_epoch) / windows_num
+        windows = [{"after": int(after_epoch + i * window_len),
+                    "before": int(after_epoch + (i + 1) * window_len) if i < windows_num - 1 else before_epoch,
+                    "boundary_urls": [],
+                    "done": False}
+                   for i in range(windows_num)]
+        return {"num_of_posts": num_of_posts, "count": 0, "windows": windows}
+
+    # get json from API, retry with exponential backoff when request fails or API returns bad data
+    async def _fetch_json(self, session, rate_limiter, url, max_retries, backoff_seconds):
+        import aiohttp
+        for attempt in range(max_retries + 1):
+            await rate_limiter.acquire()
+            try:
+                async with session.get(url, headers={'User-Agent': "Surfearch"}) as response:
+                    # pushshift returns 429 when requests are sent too fast
+                    if response.status == 429 or response.status >= 500:
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                          status=response.status)
+                    return await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+                if attempt == max_retries:
+                    raise
+                delay = backoff_seconds * 2 ** attempt * (1 + random.random())
+                print("Request failed ({}), retry in {:.1f} seconds".format(error, delay))
+                await asyncio.sleep(delay)
+
+    # crawl one time window from its end to its start
+    # API pages by creation second, so next page starts at second of the last stored post (pages can end in the middle
+    # of second), posts of that second which are already stored are skipped
+    async def _crawl_window(self, session, rate_limiter, checkpoint, window, max_retries, backoff_seconds):
+        url = self.api_url + "/submission/search?limit=1000&sort=desc&{}&after={}&before={}"
+        # windows of checkpoints written before boundary urls were recorded
+        window.setdefault("boundary_urls", [])
+        while not window["done"] and checkpoint["count"] < checkpoint["num_of_posts"]:
+            # after of API is exclusive
+            json_data = await self._fetch_json(session, rate_limiter,
+                                               url.format(self.start_url, window["after"] - 1, window["before"]),
+                                               max_retries, backoff_seconds)
+            objects = json_data.get('data', [])
+            # data has run out in window
+            run_out = len(objects) == 0
+            boundary_urls = set(window["boundary_urls"])
+            objects = [data for data in objects if data['full_link'] not in boundary_urls]
+            # all posts of the last second are stored, next request gets older posts
+            # (posts of one second which don't fit into one page can't be paged, the rest of them is not crawled)
+            if not run_out and not objects:
+                window["before"] -= 1
+                window["boundary_urls"] = []
+            # other windows can reach the quota while this request waits, posts over it are not stored
+            # (window continues from the last stored post when crawl is resumed with larger quota)
+            objects = objects[:max(checkpoint["num_of_posts"] - checkpoint["count"], 0)]
+            for data in objects:
+                self._store_post(data)
+                # next request gets posts of the same second as this one and older
+                if data['created_utc'] + 1 < window["before"]:
+                    window["before"] = data['created_utc'] + 1
+                    window["boundary_urls"] = []
+                window["boundary_urls"].append(data['full_link'])
+            checkpoint["count"] += len(objects)
+            if run_out or window["before"] <= window["after"]:
+                window["done"] = True
+            # checkpoint must not count posts which are not written yet
+            self.posts_writer.flush()
+            self._save_checkpoint(checkpoint)
+            print("Crawled: {:.2f}%".format(min(checkpoint["count"] / checkpoint["num_of_posts"], 1) * 100))
+
+    async def _crawl_async(self, checkpoint, rate, concurrency, max_retries, backoff_seconds):
+        import aiohttp
+        rate_limiter = TokenBucket(rate, concurrency)
+        # connection pool shared by all windows
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        timeout = aiohttp.ClientTimeout(total=60)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await asyncio.gather(*[self._crawl_window(session, rate_limiter, checkpoint, window, max_retries,
+                                                      backoff_seconds)
+                                   for window in checkpoint["windows"]])
+
+    # crawl given subreddit with parallel requests for several time windows, checkpoint allows to resume crawl
+    def crawl_async(self, num_of_posts, windows_num=4, rate=1, concurrency=4, after_epoch=REDDIT_START_EPOCH,
+                    before_epoch=None, max_retries=5, backoff_seconds=1):
+        if before_epoch is None:
+            before_epoch = int(datetime.utcnow().timestamp())
+        checkpoint = self._load_checkpoint(num_of_posts, windows_num, after_epoch, before_epoch)
+        checkpoint["num_of_posts"] = num_of_posts
+        try:
+            asyncio.run(self._crawl_async(checkpoint, rate, concurrency, max_retries, backoff_seconds))
+        finally:
+            self.posts_writer.close()
+        # if nothing was crawled then subreddit does not exist
+        if checkpoint["count"] == 0:
+            os.remove(self.checkpoint_path)
+            os.rmdir(self.storage_dir)
+            raise SyntaxError("Subreddit does not exist")
         print("Crawled: 100%")
+        print("Success crawled: " + str(checkpoint["count"]))
 
 
 def main():
@@ -92,14 +241,36 @@ def main():
     parser.add_argument("--storage_dir", dest="storage_dir", required=True, help="Directory to store posts")
     parser.add_argument("--count_of_crawl", dest="count_of_crawl", required=True,
                         help="Number of crawled posts")
+    parser.add_argument("--async", dest="async_crawl", action="store_true",
+                        help="Crawl several time windows in parallel (can be resumed)")
+    parser.add_argument("--resume", dest="resume", action="store_true",
+                        help="Continue interrupted async crawl in existing storage directory")
+    parser.add_argument("--windows", dest="windows", type=int, default=4,
+                        help="Number of time windows crawled in parallel by async crawl")
+    parser.add_argument("--rate", dest="rate", type=float, default=1,
+                        help="Max requests per second of async crawl")
+    parser.add_argument("--concurrency", dest="concurrency", type=int, default=4,
+                        help="Max simultaneous connections of async crawl")
+    parser.add_argument("--after", dest="after", type=int, default=REDDIT_START_EPOCH,
+                        help="Async crawl posts created after this epoch")
+    parser.add_argument("--before", dest="before", type=int, help="Async crawl posts created before this epoch")
+    parser.add_argument("--api_url", dest="api_url", default=DEFAULT_API_URL, help="Pushshift API url")
+    parser.add_argument("--posts_per_chunk", dest="posts_per_chunk", type=int, default=DEFAULT_POSTS_PER_CHUNK,
+                        help="Number of posts in one chunk of storage directory")
+    parser.add_argument("--compress", dest="compress", action="store_true", help="Compress chunks with gzip")
     args = parser.parse_args()
     print("Crawling subreddit: " + args.r)
     print("to folder: " + args.storage_dir)
     print("Amount of expected crawled data: " + args.count_of_crawl)
-    crawler = RedditCrawler(args.r, args.storage_dir)
+    crawler = RedditCrawler(args.r, args.storage_dir, args.api_url, args.resume, args.posts_per_chunk,
+                            args.compress)
     # crawl
     try:
-        crawler.crawl(int(args.count_of_crawl))
+        if args.async_crawl:
+            crawler.crawl_async(int(args.count_of_crawl), args.windows, args.rate, args.concurrency, args.after,
+                                args.before)
+        else:
+            crawler.crawl(int(args.count_of_crawl))
     except ValueError:
         print("Third Argument is not an integer")
         exit()
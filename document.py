@@ -1,10 +1,142 @@
+from array import array
+import math
+import pickle
+from lang_proc import Term, token_offsets
+
+# reddit score of doc whose popularity prior is 0.5 (prior saturates like tf in bm25, so few viral posts don't
+# dominate ranking), prior doesn't depend on other docs, so priors of segments and shards need no normalization
+POPULARITY_PIVOT_SCORE = 100
+
+
+# static popularity prior of doc in [0, 1) computed from its reddit score when doc is indexed
+def popularity_prior(score):
+    log_score = math.log1p(max(score, 0))
+    return log_score / (log_score + math.log1p(POPULARITY_PIVOT_SCORE))
+
+
 # Document class storing its title, text, url and score on reddit
 class Document(object):
-    def __init__(self, title, text, url, score):
+    __slots__ = ("title", "text", "url", "score", "raw_text")
+
+    def __init__(self, title, text, url, score, raw_text=None):
         self.title = title
         self.text = text
         self.url = url
         self.score = score
+        # original text, terms of text are found in it when document is stored
+        self.raw_text = raw_text
+
+    def __eq__(self, other):
+        return self.url == other.url
+
+
+# interned stems: stem id -> stem and stem -> stem id
+class StemVocabulary(object):
+    def __init__(self, stems=()):
+        self.stems = list(stems)
+        self._stem_ids = {stem: stem_id for stem_id, stem in enumerate(self.stems)}
+
+    def __len__(self):
+        return len(self.stems)
+
+    def __getitem__(self, stem_id):
+        return self.stems[stem_id]
+
+    # id of stem or None if stem is not in vocabulary
+    def find_id(self, stem):
+        return self._stem_ids.get(stem)
+
+    # id of stem (new stems get next id)
+    def get_id(self, stem):
+        stem_id = self._stem_ids.get(stem)
+        if stem_id is None:
+            stem_id = len(self.stems)
+            self._stem_ids[stem] = stem_id
+            self.stems.append(stem)
+        return stem_id
+
+
+# words of indexed stems counted in docs: the most frequent word of stem is shown to users instead of stem
+# (e.g. "computer" instead of "comput"), counts are kept, so words of several indexes (segments, shards) are combined
+class SurfaceForms(object):
+    def __init__(self, word_counts=None):
+        # stem -> {lowercase word: number of its occurrences}
+        self.word_counts = word_counts if word_counts is not None else {}
+
+    # count words of indexed (not stop word) terms of doc
+    def add_document(self, doc):
+        for term in doc.text:
+            if term.is_stop_word():
+                continue
+            counts = self.word_counts.setdefault(term.stem, {})
+            word = term.full_word.lower()
+            counts[word] = counts.get(word, 0) + 1
+
+    # add counts of other words (e.g. of merged segment)
+    def update(self, surface_forms):
+        for stem, words_counts in surface_forms.word_counts.items():
+            counts = self.word_counts.setdefault(stem, {})
+            for word, count in words_counts.items():
+                counts[word] = counts.get(word, 0) + count
+
+
+# surface forms written by write_surface_forms (indexes written before they were counted have none)
+def read_surface_forms(path):
+    try:
+        with open(path, "rb") as surface_forms_file:
+            return SurfaceForms(pickle.load(surface_forms_file))
+    except FileNotFoundError:
+        return SurfaceForms()
+
+
+def write_surface_forms(path, surface_forms):
+    with open(path, "wb") as surface_forms_file:
+        pickle.dump(surface_forms.word_counts, surface_forms_file, pickle.HIGHEST_PROTOCOL)
+
+
+# Document as it is stored in forward index: instead of list of terms it has utf-8 text,
+# (start, end) byte offsets of its terms in the text and ids of their stems in StemVocabulary
+class StoredDocument(object):
+    __slots__ = ("title", "url", "score", "raw_text", "stem_ids", "offsets", "unaligned_words")
+
+    def __init__(self, title, url, score, raw_text, stem_ids, offsets, unaligned_words=None):
+        self.title = title
+        self.url = url
+        self.score = score
+        self.raw_text = raw_text
+        self.stem_ids = stem_ids
+        self.offsets = offsets
+        # words of terms not found in text (position -> word), usually None
+        self.unaligned_words = unaligned_words
 
     def __eq__(self, other):
         return self.url == other.url
+
+    # number of terms
+    def __len__(self):
+        return len(self.stem_ids)
+
+    # surface word of term at given position
+    def word(self, position):
+        if self.unaligned_words and position in self.unaligned_words:
+            return self.unaligned_words[position]
+        return self.raw_text[self.offsets[2 * position]:self.offsets[2 * position + 1]].decode("utf-8")
+
+    # rebuild terms of text
+    def terms(self, stem_vocabulary):
+        raw_text, offsets, stems = self.raw_text, self.offsets, stem_vocabulary.stems
+        terms = [Term(raw_text[offsets[2 * position]:offsets[2 * position + 1]].decode("utf-8"), stems[stem_id])
+                 for position, stem_id in enumerate(self.stem_ids)]
+        if self.unaligned_words:
+            for position, word in self.unaligned_words.items():
+                terms[position].full_word = word
+        return terms
+
+
+# convert document to its stored form (stems are interned in given vocabulary)
+def to_stored_document(doc, stem_vocabulary):
+    words = [term.full_word for term in doc.text]
+    raw_text = (doc.raw_text if doc.raw_text is not None else " ".join(words)).encode("utf-8")
+    offsets, unaligned_words = token_offsets(raw_text, words)
+    stem_ids = array("I", [stem_vocabulary.get_id(term.stem) for term in doc.text])
+    return StoredDocument(doc.title, doc.url, doc.score, raw_text, stem_ids, offsets, unaligned_words or None)
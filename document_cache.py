@@ -0,0 +1,90 @@
+from concurrent.futures import ThreadPoolExecutor
+import math
+import sys
+from query_cache import LRUCache
+
+# max number of cached docs (cache is bounded by memory of docs, this only bounds number of tiny ones)
+MAX_CACHED_DOCUMENTS = 10 ** 6
+
+
+# approximate memory used by decoded stored document (see document.StoredDocument)
+def stored_document_size(stored_document):
+    return (sys.getsizeof(stored_document) + sys.getsizeof(stored_document.title) +
+            sys.getsizeof(stored_document.url) + sys.getsizeof(stored_document.raw_text) +
+            sys.getsizeof(stored_document.stem_ids) + sys.getsizeof(stored_document.offsets) +
+            (sys.getsizeof(stored_document.unaligned_words) if stored_document.unaligned_words else 0))
+
+
+# cache of decoded stored documents in front of forward index of indexes (other calls go to indexes)
+# popular docs are shown on many result pages, cached ones are not read and unpickled again
+# docs are cached by generation of indexes (docids of merged segments can change) and evicted least recently used
+# first when their memory is larger than max_bytes, docs of next page of results can be loaded in background
+class DocumentCache(object):
+    def __init__(self, indexes, max_bytes):
+        self._indexes = indexes
+        self.cache = LRUCache(MAX_CACHED_DOCUMENTS, math.inf,
+                              lambda stored_document_and_vocabulary: stored_document_size(
+                                  stored_document_and_vocabulary[0]), max_bytes)
+        self._generation = None
+        # one background thread loads docs of next pages
+        self._prefetch_executor = ThreadPoolExecutor(1)
+        self.prefetched = 0
+
+    def __getattr__(self, name):
+        return getattr(self._indexes, name)
+
+    # generation of indexes, cached docs of previous generation are dropped
+    def _current_generation(self):
+        generation = self._indexes.generation()
+        if generation != self._generation:
+            self.cache.clear()
+            self._generation = generation
+        return generation
+
+    # read docs from indexes in one pass and cache them (unless indexes have changed meanwhile)
+    def _load(self, generation, docids):
+        stored_documents = self._indexes.get_stored_documents(docids)
+        if self._indexes.generation() == generation:
+            for docid, stored_document in zip(docids, stored_documents):
+                self.cache.put((generation, docid), stored_document)
+        return stored_documents
+
+    # stored forms of docs (see indexes get_stored_document) in order of docids, e.g. whole page of results,
+    # cached docs are found first, missing ones are read from indexes at once
+    def get_many(self, docids):
+        generation = self._current_generation()
+        stored_documents = {}
+        for docid in docids:
+            stored_document = self.cache.get((generation, docid))
+            if stored_document is not None:
+                stored_documents[docid] = stored_document
+        missing_docids = [docid for docid in dict.fromkeys(docids) if docid not in stored_documents]
+        if missing_docids:
+            stored_documents.update(zip(missing_docids, self._load(generation, missing_docids)))
+        return [stored_documents[docid] for docid in docids]
+
+    def get_stored_documents(self, doc_ids):
+        return self.get_many(doc_ids)
+
+    def get_stored_document(self, doc_id):
+        return self.get_many([doc_id])[0]
+
+    # load docs which are not cached yet in background (e.g. docs of next page of results)
+    def prefetch(self, docids):
+        self._prefetch_executor.submit(self._prefetch, self._current_generation(), list(docids))
+
+    def _prefetch(self, generation, docids):
+        missing_docids = [docid for docid in docids if (generation, docid) not in self.cache]
+        if missing_docids and self._indexes.generation() == generation:
+            self._load(generation, missing_docids)
+            self.prefetched += len(missing_docids)
+
+    # hits, misses, number and memory of cached docs, number of prefetched docs
+    def stats(self):
+        lookups = self.cache.hits + self.cache.misses
+        return {"hits": self.cache.hits,
+                "misses": self.cache.misses,
+                "hit_rate": self.cache.hits / lookups if lookups else 0,
+                "entries": len(self.cache),
+                "memory_bytes": self.cache.memory_bytes,
+                "prefetched": self.prefetched}
@@ -0,0 +1,38 @@
+import json
+import os
+import uuid
+
+# version of format of indexes on disk, indexes of other versions have to be created again
+INDEX_FORMAT_VERSION = 6
+# file with collection statistics written alongside indexes
+INDEX_META_FILENAME = "index_meta.json"
+
+
+# write collection statistics of indexes (atomically, so readers never see half written file)
+# every write gets new generation of indexes, so caches of search results can tell that indexes have changed
+# fields - other fields stored with statistics (e.g. list of segments of segmented index)
+def write_index_meta(index_dir, doc_count, total_tokens, **fields):
+    meta = {"format_version": INDEX_FORMAT_VERSION,
+            "generation": uuid.uuid4().hex,
+            "doc_count": doc_count,
+            "total_tokens": total_tokens,
+            "average_doc_len": total_tokens / doc_count if doc_count else 0}
+    meta.update(fields)
+    meta_path = os.path.join(index_dir, INDEX_META_FILENAME)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as meta_file:
+        json.dump(meta, meta_file)
+    os.replace(meta_path + ".tmp", meta_path)
+    return meta
+
+
+# read collection statistics of indexes
+def read_index_meta(index_dir):
+    try:
+        with open(os.path.join(index_dir, INDEX_META_FILENAME), encoding="utf-8") as meta_file:
+            meta = json.load(meta_file)
+    except FileNotFoundError:
+        raise ValueError("No {} in {}, indexes have to be created again".format(INDEX_META_FILENAME, index_dir))
+    if meta["format_version"] != INDEX_FORMAT_VERSION:
+        raise ValueError("Indexes in {} have format version {} instead of {}, they have to be created again".format(
+            index_dir, meta["format_version"], INDEX_FORMAT_VERSION))
+    return meta
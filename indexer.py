@@ -1,25 +1,149 @@
 import argparse
-import json
+from array import array
+import heapq
+import itertools
+import multiprocessing
 import os.path
-from joblib.numpy_pickle_utils import xrange
+import pickle
+import resource
+import shutil
+import time
+from collections import Counter, defaultdict
 from lang_proc import to_doc_terms
 import shelve
-from document import Document
+from document import Document, StemVocabulary, SurfaceForms, to_stored_document, popularity_prior, \
+    read_surface_forms, write_surface_forms
+from postings import encode_postings, decode_postings, decode_docids_and_tfs, decode_positions, group_occurrences, \
+    term_stats, posting_list_docs_num, iter_docid_blocks
+from segment import write_segment, create_segments, segment_name, segments_lock, write_manifest, \
+    merge_segments_if_needed, write_term_dictionary, SegmentIndexes, TermDictionary, DEFAULT_MAX_SEGMENTS
+from index_meta import write_index_meta, read_index_meta
+from crawl_storage import iter_crawled_posts
+import metrics
+
+
+# number of docs in one block of inverted index built in memory while indexing
+DEFAULT_BLOCK_SIZE = 200
+# max number of runs merged at once (more runs are merged level by level)
+MERGE_FAN_IN = 128
+
+
+# write sorted run of (stem, occurrences) entries to file
+def _write_run(path, entries):
+    with open(path, "wb") as run_file:
+        for entry in entries:
+            pickle.dump(entry, run_file, pickle.HIGHEST_PROTOCOL)
+
+
+# read sorted run written by _write_run entry by entry
+def _read_run(path):
+    with open(path, "rb") as run_file:
+        while True:
+            try:
+                yield pickle.load(run_file)
+            except EOFError:
+                return
+
+
+# k-way streaming merge of sorted runs (runs are given in docid order, so occurrences stay sorted by docid)
+def merge_runs(run_paths):
+    merged_entries = heapq.merge(*[_read_run(path) for path in run_paths], key=lambda entry: entry[0])
+    for stem, entries in itertools.groupby(merged_entries, key=lambda entry: entry[0]):
+        occurrences = []
+        for (_, run_occurrences) in entries:
+            occurrences.extend(run_occurrences)
+        yield stem, occurrences
+
+
+# path of sorted run of block with given number
+def _run_path(index_dir, block_number):
+    return os.path.join(index_dir, "inverted_index_run0_{}".format(block_number))
+
+
+# path of stored documents of block with given number indexed by worker process (see _index_block)
+def _block_documents_path(index_dir, block_number):
+    return os.path.join(index_dir, "documents_run0_{}".format(block_number))
+
+
+# add occurrences of doc terms to block of inverted index, return doc stats (doc length and term frequencies)
+def add_to_block(block, doc, docid):
+    # count indexed stems of doc, so bm25 never has to rescan its text
+    term_frequencies = Counter()
+    for position, term in enumerate(doc.text):
+        # check if stop word
+        if term.is_stop_word():
+            continue
+        # update by stem!
+        stem = term.stem
+        term_frequencies[stem] += 1
+        block[stem].append((position, docid))
+    return len(doc.text), dict(term_frequencies)
+
+
+# write block of inverted index to disk as run sorted by stem
+def write_block(run_path, block):
+    _write_run(run_path, ((stem, block[stem]) for stem in sorted(block)))
+
+
+# shelve which is opened on first access (opening some dbm backends reads all their keys)
+class LazyShelf(object):
+    def __init__(self, path):
+        self._path = path
+        self._shelf = None
+
+    def _get_shelf(self):
+        if self._shelf is None:
+            self._shelf = shelve.open(self._path)
+        return self._shelf
+
+    def __getattr__(self, name):
+        return getattr(self._get_shelf(), name)
+
+    def __getitem__(self, key):
+        return self._get_shelf()[key]
+
+    def __contains__(self, key):
+        return key in self._get_shelf()
+
+    def __iter__(self):
+        return iter(self._get_shelf())
+
+    def __len__(self):
+        return len(self._get_shelf())
 
 
 # class used for indexing using shelves
 class ShelveIndexes(object):
-    def __init__(self):
+    def __init__(self, block_size=DEFAULT_BLOCK_SIZE):
         # creating shelves
         self.inverted_index = None
         self.forward_index = None
         self.url_to_id = None
+        self.doc_stats = None
+        self.term_stats = None
+        # sorted dictionary of indexed stems (mapped when prefix or fuzzy lookup needs it)
+        self.term_dictionary = None
+        # interned stems of stored documents (loaded lazily when indexes are loaded from disk)
+        self.stem_vocabulary = StemVocabulary()
+        # words of indexed stems shown instead of them (loaded lazily when indexes are loaded from disk)
+        self.surface_forms = SurfaceForms()
         # initialize class variables
         self.doc_count = 0
+        self.block_size = block_size
         self.block_count = 0
         self.index_dir = ""
+        # block of inverted index built in memory: stem -> [(position, docid)]
+        self._block = defaultdict(list)
+        self._block_docs_num = 0
+        self._run_paths = []
         self._doc_count = 0
+        self._total_tokens = 0
         self._avgdl = 0
+        self._generation = ""
+        # lengths of added docs by docid (used for term stats when blocks are merged)
+        self._doc_lengths = array("I", [0])
+        # popularity priors of added docs by docid (see document.popularity_prior)
+        self._static_priors = array("f", [0])
 
     # total number of docs
     def total_doc_count(self):
@@ -29,101 +153,284 @@ class ShelveIndexes(object):
     def average_doc_len(self):
         return self._avgdl
 
+    # id of indexes version, it changes when indexes are written again
+    def generation(self):
+        return self._generation
+
     # saving indexes on disk
     def save_on_disk(self):
-        self.inverted_index.close()
+        self._flush_block()
         self.forward_index.close()
         self.url_to_id.close()
+        self.doc_stats.close()
+        self._save_stem_vocabulary()
+        write_surface_forms(os.path.join(self.index_dir, "surface_forms"), self.surface_forms)
+        self._save_doc_lengths()
+        self._save_static_priors()
         self._merge_blocks()
+        # collection statistics, so loading indexes does not need to read them
+        write_index_meta(self.index_dir, self.doc_count, self._total_tokens)
 
-    # loading indexes from disk
+    # loading indexes from disk (only collection statistics are read, everything else is read when needed)
     def load_from_disk(self, index_dir):
-        self.inverted_index = shelve.open(os.path.join(index_dir, "inverted_index"))
-        self.forward_index = shelve.open(os.path.join(index_dir, "forward_index"))
-        self.url_to_id = shelve.open(os.path.join(index_dir, "url_to_id"))
+        meta = read_index_meta(index_dir)
+        self.index_dir = index_dir
+        self.inverted_index = LazyShelf(os.path.join(index_dir, "inverted_index"))
+        self.forward_index = LazyShelf(os.path.join(index_dir, "forward_index"))
+        self.url_to_id = LazyShelf(os.path.join(index_dir, "url_to_id"))
+        self.doc_stats = LazyShelf(os.path.join(index_dir, "doc_stats"))
+        self.term_stats = LazyShelf(os.path.join(index_dir, "term_stats"))
+        self.term_dictionary = None
+        self.stem_vocabulary = None
+        self.surface_forms = None
 
         # count variables used for mb25 ranking
-        self._doc_count = 0
-        total_word_count = 0
-        for (docid, text) in self.forward_index.items():
-            self._doc_count += 1
-            total_word_count += len(text.text)
-        self._avgdl = total_word_count / self._doc_count
+        self._doc_count = meta["doc_count"]
+        self._total_tokens = meta["total_tokens"]
+        self._avgdl = meta["average_doc_len"]
+        self._generation = meta.get("generation", "")
+
+    # shelves are not changed after indexing (new posts are added to segmented index)
+    def reload_if_changed(self):
+        return False
+
+    # interned stems of stored documents
+    def get_stem_vocabulary(self):
+        if self.stem_vocabulary is None:
+            with open(os.path.join(self.index_dir, "stems"), "rb") as stems_file:
+                self.stem_vocabulary = StemVocabulary(pickle.load(stems_file))
+        return self.stem_vocabulary
+
+    # words of indexed stems (one SurfaceForms, segmented index has one per segment)
+    def get_surface_forms(self):
+        if self.surface_forms is None:
+            self.surface_forms = read_surface_forms(os.path.join(self.index_dir, "surface_forms"))
+        return [self.surface_forms]
 
     # index all indexes
     def start_indexing(self, index_dir):
-        self.forward_index = shelve.open(os.path.join(index_dir, "forward_index"), "n", writeback=True)
-        self.url_to_id = shelve.open(os.path.join(index_dir, "url_to_id"), "n", writeback=True)
+        self.forward_index = shelve.open(os.path.join(index_dir, "forward_index"), "n")
+        self.url_to_id = shelve.open(os.path.join(index_dir, "url_to_id"), "n")
+        self.doc_stats = shelve.open(os.path.join(index_dir, "doc_stats"), "n")
         # update index directory
         self.index_dir = index_dir
 
+    def _save_stem_vocabulary(self):
+        with open(os.path.join(self.index_dir, "stems"), "wb") as stems_file:
+            pickle.dump(self.stem_vocabulary.stems, stems_file, pickle.HIGHEST_PROTOCOL)
+
+    # lengths of docs by docid as array of unsigned ints (docid 0 is not used)
+    def _save_doc_lengths(self):
+        with open(os.path.join(self.index_dir, "doc_lengths"), "wb") as doc_lengths_file:
+            self._doc_lengths.tofile(doc_lengths_file)
+
+    # popularity priors of docs by docid as array of floats (docid 0 is not used)
+    def _save_static_priors(self):
+        with open(os.path.join(self.index_dir, "static_priors"), "wb") as static_priors_file:
+            self._static_priors.tofile(static_priors_file)
+
+    # lengths of all docs by docid (docid 0 is not used), used by vectorized ranking
+    # (array is read whole before it is shared, so other threads never see it half read)
+    def get_doc_lengths(self):
+        if len(self._doc_lengths) != self._doc_count + 1:
+            doc_lengths = array("I")
+            with open(os.path.join(self.index_dir, "doc_lengths"), "rb") as doc_lengths_file:
+                doc_lengths.fromfile(doc_lengths_file, self._doc_count + 1)
+            self._doc_lengths = doc_lengths
+        return self._doc_lengths
+
+    # popularity priors of all docs by docid (docid 0 is not used), blended with bm25 by searcher
+    def get_static_priors(self):
+        if len(self._static_priors) != self._doc_count + 1:
+            static_priors = array("f")
+            with open(os.path.join(self.index_dir, "static_priors"), "rb") as static_priors_file:
+                static_priors.fromfile(static_priors_file, self._doc_count + 1)
+            self._static_priors = static_priors
+        return self._static_priors
+
     # sync indexes
     def sync(self):
-        self.inverted_index.sync()
         self.forward_index.sync()
         self.url_to_id.sync()
+        self.doc_stats.sync()
 
-    # merge block of inverted (merged) index
+    # merge sorted runs of blocks to inverted (merged) index
     def _merge_blocks(self):
-        # get blocks
-        blocks = [shelve.open(os.path.join(self.index_dir, "inverted_index_block{}".format(i))) for i in
-                  xrange(self.block_count)]
-        keys = set()
-        for block in blocks:
-            keys |= set(block.keys())
+        run_paths = self._run_paths
+        level = 0
+        # merge too many runs level by level, so number of open runs is bounded
+        while len(run_paths) > MERGE_FAN_IN:
+            level_run_paths = []
+            for i in range(0, len(run_paths), MERGE_FAN_IN):
+                level_run_path = os.path.join(self.index_dir, "inverted_index_run{}_{}".format(level + 1, i))
+                _write_run(level_run_path, merge_runs(run_paths[i:i + MERGE_FAN_IN]))
+                level_run_paths.append(level_run_path)
+            self._remove_runs(run_paths)
+            run_paths = level_run_paths
+            level += 1
         # open merged index
         merged_index = shelve.open(os.path.join(self.index_dir, "inverted_index"), "n")
-        key_ind = 0
-        # for each key update merged index
-        for key in keys:
-            key_ind += 1
-            merged_index[key] = sum([block.get(key, []) for block in blocks], [])
+        merged_term_stats = shelve.open(os.path.join(self.index_dir, "term_stats"), "n")
+        # stems come in sorted order, so they are also written to sorted term dictionary with their stats
+        terms_and_stats = []
+        # for each key update merged index and its stats (number of docs containing it, max tf / doc len ratio)
+        for stem, occurrences in merge_runs(run_paths):
+            merged_index[stem] = self._encode_posting_list(occurrences)
+            merged_term_stats[stem] = stats = term_stats(occurrences, self._doc_lengths)
+            terms_and_stats.append((stem,) + stats)
         # save merged index
         merged_index.close()
+        merged_term_stats.close()
+        write_term_dictionary(os.path.join(self.index_dir, "terms"), terms_and_stats)
+        self._remove_runs(run_paths)
+        self._run_paths = []
+
+    @staticmethod
+    def _remove_runs(run_paths):
+        for run_path in run_paths:
+            os.remove(run_path)
+
+    # posting list of (position, docid) occurrences is stored as is
+    def _encode_posting_list(self, occurrences):
+        return occurrences
 
-    # create a new block of data if needed
-    def _create_new_ii_block(self):
-        # save old inverted index
-        if self.inverted_index:
-            self.inverted_index.close()
-        # create new inverted index with new block
-        self.inverted_index = shelve.open(
-            os.path.join(self.index_dir, "inverted_index_block{}".format(self.block_count)), "n", writeback=True)
+    # write block built in memory to disk as run sorted by stem
+    def _flush_block(self):
+        if self._block_docs_num == 0:
+            return
+        run_path = _run_path(self.index_dir, self.block_count)
+        write_block(run_path, self._block)
+        self._run_paths.append(run_path)
         # update block count
         self.block_count += 1
+        self._block = defaultdict(list)
+        self._block_docs_num = 0
 
-    def add_document(self, doc):
-        # create new block if needed (per 200)
-        if self.doc_count % 200 == 0:
-            self._create_new_ii_block()
-        self.doc_count += 1
+    # path of run for next block (blocks built outside of indexes should write their runs there)
+    def next_run_path(self):
+        return _run_path(self.index_dir, self.block_count)
+
+    # add whole block indexed outside of indexes (e.g. by worker process), its run is at next_run_path()
+    # documents_path - file written by _index_block: stems of block and their words, then stored documents of block
+    # in docid order with their stats
+    def add_block(self, documents_path):
+        self._flush_block()
+        entries = _read_run(documents_path)
+        stems, word_counts = next(entries)
+        self.surface_forms.update(SurfaceForms(word_counts))
+        # stem ids of block -> stem ids of vocabulary (blocks are added in order, so ids are the same as in serial
+        # indexing)
+        stem_ids = array("I", [self.stem_vocabulary.get_id(stem) for stem in stems])
+        for stored_document, stats in entries:
+            self.doc_count += 1
+            stored_document.stem_ids = array("I", [stem_ids[stem_id] for stem_id in stored_document.stem_ids])
+            self._store_stored_document(self.doc_count, stored_document, stats)
+        os.remove(documents_path)
+        self._run_paths.append(self.next_run_path())
+        self.block_count += 1
+
+    # update url to id, forward index and doc stats
+    def _store_document(self, docid, doc, stats):
+        self.surface_forms.add_document(doc)
+        self._store_stored_document(docid, to_stored_document(doc, self.stem_vocabulary), stats)
+
+    def _store_stored_document(self, docid, stored_document, stats):
         # check if doc was already added
-        assert doc.url not in self.url_to_id
+        assert stored_document.url not in self.url_to_id
         # update url to id
-        self.url_to_id[doc.url] = self.doc_count
-        # update forward index
-        self.forward_index[str(self.doc_count)] = doc
-        # update inverted index
-        for position, term in enumerate(doc.text):
-            # check if stop word
-            if term.is_stop_word():
-                continue
-            # update by stem!
-            stem = term.stem
-            if stem not in self.inverted_index:
-                self.inverted_index[stem] = []
-            self.inverted_index[stem].append((position, self.doc_count))
+        self.url_to_id[stored_document.url] = docid
+        # update forward index (compact form of doc)
+        self.forward_index[str(docid)] = stored_document
+        # update doc stats (doc length and term frequencies)
+        self.doc_stats[str(docid)] = stats
+        self._total_tokens += stats[0]
+        self._doc_lengths.append(stats[0])
+        self._static_priors.append(popularity_prior(stored_document.score))
+
+    def add_document(self, doc):
+        # write block to disk if it is full
+        if self._block_docs_num == self.block_size:
+            self._flush_block()
+        self._block_docs_num += 1
+        self.doc_count += 1
+        # update inverted index and other indexes
+        self._store_document(self.doc_count, doc, add_to_block(self._block, doc, self.doc_count))
+
+    # stored posting list of stem, size of its record read from disk is counted when metrics are enabled
+    def _get_posting_list(self, stem, default):
+        if not metrics.enabled:
+            return self.inverted_index.get(stem, default)
+        try:
+            record = self.inverted_index.dict[stem.encode("utf-8")]
+        except KeyError:
+            return default
+        metrics.increment("posting_lists_read")
+        metrics.increment("postings_bytes_read", len(record))
+        return pickle.loads(record)
 
     # getters
     def get_documents(self, query_term):
-        return self.inverted_index.get(query_term.stem, [])
+        return self._get_posting_list(query_term.stem, [])
+
+    # sorted distinct docids containing query term
+    def get_document_ids(self, query_term):
+        return sorted(set(docid for (pos, docid) in self.get_documents(query_term)))
+
+    # number of docs of posting list and iterator of its sorted docids in blocks (arrays) decoded when they are needed
+    # (pickled posting list is one block)
+    def get_docid_blocks(self, query_term):
+        docids = self.get_document_ids(query_term)
+        return len(docids), iter([docids])
+
+    # posting list grouped by docid: [(docid, positions)]
+    def get_postings(self, query_term):
+        return group_occurrences(self.get_documents(query_term))
+
+    # positions of query term in given docs: {docid: positions} of docs of sorted docids containing query term
+    def get_positions(self, query_term, docids):
+        docids = set(docids)
+        return dict(group_occurrences(occurrence for occurrence in self.get_documents(query_term)
+                                      if occurrence[1] in docids))
+
+    # columnar posting list without positions: arrays of sorted docids and term frequencies in them
+    def get_docids_and_tfs(self, query_term):
+        postings = self.get_postings(query_term)
+        return (array("I", [docid for docid, positions in postings]),
+                array("I", [len(positions) for docid, positions in postings]))
+
+    # sorted dictionaries of indexed stems (see segment.TermDictionary) used for prefix and fuzzy lookup of terms
+    def get_term_dictionaries(self):
+        if self.term_dictionary is None:
+            self.term_dictionary = TermDictionary(os.path.join(self.index_dir, "terms"))
+        return [self.term_dictionary]
+
+    # number of docs containing query term
+    def get_document_frequency(self, query_term):
+        return self.term_stats.get(query_term.stem, (0, 0))[0]
+
+    # max ratio of query term frequency to doc length among docs containing it (bounds its bm25 rank)
+    def get_max_tf_ratio(self, query_term):
+        return self.term_stats.get(query_term.stem, (0, 0))[1]
+
+    # length of doc and frequencies of its indexed stems
+    def get_document_stats(self, doc_id):
+        return self.doc_stats[str(doc_id)]
 
     def get_document_text(self, doc_id):
-        return self.forward_index[str(doc_id)].text
+        return self.forward_index[str(doc_id)].terms(self.get_stem_vocabulary())
+
+    # stored form of doc (see document.StoredDocument) and vocabulary of its stem ids
+    def get_stored_document(self, doc_id):
+        if metrics.enabled:
+            metrics.increment("documents_loaded")
+        return self.forward_index[str(doc_id)], self.get_stem_vocabulary()
+
+    # stored forms of docs (see get_stored_document) in order of doc_ids, records are read in docid order
+    def get_stored_documents(self, doc_ids):
+        stored_documents = {doc_id: self.get_stored_document(doc_id) for doc_id in sorted(doc_ids)}
+        return [stored_documents[doc_id] for doc_id in doc_ids]
 
     def get_document_score(self, doc_id):
-        if self.forward_index[str(doc_id)].score > 2:
-            print("HI")
         return self.forward_index[str(doc_id)].score
 
     def get_url(self, doc_id):
@@ -133,33 +440,178 @@ class ShelveIndexes(object):
         return self.forward_index[str(doc_id)].title
 
 
-# create indexes function
-def create_index_from_dir(crawled_data_dir, index_directory, IndexesImplementation=ShelveIndexes):
-    indexer = IndexesImplementation()
+# class used for indexing using shelves with compact binary posting lists
+# (grouped by docid, docids and positions are delta and varint encoded, see postings.py)
+class CompactIndexes(ShelveIndexes):
+    def _encode_posting_list(self, occurrences):
+        return encode_postings(group_occurrences(occurrences))
+
+    # getters
+    def get_documents(self, query_term):
+        return [(position, docid) for docid, positions in self.get_postings(query_term) for position in positions]
+
+    def get_document_ids(self, query_term):
+        docids, tfs = self.get_docids_and_tfs(query_term)
+        return docids
+
+    def get_docids_and_tfs(self, query_term):
+        return decode_docids_and_tfs(self._get_posting_list(query_term.stem, b""))
+
+    def get_docid_blocks(self, query_term):
+        posting_list = self._get_posting_list(query_term.stem, b"")
+        return posting_list_docs_num(posting_list), iter_docid_blocks(posting_list)
+
+    def get_postings(self, query_term):
+        return decode_postings(self._get_posting_list(query_term.stem, b""))
+
+    # only positions of given docs are decoded (posting list is not decoded after the last of them)
+    def get_positions(self, query_term, docids):
+        return decode_positions(self._get_posting_list(query_term.stem, b""), docids)
+
+
+# indexes implementations by their names in command line
+INDEXES_IMPLEMENTATIONS = {"shelve": ShelveIndexes, "compact": CompactIndexes}
+
+
+# create document from crawled post (dict with title, text, url and score)
+def read_crawled_document(json_doc):
+    # get data about document
+    doc_title = json_doc["title"]
+    doc_text = to_doc_terms(json_doc["text"])
+    doc_url = json_doc["url"]
+    doc_score = json_doc["score"]
+    # create new document
+    return Document(doc_title, doc_text, doc_url, int(doc_score), json_doc["text"])
+
+
+# index block of crawled posts in worker process: write its sorted run and its stored documents with their stats
+# (stems are interned in vocabulary of block), return path of its documents
+def _index_block(task):
+    posts, first_docid, run_path, documents_path = task
+    block = defaultdict(list)
+    stem_vocabulary = StemVocabulary()
+    surface_forms = SurfaceForms()
+    stored_documents_and_stats = []
+    for docid, post in enumerate(posts, first_docid):
+        doc = read_crawled_document(post)
+        stats = add_to_block(block, doc, docid)
+        surface_forms.add_document(doc)
+        stored_documents_and_stats.append((to_stored_document(doc, stem_vocabulary), stats))
+    write_block(run_path, block)
+    _write_run(documents_path, itertools.chain([(stem_vocabulary.stems, surface_forms.word_counts)],
+                                               stored_documents_and_stats))
+    return documents_path
+
+
+# blocks of posts read from stream with docid of their first post, path of their run and path of their documents
+def _block_tasks(indexer, posts, block_size):
+    first_docid, first_block_number = indexer.doc_count + 1, indexer.block_count
+    for block_number in itertools.count():
+        block_posts = list(itertools.islice(posts, block_size))
+        if not block_posts:
+            return
+        yield (block_posts, first_docid + block_number * block_size,
+               _run_path(indexer.index_dir, first_block_number + block_number),
+               _block_documents_path(indexer.index_dir, first_block_number + block_number))
+
+
+# add crawled posts to indexer using pool of worker processes (blocks are the same as in serial indexing)
+# workers write whole blocks to disk, indexer only merges them
+def _index_posts_in_parallel(indexer, posts, block_size, workers):
+    tasks = _block_tasks(indexer, posts, block_size)
+    with multiprocessing.Pool(workers) as pool:
+        # posts are read in waves of few blocks per worker, so whole crawl is never in memory
+        while True:
+            wave = list(itertools.islice(tasks, 2 * workers))
+            if not wave:
+                break
+            # results are returned in order of blocks, so docids are the same as in serial indexing
+            for task, documents_path in zip(wave, pool.imap(_index_block, wave)):
+                assert indexer.next_run_path() == task[2]
+                indexer.add_block(documents_path)
+                indexer.sync()
+
+
+# index stream of crawled posts
+def index_posts(posts, index_directory, IndexesImplementation=ShelveIndexes, block_size=DEFAULT_BLOCK_SIZE,
+                workers=1):
+    start_time = time.time()  # used for time statistics
+    indexer = IndexesImplementation(block_size)
     # start indexing
     indexer.start_indexing(index_directory)
-    indexed_docs_num = 0
-    # loop through each file in crawled_data
-    for filename in os.listdir(crawled_data_dir):
-        indexed_docs_num += 1
-        # open and read file
-        file_to_open = os.path.join(crawled_data_dir, filename)
-        with open(file_to_open, encoding="utf-8") as doc:
-            json_doc = json.load(doc)
-        # get data about document
-        doc_title = json_doc["title"]
-        doc_text = to_doc_terms(json_doc["text"])
-        doc_url = json_doc["url"]
-        doc_score = json_doc["score"]
-        # create new document
-        new_document = Document(doc_title, doc_text, doc_url, int(doc_score))
-        # sync if needed
-        if indexed_docs_num % 100 == 0:
-            indexer.sync()
-        # add it to indexer
-        indexer.add_document(new_document)
+    if workers > 1:
+        _index_posts_in_parallel(indexer, posts, block_size, workers)
+    else:
+        # loop through each post in crawled_data
+        for indexed_docs_num, post in enumerate(posts, 1):
+            new_document = read_crawled_document(post)
+            # sync if needed
+            if indexed_docs_num % 100 == 0:
+                indexer.sync()
+            # add it to indexer
+            indexer.add_document(new_document)
     # save indexes on disk in JSON file
     indexer.save_on_disk()
+    # report time and memory statistics (ru_maxrss is in kilobytes on linux, children are worker processes)
+    statistics = {"docs": indexer.doc_count,
+                  "seconds": time.time() - start_time,
+                  "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "workers_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}
+    print("Indexed {docs} docs in {seconds:.2f} seconds, peak memory {peak_rss_mb:.1f} MB".format(**statistics))
+    return statistics
+
+
+# create indexes function
+def create_index_from_dir(crawled_data_dir, index_directory, IndexesImplementation=ShelveIndexes,
+                          block_size=DEFAULT_BLOCK_SIZE, workers=1):
+    # posts are streamed from crawled data (chunks of JSON lines or old layout with file per post)
+    return index_posts(iter_crawled_posts(crawled_data_dir), index_directory, IndexesImplementation, block_size,
+                       workers)
+
+
+# posts whose urls are not indexed yet (posts crawled twice are returned once by iter_crawled_posts)
+# urls with docids above doc_count of manifest were recorded by append interrupted before its segment was added
+# to manifest, their posts are indexed again
+def _new_posts(posts, url_to_id, doc_count):
+    return (post for post in posts if url_to_id.get(post["url"], doc_count + 1) > doc_count)
+
+
+# incremental indexing: index crawled posts which are not in indexes yet as new segment of segmented index
+# (created with --segment), collection statistics of segmented index are updated
+# order_by_prior - docids of new segment are assigned in order of decreasing popularity prior (see write_segment)
+def append_to_index(crawled_data_dir, index_directory, IndexesImplementation=ShelveIndexes,
+                    block_size=DEFAULT_BLOCK_SIZE, workers=1, order_by_prior=False):
+    segments_dir = SegmentIndexes.segments_dir(index_directory)
+    with segments_lock(segments_dir):
+        manifest = read_index_meta(segments_dir)
+        # new posts are indexed to temporary indexes with docids 1..n, their segment continues docids of index
+        temporary_dir = os.path.join(segments_dir, "appending")
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        os.mkdir(temporary_dir)
+        with shelve.open(os.path.join(index_directory, "url_to_id")) as url_to_id:
+            statistics = index_posts(_new_posts(iter_crawled_posts(crawled_data_dir), url_to_id,
+                                                manifest["doc_count"]),
+                                     temporary_dir, IndexesImplementation, block_size, workers)
+            if statistics["docs"] > 0:
+                indexes = IndexesImplementation()
+                indexes.load_from_disk(temporary_dir)
+                docid_offset = manifest["doc_count"]
+                name = segment_name(manifest["next_segment"])
+                # segment of append interrupted before manifest was replaced is written again
+                shutil.rmtree(os.path.join(segments_dir, name), ignore_errors=True)
+                segment_docids = write_segment(indexes, os.path.join(segments_dir, name), docid_offset,
+                                               order_by_prior)
+                segment_meta = read_index_meta(os.path.join(segments_dir, name))
+                # urls are recorded before manifest is replaced, urls of interrupted append are above its doc count
+                for url, docid in indexes.url_to_id.items():
+                    url_to_id[url] = segment_docids[docid]
+                url_to_id.sync()
+                # searchers see new segment when manifest is replaced
+                write_manifest(segments_dir, manifest["segments"] + [name], manifest["next_segment"] + 1,
+                               manifest["doc_count"] + segment_meta["doc_count"],
+                               manifest["total_tokens"] + segment_meta["total_tokens"])
+        shutil.rmtree(temporary_dir)
+    return statistics
 
 
 def main():
@@ -167,18 +619,62 @@ def main():
     parser = argparse.ArgumentParser(description="Index /r/{your subreddit}")
     parser.add_argument("--crawled_data", dest="crawled_data", required=True, help="Crawled data directory")
     parser.add_argument("--index_dir", dest="index_dir", required=True, help="Index directory")
+    parser.add_argument("--index_format", dest="index_format", default="shelve",
+                        choices=sorted(INDEXES_IMPLEMENTATIONS), help="Format of stored indexes")
+    parser.add_argument("--segment", dest="segment", action="store_true",
+                        help="Also write final read only memory mapped segment (used by web searcher)")
+    parser.add_argument("--block_size", dest="block_size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help="Number of docs in one in-memory block of inverted index")
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="Number of worker processes parsing and tokenizing crawled posts")
+    parser.add_argument("--append", dest="append", action="store_true",
+                        help="Add posts which are not indexed yet as new segment of existing segmented index")
+    parser.add_argument("--max_segments", dest="max_segments", type=int, default=DEFAULT_MAX_SEGMENTS,
+                        help="Segments are merged after appending when there are more of them")
+    parser.add_argument("--shards", dest="shards", type=int, default=0,
+                        help="Partition docs to that many shards searched by separate processes")
+    parser.add_argument("--order_by_prior", dest="order_by_prior", action="store_true",
+                        help="Assign docids of segments in order of decreasing popularity prior of docs")
     args = parser.parse_args()
 
+    IndexesImplementation = INDEXES_IMPLEMENTATIONS[args.index_format]
+    print("Crawled data: " + args.crawled_data)
+    print("Index directory: " + args.index_dir)
+    if args.append:
+        # check if segmented index is created
+        if not os.path.exists(SegmentIndexes.segments_dir(args.index_dir)):
+            print("No segmented index in folder, create it with --segment first")
+            exit()
+        append_to_index(args.crawled_data, args.index_dir, IndexesImplementation, args.block_size, args.workers,
+                        args.order_by_prior)
+        merge_segments_if_needed(SegmentIndexes.segments_dir(args.index_dir), args.max_segments)
+        print("Success!")
+        return
     # check if indexes already created
     try:
         os.mkdir(args.index_dir)
     except FileExistsError:
         print("Folder is already created")
         exit()
-    print("Crawled data: " + args.crawled_data)
-    print("Index directory: " + args.index_dir)
+    # create sharded index (shards.py imports this module, so it is imported here)
+    if args.shards > 0:
+        from shards import create_sharded_index
+        create_sharded_index(args.crawled_data, args.index_dir, args.index_format, args.shards, args.block_size,
+                             args.workers)
+        print("Success!")
+        return
     # create indexes
-    create_index_from_dir(args.crawled_data, args.index_dir)
+    create_index_from_dir(args.crawled_data, args.index_dir, IndexesImplementation, args.block_size, args.workers)
+    # write immutable segments from created indexes
+    if args.segment:
+        indexes = IndexesImplementation()
+        indexes.load_from_disk(args.index_dir)
+        segment_docids = create_segments(indexes, SegmentIndexes.segments_dir(args.index_dir), args.order_by_prior)
+        # urls are mapped to docids of segmented index (they differ when docids are ordered by prior)
+        if args.order_by_prior:
+            with shelve.open(os.path.join(args.index_dir, "url_to_id")) as url_to_id:
+                for url, docid in list(url_to_id.items()):
+                    url_to_id[url] = segment_docids[docid]
     print("Success!")
 
 
@@ -1,18 +1,66 @@
+from array import array
+from functools import lru_cache
 from nltk.stem.porter import PorterStemmer
 from nltk.tokenize import sent_tokenize, TreebankWordTokenizer
-import itertools
 import string
 from nltk.corpus import stopwords
+import metrics
 
 # stop words variable from nltk
-_stop_words = stopwords.words('english')
+_stop_words = frozenset(stopwords.words('english'))
+
+# max number of words in memo of their stems
+DEFAULT_STEM_CACHE_SIZE = 100000
+# tokenizer replaces double quotes with these tokens
+_QUOTE_TOKENS = ("``", "''")
+
+
+# Analyzer turns raw text to terms, one shared stemmer and tokenizer are used for all texts
+class Analyzer(object):
+    def __init__(self, stem_cache_size=DEFAULT_STEM_CACHE_SIZE):
+        self._stemmer = PorterStemmer()
+        self._tokenizer = TreebankWordTokenizer()
+        # bounded LRU memo from surface word to its stem
+        self._cached_stem = lru_cache(maxsize=stem_cache_size)(self._stem)
+
+    def _stem(self, word):
+        return self._stemmer.stem(word).lower()
+
+    # stem of word
+    def stem(self, word):
+        return self._cached_stem(word)
+
+    # hits, misses, size and max size of stems memo
+    def stem_cache_info(self):
+        return self._cached_stem.cache_info()
+
+    # split raw text to tokens
+    def tokenize(self, raw_text):
+        return [token for sent in sent_tokenize(raw_text) for token in self._tokenizer.tokenize(sent)]
+
+    # stem a tokenize raw text
+    def analyze(self, raw_text):
+        # create terms from tokens
+        terms = [Term(token, self.stem(token)) for token in self.tokenize(raw_text)]
+        correct_terms = []
+        # check if term is term we need
+        for term in terms:
+            if not term.is_punctuation() or not term.is_stop_word():
+                correct_terms.append(term)
+        return correct_terms
+
+    # analyze batch of raw texts
+    def analyze_many(self, raw_texts):
+        return [self.analyze(raw_text) for raw_text in raw_texts]
 
 
 # Term object has full word and its stem variables
 class Term(object):
-    def __init__(self, full_word):
+    __slots__ = ("full_word", "stem")
+
+    def __init__(self, full_word, stem=None):
         self.full_word = full_word
-        self.stem = PorterStemmer().stem(full_word).lower()
+        self.stem = stem if stem is not None else default_analyzer.stem(full_word)
 
     def __eq__(self, other):
         return self.stem == other.stem
@@ -34,23 +82,65 @@ class Term(object):
         return self.full_word in _stop_words
 
 
+# find words (tokens of text) in utf-8 encoded text one after another
+# return array of (start, end) byte offsets of words and {position: word} of words not found in text
+def token_offsets(raw_text, words):
+    offsets = array("I")
+    unaligned_words = {}
+    cursor = 0
+    for position, word in enumerate(words):
+        encoded_word = word.encode("utf-8")
+        start = raw_text.find(encoded_word, cursor)
+        # tokenizer changes double quotes
+        if word in _QUOTE_TOKENS:
+            quote_start = raw_text.find(b'"', cursor)
+            if quote_start != -1 and (start == -1 or quote_start < start):
+                start, encoded_word = quote_start, b'"'
+        if start == -1:
+            unaligned_words[position] = word
+            offsets.extend((cursor, cursor))
+            continue
+        cursor = start + len(encoded_word)
+        offsets.extend((start, cursor))
+    return offsets, unaligned_words
+
+
+# analyzer used by indexer and searcher
+default_analyzer = Analyzer()
+
+
 # stem a tokenize raw text
 def stem_and_tokenize_text(raw_query):
-    # get tokens
-    sents = sent_tokenize(raw_query)
-    tokens = list(itertools.chain(*[TreebankWordTokenizer().tokenize(sent) for sent in sents]))
-    # create terms from tokens
-    terms = [Term(token) for token in tokens]
-    correct_terms = []
-    # check if term is term we need
-    for term in terms:
-        if not term.is_punctuation() or not term.is_stop_word():
-            correct_terms.append(term)
-    return correct_terms
+    return default_analyzer.analyze(raw_query)
 
 
 def to_query_terms(raw_query):
-    return stem_and_tokenize_text(raw_query)
+    with metrics.stage("analyze"):
+        return stem_and_tokenize_text(raw_query)
+
+
+# query with its terms and quoted phrases
+class ParsedQuery(object):
+    def __init__(self, terms, phrases):
+        # all terms of query (including terms of phrases)
+        self.terms = terms
+        # phrase is list of (offset in phrase, term) of its indexed terms (stop words only keep offsets of others)
+        self.phrases = phrases
+
+
+# parse query: parts of query in double quotes are phrases (unclosed quote starts phrase till end of query)
+def parse_query(raw_query):
+    terms = []
+    phrases = []
+    with metrics.stage("analyze"):
+        for part_number, part in enumerate(raw_query.split('"')):
+            part_terms = stem_and_tokenize_text(part)
+            terms.extend(part_terms)
+            if part_number % 2 == 1:
+                phrase = [(offset, term) for offset, term in enumerate(part_terms) if not term.is_stop_word()]
+                if phrase:
+                    phrases.append(phrase)
+    return ParsedQuery(terms, phrases)
 
 
 def to_doc_terms(raw_doc):
@@ -0,0 +1,170 @@
+from collections import defaultdict
+import logging
+import os
+import threading
+import time
+
+# process wide metrics of search service:
+# * gauges - name -> last value (always kept, they are set rarely)
+# * counters and stage timers - totals of hot path work (postings bytes read, docs scored, time of each stage),
+#   kept only when instrumentation is enabled with SURFEARCH_METRICS=1, otherwise each call returns at once
+# * request latency histogram and log of slow requests - always kept (one timer per request)
+# Counters and stage times of request are also kept per request, so slow queries are logged with breakdown.
+enabled = os.environ.get("SURFEARCH_METRICS") == "1"
+# requests slower than that are logged, with times of their stages when instrumentation is enabled (0 disables log)
+slow_query_seconds = float(os.environ.get("SURFEARCH_SLOW_QUERY_MS", 500)) / 1000
+# upper bounds of buckets of request latency histogram (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+slow_query_logger = logging.getLogger("surfearch.slow_queries")
+
+_gauges = {}
+_counters = defaultdict(float)
+# stage -> [number of times, total seconds]
+_stages = defaultdict(lambda: [0, 0.0])
+_latency_buckets = [0] * len(LATENCY_BUCKETS)
+_latency_sum = 0.0
+_latency_count = 0
+_lock = threading.Lock()
+# trace of current request of thread (stage times and counters of request)
+_local = threading.local()
+
+
+def enable(value=True):
+    global enabled
+    enabled = value
+
+
+def set_gauge(name, value):
+    _gauges[name] = value
+
+
+def get_gauges():
+    return dict(_gauges)
+
+
+def get_counters():
+    with _lock:
+        return dict(_counters)
+
+
+def increment(name, value=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] += value
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.counters[name] += value
+
+
+# stage of request, time spent in it is added to stage timer:
+#   with metrics.stage("postings"):
+#       ...
+class _Stage(object):
+    __slots__ = ("name", "start_time")
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start_time
+        with _lock:
+            stage_timer = _stages[self.name]
+            stage_timer[0] += 1
+            stage_timer[1] += seconds
+        trace = getattr(_local, "trace", None)
+        if trace is not None:
+            trace.stages[self.name] += seconds
+        return False
+
+
+# stage used when instrumentation is disabled (does nothing)
+class _NoStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    return _Stage(name) if enabled else _NO_STAGE
+
+
+# stage times and counters of one request
+class _RequestTrace(object):
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stages = defaultdict(float)
+        self.counters = defaultdict(float)
+
+
+# start trace of request handled by current thread (its stages and counters are traced only when enabled)
+def start_request():
+    _local.trace = _RequestTrace()
+
+
+# finish trace of request of current thread: its latency is added to histogram, slow request is logged
+# (with stage times and counters of request when instrumentation is enabled)
+def finish_request(description):
+    global _latency_sum, _latency_count
+    trace = getattr(_local, "trace", None)
+    if trace is None:
+        return
+    _local.trace = None
+    seconds = time.perf_counter() - trace.start_time
+    with _lock:
+        _latency_sum += seconds
+        _latency_count += 1
+        for i, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                _latency_buckets[i] += 1
+    if 0 < slow_query_seconds <= seconds:
+        if not enabled:
+            slow_query_logger.warning("slow query %r: %.1f ms", description, seconds * 1000)
+            return
+        slow_query_logger.warning("slow query %r: %.1f ms, stages: %s, counters: %s", description, seconds * 1000,
+                                  ", ".join("{} {:.1f} ms".format(name, stage_seconds * 1000)
+                                            for name, stage_seconds in sorted(trace.stages.items())),
+                                  ", ".join("{} {:g}".format(name, value)
+                                            for name, value in sorted(trace.counters.items())))
+
+
+# all metrics in Prometheus text format
+def render_prometheus(prefix="surfearch_"):
+    lines = []
+    for name, value in sorted(get_gauges().items()):
+        lines.append("# TYPE {}{} gauge".format(prefix, name))
+        lines.append("{}{} {}".format(prefix, name, float(value)))
+    with _lock:
+        counters = sorted(_counters.items())
+        stages = sorted((name, tuple(stage_timer)) for name, stage_timer in _stages.items())
+        latency_buckets = list(_latency_buckets)
+        latency_sum, latency_count = _latency_sum, _latency_count
+    for name, value in counters:
+        lines.append("# TYPE {}{}_total counter".format(prefix, name))
+        lines.append("{}{}_total {}".format(prefix, name, float(value)))
+    if stages:
+        lines.append("# TYPE {}stage_seconds summary".format(prefix))
+        for name, (count, seconds) in stages:
+            lines.append('{}stage_seconds_sum{{stage="{}"}} {}'.format(prefix, name, seconds))
+            lines.append('{}stage_seconds_count{{stage="{}"}} {}'.format(prefix, name, count))
+    if latency_count:
+        lines.append("# TYPE {}request_seconds histogram".format(prefix))
+        for upper_bound, count in zip(LATENCY_BUCKETS, latency_buckets):
+            lines.append('{}request_seconds_bucket{{le="{}"}} {}'.format(prefix, upper_bound, count))
+        lines.append('{}request_seconds_bucket{{le="+Inf"}} {}'.format(prefix, latency_count))
+        lines.append("{}request_seconds_sum {}".format(prefix, latency_sum))
+        lines.append("{}request_seconds_count {}".format(prefix, latency_count))
+    return "\n".join(lines) + "\n"
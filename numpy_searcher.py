@@ -0,0 +1,84 @@
+import threading
+import numpy as np
+import metrics
+from searcher import Searcher, SearchResults, K1, B, PROXIMITY_WEIGHT
+
+
+# Searcher ranking all candidate docs of query at once with array operations instead of doc by doc:
+# posting lists are decoded to arrays of docids and term frequencies, lengths of all docs are kept in memory
+class NumpySearcher(Searcher):
+    def __init__(self, index_dir, IndexesImplementation, proximity_weight=PROXIMITY_WEIGHT, prior_weight=0):
+        super().__init__(index_dir, IndexesImplementation, proximity_weight, prior_weight)
+        # (generation of indexes, lengths of docs, static scores of docs), replaced as a whole
+        self._doc_arrays = (None, None, None)
+        # held by thread loading arrays of changed indexes
+        self._doc_arrays_lock = threading.Lock()
+
+    # lengths and static scores of all docs by docid (loaded again when indexes change, e.g. new segment is added),
+    # threads searching meanwhile keep arrays they have got
+    def _load_doc_arrays(self):
+        if self._doc_arrays[0] != self.indexes.generation():
+            with self._doc_arrays_lock:
+                generation = self.indexes.generation()
+                if self._doc_arrays[0] != generation:
+                    doc_lengths = np.frombuffer(self.indexes.get_doc_lengths(), dtype=np.uint32).astype(np.float64)
+                    # the same floats as static scores of Searcher, so ranks are the same
+                    static_score_array = np.array(self._get_static_scores()[0]) if self.prior_weight else None
+                    self._doc_arrays = (generation, doc_lengths, static_score_array)
+        generation, doc_lengths, static_score_array = self._doc_arrays
+        return doc_lengths, static_score_array
+
+    # candidate docids (sorted) and their bm25 ranks, the same as Searcher._bm25 of each candidate
+    def _rank_candidates(self, query_terms):
+        # columnar posting lists of query terms (duplicate query terms are ranked once, as in Searcher)
+        with metrics.stage("postings"):
+            postings = []
+            for query_term in dict.fromkeys(query_terms):
+                docids, tfs = self.indexes.get_docids_and_tfs(query_term)
+                postings.append((query_term, np.frombuffer(docids, dtype=np.uint32),
+                                 np.frombuffer(tfs, dtype=np.uint32)))
+        # arrays are got after posting lists, so they cover docids of segments added meanwhile
+        doc_lengths, static_score_array = self._load_doc_arrays()
+        total_doc_count = self.indexes.total_doc_count()
+        average_doc_len = self.indexes.average_doc_len()
+        with metrics.stage("score"):
+            candidates = np.unique(np.concatenate([docids for query_term, docids, tfs in postings] +
+                                                  [np.empty(0, np.uint32)]))
+            ranks = np.zeros(len(candidates))
+            for query_term, docids, tfs in postings:
+                if len(docids) == 0:
+                    continue
+                nd_containing = self._document_frequency(query_term, len(docids))
+                # the same formula as bm25_term_rank, docs without query term get 0
+                inverted_document_frequency = np.log((total_doc_count - nd_containing + 0.5) / (nd_containing + 0.5))
+                term_frequency = tfs / doc_lengths[docids]
+                ranks[np.searchsorted(candidates, docids)] += inverted_document_frequency * (
+                        term_frequency * (K1 + 1)) / (
+                        term_frequency + K1 * (1 - B + B * nd_containing / average_doc_len))
+            if self.prior_weight:
+                ranks += static_score_array[candidates]
+        self._count_search(len(candidates), len(candidates))
+        return candidates, ranks
+
+    # first k docs sorted by relevance, docs with the same relevance are sorted by docid (as sort_by_relevance)
+    @staticmethod
+    def _sorted_results(docids, ranks, k, total_doc_num):
+        order = np.lexsort((docids, -ranks))[:k]
+        return SearchResults(list(zip(docids[order].tolist(), ranks[order].tolist())), total_doc_num)
+
+    # bm25 for all docs
+    def find_documents_and_rank_by_bm25(self, query_terms):
+        candidates, ranks = self._rank_candidates(query_terms)
+        return self._sorted_results(candidates, ranks, len(candidates), len(candidates))
+
+    # best k docs by bm25 (partial selection of best ranks instead of sorting all of them)
+    def find_documents_top_k(self, query_terms, k):
+        candidates, ranks = self._rank_candidates(query_terms)
+        total_doc_num = len(candidates)
+        k = max(k, 0)
+        if 0 < k < len(candidates):
+            kth_rank = ranks[np.argpartition(-ranks, k - 1)[k - 1]]
+            # all docs with rank equal to k-th rank are kept, so ties are broken by docid as in sorting
+            best = np.flatnonzero(ranks >= kth_rank)
+            candidates, ranks = candidates[best], ranks[best]
+        return self._sorted_results(candidates, ranks, k, total_doc_num)
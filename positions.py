@@ -0,0 +1,104 @@
+from bisect import bisect_left, bisect_right
+import heapq
+
+# Matching of query terms by sorted docids of their posting lists and by their positions in docs (positions of
+# term in doc are sorted arrays from posting lists). Lists are merged with skips: galloping or binary search
+# jumps over docids and positions which can't match instead of visiting them one by one.
+
+
+# first index >= start of sorted list with value >= target: skips of growing length (1, 2, 4, ...) find range
+# of target, then binary search finds it in range (cheap when target is near, as in merges of similar lists)
+def gallop(values, target, start):
+    bound = 1
+    while start + bound < len(values) and values[start + bound] < target:
+        bound *= 2
+    return bisect_left(values, target, start + bound // 2, min(start + bound + 1, len(values)))
+
+
+# docids which are in all given sorted docid lists, shortest list drives the intersection
+def intersect(docid_lists):
+    if not docid_lists:
+        return []
+    docid_lists = sorted(docid_lists, key=len)
+    cursors = [0] * len(docid_lists)
+    docids = []
+    for docid in docid_lists[0]:
+        for i in range(1, len(docid_lists)):
+            cursors[i] = gallop(docid_lists[i], docid, cursors[i])
+            if cursors[i] == len(docid_lists[i]):
+                return docids
+            if docid_lists[i][cursors[i]] != docid:
+                break
+        else:
+            docids.append(docid)
+    return docids
+
+
+# docids which are in any of given sorted docid lists
+def union(docid_lists):
+    docids = []
+    for docid in heapq.merge(*docid_lists):
+        if not docids or docids[-1] != docid:
+            docids.append(docid)
+    return docids
+
+
+# docids of sorted list which are not in excluded sorted list
+def difference(docids, excluded_docids):
+    cursor = 0
+    result = []
+    for docid in docids:
+        cursor = gallop(excluded_docids, docid, cursor)
+        if cursor == len(excluded_docids) or excluded_docids[cursor] != docid:
+            result.append(docid)
+    return result
+
+
+# start positions of phrase in doc, phrase term with offset i in phrase has to be at start + i
+# position_lists are positions of phrase terms in doc, offsets are offsets of these terms in phrase
+def phrase_starts(position_lists, offsets):
+    # rarest term first, so it proposes fewest starts
+    lists_and_offsets = sorted(zip(position_lists, offsets), key=lambda x: len(x[0]))
+    cursors = [0] * len(lists_and_offsets)
+    starts = []
+    start = 0
+    while True:
+        for i, (positions, offset) in enumerate(lists_and_offsets):
+            cursors[i] = bisect_left(positions, start + offset, cursors[i])
+            if cursors[i] == len(positions):
+                return starts
+            candidate = positions[cursors[i]] - offset
+            # term is not at its place, phrase can't start before its next occurrence
+            if candidate != start:
+                start = candidate
+                break
+        else:
+            starts.append(start)
+            start += 1
+
+
+# smallest window (first position, last position) of doc containing position from each list
+def min_window(position_lists):
+    heap = [(positions[0], i, 0) for i, positions in enumerate(position_lists)]
+    heapq.heapify(heap)
+    window_end = max(position for (position, i, j) in heap)
+    best_window = (heap[0][0], window_end)
+    while True:
+        position, i, j = heapq.heappop(heap)
+        if window_end - position < best_window[1] - best_window[0]:
+            best_window = (position, window_end)
+        positions = position_lists[i]
+        if j + 1 == len(positions):
+            return best_window
+        # positions of list before first position of other lists can't make shorter window except the last of them
+        j = max(j + 1, bisect_right(positions, heap[0][0]) - 1) if heap else j + 1
+        window_end = max(window_end, positions[j])
+        heapq.heappush(heap, (positions[j], i, j))
+
+
+# rank boost of doc where query terms are close to each other: weight for adjacent terms, less for farther ones
+def proximity_boost(position_lists, weight):
+    if len(position_lists) < 2:
+        return 0
+    window_start, window_end = min_window(position_lists)
+    return weight * (len(position_lists) - 1) / (window_end - window_start + 2 - len(position_lists))
@@ -0,0 +1,211 @@
+from array import array
+from bisect import bisect_left
+
+
+# Compact binary posting list format (grouped by docid):
+#   varint(number of docs)
+#   varint(docid delta) * number of docs
+#   varint(term frequency) * number of docs
+#   varint(position delta) * sum of term frequencies (positions of each doc are delta encoded from 0)
+# so docids and term frequencies can be decoded without touching positions
+
+
+# append unsigned int to buffer as varint (7 bits per byte, high bit is set when more bytes follow)
+def encode_varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+# read varint from buffer at given offset, return value and offset after it
+def decode_varint(buf, offset):
+    byte = buf[offset]
+    offset += 1
+    if byte < 0x80:
+        return byte, offset
+    value = byte & 0x7F
+    shift = 7
+    while True:
+        byte = buf[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+# read count varints from buffer, return them in array and offset after them
+def _decode_varints(buf, offset, count):
+    # fast path: small values (most deltas and term frequencies) are single bytes
+    chunk = buf[offset:offset + count]
+    if len(chunk) == count and (not chunk or max(chunk) < 0x80):
+        return array("I", list(chunk)), offset + count
+    values = array("I")
+    for _ in range(count):
+        value, offset = decode_varint(buf, offset)
+        values.append(value)
+    return values, offset
+
+
+# encode posting list given as [(docid, [positions])] sorted by docid
+def encode_postings(postings):
+    out = bytearray()
+    encode_varint(len(postings), out)
+    # docids
+    previous_docid = 0
+    for docid, positions in postings:
+        encode_varint(docid - previous_docid, out)
+        previous_docid = docid
+    # term frequencies
+    for docid, positions in postings:
+        encode_varint(len(positions), out)
+    # positions
+    for docid, positions in postings:
+        previous_position = 0
+        for position in positions:
+            encode_varint(position - previous_position, out)
+            previous_position = position
+    return bytes(out)
+
+
+# bytes which are not the last byte of varint
+_CONTINUATION_BYTES = bytes(range(0x80, 0x100))
+# number of docids decoded at once when only first docids of posting list are needed
+DOCIDS_BLOCK_SIZE = 128
+
+
+# offset after count varints of buffer starting at offset (varints are counted by their last bytes, not decoded)
+def _skip_varints(buf, offset, count):
+    while count > 0:
+        chunk = bytes(buf[offset:offset + count])
+        if not chunk:
+            raise ValueError("posting list is truncated")
+        count -= len(chunk.translate(None, _CONTINUATION_BYTES))
+        offset += len(chunk)
+    return offset
+
+
+# number of docs of encoded posting list
+def posting_list_docs_num(buf):
+    return decode_varint(buf, 0)[0] if buf else 0
+
+
+# sorted docids of posting list decoded block by block (DOCIDS_BLOCK_SIZE docids in each array),
+# so rest of list is never decoded when its first docids are enough
+def iter_docid_blocks(buf):
+    if not buf:
+        return
+    docs_num, offset = decode_varint(buf, 0)
+    docid = 0
+    for block_start in range(0, docs_num, DOCIDS_BLOCK_SIZE):
+        block, offset = _decode_varints(buf, offset, min(DOCIDS_BLOCK_SIZE, docs_num - block_start))
+        # restore docids from deltas
+        for i in range(len(block)):
+            docid += block[i]
+            block[i] = docid
+        yield block
+
+
+# decode only docids and term frequencies of posting list
+def decode_docids_and_tfs(buf):
+    if not buf:
+        return array("I"), array("I")
+    docs_num, offset = decode_varint(buf, 0)
+    docids, offset = _decode_varints(buf, offset, docs_num)
+    # restore docids from deltas
+    docid = 0
+    for i in range(docs_num):
+        docid += docids[i]
+        docids[i] = docid
+    tfs, offset = _decode_varints(buf, offset, docs_num)
+    return docids, tfs
+
+
+# decode whole posting list to [(docid, positions)]
+def decode_postings(buf):
+    if not buf:
+        return []
+    docs_num, offset = decode_varint(buf, 0)
+    docids, offset = _decode_varints(buf, offset, docs_num)
+    tfs, offset = _decode_varints(buf, offset, docs_num)
+    postings = []
+    docid = 0
+    for i in range(docs_num):
+        docid += docids[i]
+        positions, offset = _decode_varints(buf, offset, tfs[i])
+        # restore positions from deltas
+        position = 0
+        for j in range(len(positions)):
+            position += positions[j]
+            positions[j] = position
+        postings.append((docid, positions))
+    return postings
+
+
+# decode positions of given docs only: {docid: positions} of docs of sorted docids which are in posting list,
+# docids of list are decoded up to the last given docid and positions of other docs are skipped
+def decode_positions(buf, docids):
+    positions_of_docs = {}
+    if not buf or not docids:
+        return positions_of_docs
+    docs_num, docids_offset = decode_varint(buf, 0)
+    list_docids = array("I")
+    for block in iter_docid_blocks(buf):
+        list_docids.extend(block)
+        if block[-1] >= docids[-1]:
+            break
+    # indexes of given docs in posting list
+    indexes = []
+    for docid in docids:
+        index = bisect_left(list_docids, docid)
+        if index < len(list_docids) and list_docids[index] == docid:
+            indexes.append(index)
+    if not indexes:
+        return positions_of_docs
+    tfs_offset = _skip_varints(buf, docids_offset, docs_num)
+    tfs, _ = _decode_varints(buf, tfs_offset, indexes[-1] + 1)
+    offset = _skip_varints(buf, tfs_offset, docs_num)
+    # positions of docs before index are skipped
+    index = 0
+    for doc_index in indexes:
+        offset = _skip_varints(buf, offset, sum(tfs[index:doc_index]))
+        positions, offset = _decode_varints(buf, offset, tfs[doc_index])
+        # restore positions from deltas
+        position = 0
+        for j in range(len(positions)):
+            position += positions[j]
+            positions[j] = position
+        positions_of_docs[list_docids[doc_index]] = positions
+        index = doc_index + 1
+    return positions_of_docs
+
+
+# group posting list of (position, docid) occurrences by docid
+def group_occurrences(occurrences):
+    postings = []
+    for position, docid in occurrences:
+        if not postings or postings[-1][0] != docid:
+            postings.append((docid, array("I")))
+        postings[-1][1].append(position)
+    return postings
+
+
+# number of distinct docs and max ratio of term frequency to doc length in posting list
+# of (position, docid) occurrences sorted by docid, doc_lengths is indexed by docid
+def term_stats(occurrences, doc_lengths):
+    docs_num = 0
+    max_tf_ratio = 0
+    previous_docid = None
+    tf = 0
+    for position, docid in occurrences:
+        if docid != previous_docid:
+            if previous_docid is not None:
+                max_tf_ratio = max(max_tf_ratio, tf / doc_lengths[previous_docid])
+            docs_num += 1
+            previous_docid = docid
+            tf = 0
+        tf += 1
+    if previous_docid is not None:
+        max_tf_ratio = max(max_tf_ratio, tf / doc_lengths[previous_docid])
+    return docs_num, max_tf_ratio
@@ -0,0 +1,249 @@
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+from collections import OrderedDict
+import metrics
+
+# default max size of files of cache shared by processes (see FileCacheBackend)
+DEFAULT_FILE_CACHE_MB = 256
+# each process sweeps directory of shared cache at most once per that many seconds
+FILE_CACHE_SWEEP_SECONDS = 60
+
+
+# approximate memory used by search results (tuples of docids and relevances)
+def search_results_size(search_results):
+    docs_num = len(search_results.docids)
+    return sys.getsizeof(search_results) + 2 * sys.getsizeof(tuple()) + docs_num * (2 * 8 + 28 + 24)
+
+
+# process local cache with least recently used eviction and time to live of entries
+# max_bytes - (optional) entries are also evicted when their total size is larger
+class LRUCache(object):
+    def __init__(self, max_entries, ttl_seconds, size_of=sys.getsizeof, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._size_of = size_of
+        # key -> (time of put, size, value)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.memory_bytes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key, value):
+        size = self._size_of(value)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), size, value)
+            self.memory_bytes += size
+            # evict least recently used entries
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and
+                                                            self.memory_bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    # whether key is cached (recency of entry and hit statistics are not changed)
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.memory_bytes = 0
+
+    def _remove(self, key):
+        put_time, size, value = self._entries.pop(key)
+        self.memory_bytes -= size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# remove file which can be already removed by other process
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# cache shared by all processes on machine (e.g. gunicorn workers): one pickle file per entry in directory
+# expired entries are removed by sweeps, the oldest entries are also removed while files take more than max_bytes
+class FileCacheBackend(object):
+    def __init__(self, cache_dir, ttl_seconds, max_bytes=DEFAULT_FILE_CACHE_MB * 2 ** 20):
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._next_sweep_time = 0
+        self._sweep_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(repr(key).encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+            with open(path, "rb") as entry_file:
+                entry_key, value = pickle.load(entry_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # different key with the same hash
+        if entry_key != key:
+            return None
+        return value
+
+    # entry is not cached when it can't be written (e.g. disk is full), search does not fail because of cache
+    def put(self, key, value):
+        path = self._path(key)
+        # write to temporary file and rename it, so other processes never read half written entry
+        temporary_path = "{}.{}.{}".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(temporary_path, "wb") as entry_file:
+                pickle.dump((key, value), entry_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, path)
+        except OSError:
+            _remove_file(temporary_path)
+        self._sweep_if_needed()
+
+    def _sweep_if_needed(self):
+        if time.monotonic() < self._next_sweep_time or not self._sweep_lock.acquire(blocking=False):
+            return
+        try:
+            self._next_sweep_time = time.monotonic() + FILE_CACHE_SWEEP_SECONDS
+            self.sweep()
+        finally:
+            self._sweep_lock.release()
+
+    # remove expired entries (and temporary files left by interrupted writes), then the oldest entries until files
+    # of cache take at most max_bytes
+    def sweep(self):
+        now = time.time()
+        entries = []
+        try:
+            filenames = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for filename in filenames:
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.ttl_seconds:
+                _remove_file(path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        cache_bytes = sum(size for (mtime, size, path) in entries)
+        for mtime, size, path in sorted(entries):
+            if cache_bytes <= self.max_bytes:
+                break
+            _remove_file(path)
+            cache_bytes -= size
+
+
+# cache of ranked search results in front of Searcher
+# results are cached by stems of query terms and generation of index (new index never gets old results)
+class QueryCache(object):
+    # min_k - at least that many best docs are searched on miss, so next pages are served from cache
+    def __init__(self, searcher, max_entries=1000, ttl_seconds=600, shared_backend=None, min_k=250):
+        self.searcher = searcher
+        self.min_k = min_k
+        self.local_cache = LRUCache(max_entries, ttl_seconds, search_results_size)
+        self.shared_backend = shared_backend
+        self._generation = None
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    # normalized query terms: unique and sorted by stem (results do not depend on order of words in query)
+    @staticmethod
+    def normalize_query_terms(query_terms):
+        return sorted({query_term.stem: query_term for query_term in query_terms}.values(),
+                      key=lambda query_term: query_term.stem)
+
+    # best k docs by bm25, the same as Searcher.find_documents_top_k
+    # searcher (the cache's one by default) is used on miss, e.g. searcher of batch of queries sharing posting lists
+    def find_documents_top_k(self, query_terms, k, searcher=None):
+        searcher = searcher or self.searcher
+        query_terms = self.normalize_query_terms(query_terms)
+        return self._find_documents(tuple(query_term.stem for query_term in query_terms),
+                                    lambda searched_k: searcher.find_documents_top_k(query_terms, searched_k), k)
+
+    # best k docs of parsed query, the same as Searcher.find_documents_by_query
+    def find_documents_by_query(self, parsed_query, k, searcher=None):
+        searcher = searcher or self.searcher
+        query_terms = self.normalize_query_terms(parsed_query.terms)
+        phrases = tuple(tuple((offset, term.stem) for (offset, term) in phrase) for phrase in parsed_query.phrases)
+        return self._find_documents(("query", tuple(query_term.stem for query_term in query_terms), phrases),
+                                    lambda searched_k: searcher.find_documents_by_query(parsed_query, searched_k), k)
+
+    # best k docs matching boolean query, the same as Searcher.find_documents_by_boolean_query
+    def find_documents_by_boolean_query(self, boolean_query, k, searcher=None):
+        searcher = searcher or self.searcher
+        return self._find_documents(("boolean", boolean_query.key() if boolean_query is not None else None),
+                                    lambda searched_k: searcher.find_documents_by_boolean_query(boolean_query,
+                                                                                                searched_k), k)
+
+    # cached results of search or results of search(searched_k) of at least k docs
+    def _find_documents(self, query_key, search, k):
+        generation = self.searcher.indexes.generation()
+        # index has changed, all cached results are old
+        if generation != self._generation:
+            self.local_cache.clear()
+            self._generation = generation
+        key = (generation, query_key)
+        search_results = self.local_cache.get(key)
+        if search_results is None and self.shared_backend is not None:
+            search_results = self.shared_backend.get(key)
+            if search_results is not None:
+                self.shared_hits += 1
+                self.local_cache.put(key, search_results)
+        searched_k = max(k, self.min_k)
+        # cached results have less than k best docs (deeper page is requested), search twice as many
+        if search_results is not None and len(search_results.docids) < min(k, search_results.total_doc_num()):
+            searched_k = max(k, 2 * len(search_results.docids))
+            search_results = None
+        if search_results is None:
+            self.misses += 1
+            search_results = search(searched_k)
+            self.local_cache.put(key, search_results)
+            if self.shared_backend is not None:
+                self.shared_backend.put(key, search_results)
+        else:
+            self.hits += 1
+        self._update_metrics()
+        return search_results
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0,
+                "entries": len(self.local_cache),
+                "memory_bytes": self.local_cache.memory_bytes}
+
+    def _update_metrics(self):
+        for name, value in self.stats().items():
+            metrics.set_gauge("query_cache_" + name, value)
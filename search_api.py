@@ -0,0 +1,172 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from aiohttp import web
+import metrics
+from search_service import SearchService, AnalyzedQuery, suggestions_json, DEFAULT_SUGGESTIONS
+
+# JSON search API served by aiohttp: searches run in pool of threads, so event loop keeps accepting requests
+# while slow queries are searched
+#   GET /api/search?q=<query>&limit=<n>&cursor=<cursor> - page of results and cursor of next page
+#   POST /api/batch {"queries": [...], "limit": <n>} - first pages of many queries, query terms are analyzed
+#                                                      and posting lists are fetched once for all of them
+#   GET /api/autocomplete?q=<query>&limit=<n> - indexed terms completing (or correcting) last word of query
+#   GET /metrics - metrics in Prometheus text format
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+MAX_BATCH_QUERIES = 100
+DEFAULT_THREADS = 4
+
+
+# cursor of next page: generation of index and offset of page in results
+def encode_cursor(generation, offset):
+    return base64.urlsafe_b64encode(json.dumps([generation, offset]).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        generation, offset = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+    if not isinstance(offset, int) or offset < 0:
+        raise ValueError("invalid cursor")
+    return generation, offset
+
+
+def _json_error(HTTPException, message):
+    return HTTPException(text=json.dumps({"error": message}), content_type="application/json")
+
+
+def _parse_limit(limit):
+    try:
+        limit = int(limit)
+    except (ValueError, TypeError):
+        raise _json_error(web.HTTPBadRequest, "limit has to be integer")
+    if not 0 < limit <= MAX_LIMIT:
+        raise _json_error(web.HTTPBadRequest, "limit has to be between 1 and {}".format(MAX_LIMIT))
+    return limit
+
+
+class SearchApi(object):
+    def __init__(self, search_service, threads=DEFAULT_THREADS):
+        self.search_service = search_service
+        self.executor = ThreadPoolExecutor(threads)
+
+    # page of results of analyzed query starting at offset (searcher of batch is used for batch of queries)
+    def _page(self, analyzed_query, offset, limit, searcher=None):
+        search_results = self.search_service.search(analyzed_query, offset + limit, searcher)
+        docids = search_results.docids[offset:offset + limit]
+        scores = search_results.relevances[offset:offset + limit]
+        snippets = self.search_service.snippet_generator.get_snippets(analyzed_query.terms, docids, searcher)
+        # docs of next page are probably requested soon
+        self.search_service.prefetch_documents(search_results.docids[offset + limit:offset + 2 * limit])
+        next_offset = offset + len(docids)
+        generation = self.search_service.searcher.indexes.generation()
+        return {"query": analyzed_query.raw_query,
+                "total": search_results.total_doc_num(),
+                "results": [{"docid": docid,
+                             "score": score,
+                             "title": snippet.title,
+                             "url": snippet.url,
+                             # list of [word, is query term]
+                             "snippet": snippet.snippet}
+                            for docid, score, snippet in zip(docids, scores, snippets)],
+                "next_cursor": encode_cursor(generation, next_offset)
+                if docids and next_offset < search_results.total_doc_num() else None}
+
+    # page of results of query (run in thread of pool)
+    def search(self, raw_query, cursor, limit):
+        metrics.start_request()
+        try:
+            self.search_service.reload_if_changed()
+            offset = 0
+            if cursor:
+                try:
+                    generation, offset = decode_cursor(cursor)
+                except ValueError as error:
+                    raise _json_error(web.HTTPBadRequest, str(error))
+                # results of changed index are different, pages of old results can't be continued
+                if generation != self.search_service.searcher.indexes.generation():
+                    raise _json_error(web.HTTPGone, "cursor expired, index has changed")
+            return self._page(AnalyzedQuery(raw_query), offset, limit)
+        finally:
+            metrics.finish_request(raw_query)
+
+    # first pages of results of queries (run in thread of pool)
+    def search_batch(self, raw_queries, limit):
+        metrics.start_request()
+        try:
+            self.search_service.reload_if_changed()
+            # the same queries of batch are analyzed once, posting lists of terms are fetched once for all queries
+            analyzed_queries = {raw_query: AnalyzedQuery(raw_query) for raw_query in raw_queries}
+            searcher = self.search_service.batch_searcher()
+            return {"results": [self._page(analyzed_queries[raw_query], 0, limit, searcher)
+                                for raw_query in raw_queries]}
+        finally:
+            metrics.finish_request("batch of {} queries".format(len(raw_queries)))
+
+    # suggestions for last word of query typed so far (run in thread of pool)
+    def autocomplete(self, raw_query, limit):
+        self.search_service.reload_if_changed()
+        return suggestions_json(raw_query, self.search_service.autocomplete(raw_query, limit))
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def handle_search(self, request):
+        raw_query = request.query.get("q", "")
+        if not raw_query.strip():
+            raise _json_error(web.HTTPBadRequest, "query is empty")
+        limit = _parse_limit(request.query.get("limit", DEFAULT_LIMIT))
+        return web.json_response(await self._run(self.search, raw_query, request.query.get("cursor"), limit))
+
+    async def handle_batch(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise _json_error(web.HTTPBadRequest, "body has to be JSON")
+        raw_queries = body.get("queries") if isinstance(body, dict) else None
+        if not isinstance(raw_queries, list) or not all(isinstance(raw_query, str) for raw_query in raw_queries):
+            raise _json_error(web.HTTPBadRequest, "queries has to be list of strings")
+        if len(raw_queries) > MAX_BATCH_QUERIES:
+            raise _json_error(web.HTTPBadRequest, "at most {} queries in batch".format(MAX_BATCH_QUERIES))
+        limit = _parse_limit(body.get("limit", DEFAULT_LIMIT))
+        return web.json_response(await self._run(self.search_batch, raw_queries, limit))
+
+    async def handle_autocomplete(self, request):
+        limit = _parse_limit(request.query.get("limit", DEFAULT_SUGGESTIONS))
+        return web.json_response(await self._run(self.autocomplete, request.query.get("q", ""), limit))
+
+    async def handle_metrics(self, request):
+        self.search_service.collect_metrics()
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain")
+
+
+def create_app(index_dir="indexes", threads=DEFAULT_THREADS):
+    search_api = SearchApi(SearchService(index_dir), threads)
+    app = web.Application()
+    app.add_routes([web.get("/api/search", search_api.handle_search),
+                    web.post("/api/batch", search_api.handle_batch),
+                    web.get("/api/autocomplete", search_api.handle_autocomplete),
+                    web.get("/metrics", search_api.handle_metrics)])
+    return app
+
+
+def main():
+    # get arguments
+    parser = argparse.ArgumentParser(description="Surfearch JSON search API")
+    parser.add_argument("--index_dir", dest="index_dir", default="indexes", help="Index directory")
+    parser.add_argument("--host", dest="host", default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", dest="port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("--threads", dest="threads", type=int,
+                        default=int(os.environ.get("SURFEARCH_API_THREADS", DEFAULT_THREADS)),
+                        help="Number of threads searching queries")
+    args = parser.parse_args()
+    web.run_app(create_app(args.index_dir, args.threads), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+import copy
+import os.path
+import string
+from indexer import ShelveIndexes
+from segment import SegmentIndexes, BackgroundMerger, DEFAULT_MAX_SEGMENTS
+from shards import ShardedSearcher, ShardedSnippetGenerator, shards_dir
+from searcher import Searcher
+from snippets import SnippetGenerator
+from query_cache import QueryCache, FileCacheBackend, DEFAULT_FILE_CACHE_MB
+from document_cache import DocumentCache
+from lang_proc import parse_query, default_analyzer
+from boolean_query import is_boolean_query, parse_boolean_query
+import metrics
+from term_lookup import default_max_edits
+
+# default number of suggestions of autocomplete
+DEFAULT_SUGGESTIONS = 10
+
+
+# indexes of batch of queries: posting lists of each term are fetched (and decoded) once for all queries of batch,
+# other calls go to indexes
+class _BatchPostingsIndexes(object):
+    def __init__(self, indexes):
+        self._indexes = indexes
+        self._document_ids = {}
+        self._postings = {}
+        self._positions = {}
+        self._docids_and_tfs = {}
+
+    def __getattr__(self, name):
+        return getattr(self._indexes, name)
+
+    def get_document_ids(self, query_term):
+        if query_term.stem not in self._document_ids:
+            self._document_ids[query_term.stem] = self._indexes.get_document_ids(query_term)
+        return self._document_ids[query_term.stem]
+
+    def get_postings(self, query_term):
+        if query_term.stem not in self._postings:
+            self._postings[query_term.stem] = self._indexes.get_postings(query_term)
+        return self._postings[query_term.stem]
+
+    # positions in docs of batch (reranked docs and snippets of each query) are served from posting list decoded
+    # whole once, so queries sharing term read it once instead of once per query
+    def get_positions(self, query_term, docids):
+        if query_term.stem not in self._positions:
+            self._positions[query_term.stem] = dict(self.get_postings(query_term))
+        positions_of_docs = self._positions[query_term.stem]
+        return {docid: positions_of_docs[docid] for docid in docids if docid in positions_of_docs}
+
+    # posting lists fetched by any query of batch are decoded whole, so they are shared
+    def get_docid_blocks(self, query_term):
+        docids = self.get_document_ids(query_term)
+        return len(docids), iter([docids])
+
+    def get_docids_and_tfs(self, query_term):
+        if query_term.stem not in self._docids_and_tfs:
+            self._docids_and_tfs[query_term.stem] = self._indexes.get_docids_and_tfs(query_term)
+        return self._docids_and_tfs[query_term.stem]
+
+
+# analyzed raw query: parsed terms and phrases or boolean query, and terms used for snippets
+class AnalyzedQuery(object):
+    def __init__(self, raw_query):
+        self.raw_query = raw_query
+        if is_boolean_query(raw_query):
+            # query with AND, OR, NOT operators or brackets
+            self.boolean_query = parse_boolean_query(raw_query)
+            self.parsed_query = None
+            self.terms = self.boolean_query.positive_terms() if self.boolean_query is not None else []
+        else:
+            # terms and quoted phrases of query
+            self.boolean_query = None
+            self.parsed_query = parse_query(raw_query)
+            self.terms = self.parsed_query.terms
+
+
+# JSON of suggestions of autocomplete (see SearchService.autocomplete)
+def suggestions_json(raw_query, suggestions):
+    return {"query": raw_query,
+            "suggestions": [{"term": word, "stem": stem, "document_frequency": document_frequency,
+                             "distance": distance}
+                            for word, stem, document_frequency, distance in suggestions]}
+
+
+# search service used by web ui and JSON API: searcher over indexes of index_dir, cache of results and snippets
+# (configured with environment variables, see README)
+class SearchService(object):
+    def __init__(self, index_dir="indexes"):
+        # SURFEARCH_SCORING=numpy ranks all candidate docs at once with NumPy arrays
+        if os.environ.get("SURFEARCH_SCORING") == "numpy":
+            from numpy_searcher import NumpySearcher as SearcherImplementation
+        else:
+            SearcherImplementation = Searcher
+        query_cache_ttl_seconds = int(os.environ.get("SURFEARCH_QUERY_CACHE_TTL", 600))
+        # SURFEARCH_PRIOR_WEIGHT blends popularity prior of docs (by their reddit score) with bm25
+        prior_weight = float(os.environ.get("SURFEARCH_PRIOR_WEIGHT", 0))
+        # sharded index is searched by shard worker processes
+        if os.path.exists(shards_dir(index_dir)):
+            self.searcher = ShardedSearcher(index_dir, prior_weight)
+        # use memory mapped segments if indexer wrote them (their pages are shared by all workers)
+        elif os.path.exists(SegmentIndexes.segments_dir(index_dir)):
+            self.searcher = SearcherImplementation(index_dir, SegmentIndexes, prior_weight=prior_weight)
+            # keep number of segments added by incremental indexing bounded
+            # (SURFEARCH_MERGE_INTERVAL=0 disables merges)
+            merge_interval_seconds = int(os.environ.get("SURFEARCH_MERGE_INTERVAL", 60))
+            if merge_interval_seconds > 0:
+                BackgroundMerger(SegmentIndexes.segments_dir(index_dir), merge_interval_seconds,
+                                 int(os.environ.get("SURFEARCH_MAX_SEGMENTS", DEFAULT_MAX_SEGMENTS))).start()
+        else:
+            self.searcher = SearcherImplementation(index_dir, ShelveIndexes, prior_weight=prior_weight)
+        # decoded docs shown on result pages, SURFEARCH_DOCUMENT_CACHE_MB enables cache of them
+        # (docs of sharded index are read by shard worker processes)
+        document_cache_mb = float(os.environ.get("SURFEARCH_DOCUMENT_CACHE_MB", 0))
+        self.document_cache = None
+        if document_cache_mb > 0 and not isinstance(self.searcher, ShardedSearcher):
+            self.document_cache = DocumentCache(self.searcher.indexes, int(document_cache_mb * 2 ** 20))
+            self.searcher.indexes = self.document_cache
+        # cache of ranked results, SURFEARCH_QUERY_CACHE_DIR makes it shared by all workers on machine
+        self.query_cache = QueryCache(self.searcher, int(os.environ.get("SURFEARCH_QUERY_CACHE_SIZE", 1000)),
+                                      query_cache_ttl_seconds,
+                                      FileCacheBackend(os.environ["SURFEARCH_QUERY_CACHE_DIR"], query_cache_ttl_seconds,
+                                                       int(float(os.environ.get("SURFEARCH_QUERY_CACHE_DIR_MB",
+                                                                                DEFAULT_FILE_CACHE_MB)) * 2 ** 20))
+                                      if os.environ.get("SURFEARCH_QUERY_CACHE_DIR") else None)
+        # snippets of results, SURFEARCH_SNIPPET_CACHE_SIZE enables cache of them
+        if isinstance(self.searcher, ShardedSearcher):
+            self.snippet_generator = ShardedSnippetGenerator(self.searcher)
+        else:
+            self.snippet_generator = SnippetGenerator(self.searcher,
+                                                      int(os.environ.get("SURFEARCH_SNIPPET_CACHE_SIZE", 0)),
+                                                      query_cache_ttl_seconds)
+
+    # best k docs of analyzed query (searcher is used when results are not cached)
+    def search(self, analyzed_query, k, searcher=None):
+        if analyzed_query.parsed_query is not None:
+            return self.query_cache.find_documents_by_query(analyzed_query.parsed_query, k, searcher)
+        return self.query_cache.find_documents_by_boolean_query(analyzed_query.boolean_query, k, searcher)
+
+    # suggestions for last (partially typed) word of raw query:
+    # [(the most frequent word of stem, stem, number of docs containing it, edit distance)]
+    # indexed stems starting with the word or its stem (distance 0), the most frequent first, then stems within
+    # edit distance of the word (typos) when there are fewer than limit of them
+    def autocomplete(self, raw_query, limit=DEFAULT_SUGGESTIONS):
+        words = raw_query.split()
+        # the last word is complete when it is followed by space
+        if not words or raw_query[-1].isspace():
+            return []
+        word = words[-1].strip(string.punctuation).lower()
+        if not word:
+            return []
+        stem = default_analyzer.stem(word)
+        completions = dict(self.searcher.expand_prefix(word, limit))
+        if stem != word:
+            completions.update(self.searcher.expand_prefix(stem, limit))
+        suggestions = [(term, document_frequency, 0) for term, document_frequency in
+                       sorted(completions.items(), key=lambda completion: (-completion[1], completion[0]))[:limit]]
+        if len(suggestions) < limit:
+            suggestions.extend([suggestion for suggestion in
+                                self.searcher.expand_fuzzy(stem, default_max_edits(stem), limit + len(completions))
+                                if suggestion[0] not in completions][:limit - len(suggestions)])
+        # stems are not words (e.g. "comput"), users see the most frequent word of each of them
+        surface_forms = self.searcher.surface_forms([stem for stem, document_frequency, distance in suggestions])
+        return [(surface_forms[stem], stem, document_frequency, distance)
+                for stem, document_frequency, distance in suggestions]
+
+    # load docs of next page of results to document cache in background
+    def prefetch_documents(self, docids):
+        if self.document_cache is not None and len(docids) > 0:
+            self.document_cache.prefetch(docids)
+
+    # searcher of batch of queries sharing posting lists fetched by any of them
+    def batch_searcher(self):
+        searcher = copy.copy(self.searcher)
+        searcher.indexes = _BatchPostingsIndexes(self.searcher.indexes)
+        return searcher
+
+    # see segments added or merged since last query
+    def reload_if_changed(self):
+        return self.searcher.indexes.reload_if_changed()
+
+    # update gauges of caches which are not updated on each lookup
+    def collect_metrics(self):
+        stem_cache_info = default_analyzer.stem_cache_info()
+        metrics.set_gauge("stem_cache_hits", stem_cache_info.hits)
+        metrics.set_gauge("stem_cache_misses", stem_cache_info.misses)
+        if self.snippet_generator.cache is not None:
+            metrics.set_gauge("snippet_cache_hits", self.snippet_generator.cache.hits)
+            metrics.set_gauge("snippet_cache_misses", self.snippet_generator.cache.misses)
+        if self.document_cache is not None:
+            for name, value in self.document_cache.stats().items():
+                metrics.set_gauge("document_cache_" + name, value)
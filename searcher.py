@@ -1,7 +1,19 @@
+from bisect import bisect_left
+import heapq
+import itertools
 import math
+import time
+import metrics
+import term_lookup
+from positions import intersect, phrase_starts, min_window, proximity_boost
 
-# used for old ranking functions based on reddit score
-# from collections import defaultdict
+# bm25 parameters
+K1 = 1.5
+B = 0.75
+# proximity boost of doc where all found query terms are adjacent (see positions.proximity_boost)
+PROXIMITY_WEIGHT = 0.5
+# number of best docs by bm25 which are reordered with proximity boost
+RERANK_DEPTH = 100
 
 # class to store data about pages
 class SerpPagination(object):
@@ -25,11 +37,53 @@ class SerpPagination(object):
         return result
 
 
+# bm25 rank of query term in doc
+# * term_frequency - frequency of query term in doc divided by doc length
+# * nd_containing - how many docs containing given query term
+def bm25_term_rank(term_frequency, nd_containing, total_doc_count, average_doc_len):
+    # calculate IDF
+    inverted_document_frequency = math.log((total_doc_count - nd_containing + 0.5) / (nd_containing + 0.5))
+    # calculate rank with given k1 and b
+    return inverted_document_frequency * (term_frequency * (K1 + 1)) / (term_frequency + K1 * (
+            1 - B + B * nd_containing / average_doc_len))
+
+
+# sort (docid, relevance) by relevance, docs with the same relevance are sorted by docid
+def sort_by_relevance(docids_and_relevance):
+    return sorted(docids_and_relevance, key=lambda x: (-x[1], x[0]))
+
+
+# cursor over sorted docids of query term (used for dynamic pruning), docids are read block by block
+# (see indexes get_docid_blocks), so blocks after the last visited docid are never decoded
+class _PostingCursor(object):
+    def __init__(self, docid_blocks, upper_bound):
+        self._docid_blocks = docid_blocks
+        self.upper_bound = upper_bound
+        # current block of docids
+        self.docids = next(docid_blocks, [])
+        self.position = 0
+
+    def docid(self):
+        return self.docids[self.position]
+
+    def exhausted(self):
+        return self.position == len(self.docids)
+
+    # move to first docid >= target (blocks which end before target are not searched)
+    def advance_to(self, target):
+        while self.docids and self.docids[-1] < target:
+            self.docids = next(self._docid_blocks, [])
+            self.position = 0
+        self.position = bisect_left(self.docids, target, self.position)
+
+
 # class to store search results
 class SearchResults:
     # store docids and its relevances according to bm25
-    def __init__(self, docids):
+    # total_doc_num is number of all found docs when only best of them are stored
+    def __init__(self, docids, total_doc_num=None):
         self.docids, self.relevances = zip(*docids) if docids else ([], [])
+        self._total_doc_num = len(self.docids) if total_doc_num is None else total_doc_num
 
     # paging
     def get_page(self, page, page_size):
@@ -37,90 +91,330 @@ class SearchResults:
         return self.docids[start_num:start_num + page_size]
 
     def get_pagination(self, page, page_size):
-        return SerpPagination(page, page_size, len(self.docids))
+        return SerpPagination(page, page_size, self._total_doc_num)
 
     def total_doc_num(self):
-        return len(self.docids)
+        return self._total_doc_num
 
 
 # Searcher
 class Searcher(object):
-    def __init__(self, index_dir, IndexesImplementation):
+    def __init__(self, index_dir, IndexesImplementation, proximity_weight=PROXIMITY_WEIGHT, prior_weight=0):
+        start_time = time.perf_counter()  # used for time statistics
+        self.proximity_weight = proximity_weight
+        # weight of popularity prior of doc (see document.popularity_prior) added to its bm25 rank,
+        # 0 ranks docs by relevance only
+        self.prior_weight = prior_weight
+        # (generation of indexes, static scores of docs, their bounds) see _get_static_scores
+        self._static_scores = (None, None, None)
         self.indexes = IndexesImplementation()
         self.indexes.load_from_disk(index_dir)
+        self.startup_seconds = time.perf_counter() - start_time
+        metrics.set_gauge("searcher_startup_seconds", self.startup_seconds)
 
     # bm 25 ranking for given doc and query terms
     def _bm25(self, docid, query_terms_to_posting_lists_sizes):
         # initial rank
         rank = 0
-        # get text by docid
-        text = self.indexes.get_document_text(docid)
-        # get len of all text
-        text_len = len(text)
+        # get len of text and term frequencies by docid (precomputed by indexer)
+        text_len, term_frequencies = self.indexes.get_document_stats(docid)
         # * qt - query term
         # * nd_containing - how many docs containing given query term
         for qt, nd_containing in query_terms_to_posting_lists_sizes.items():
             # find how many times qt appeared in doc
-            count_of_qt_in_doc = 0
-            for term in text:
-                if term == qt:
-                    count_of_qt_in_doc += 1
+            count_of_qt_in_doc = term_frequencies.get(qt.stem, 0)
             # compute term frequency in doc
             term_frequency = count_of_qt_in_doc / text_len
-            # calculate IDF
-            inverted_document_frequency = math.log(
-                (self.indexes.total_doc_count() - nd_containing + 0.5) / (nd_containing + 0.5))
-            # calculate rank with given k1 and b below:
-            k1 = 1.5
-            b = 0.75
-            rank += inverted_document_frequency * (term_frequency * (k1 + 1)) / (term_frequency + k1 * (
-                    1 - b + b * query_terms_to_posting_lists_sizes[qt] / self.indexes.average_doc_len()))
+            rank += bm25_term_rank(term_frequency, nd_containing, self.indexes.total_doc_count(),
+                                   self.indexes.average_doc_len())
         return rank
 
+    # static scores of docs by docid (weighted popularity priors) and their bounds: bound of docid is max static score
+    # of docs with docid >= docid (it decreases quickly in segments ordered by prior, so top k search stops early)
+    def _get_static_scores(self):
+        generation, static_scores, static_score_bounds = self._static_scores
+        if generation != self.indexes.generation():
+            generation = self.indexes.generation()
+            static_scores = [self.prior_weight * prior for prior in self.indexes.get_static_priors()]
+            static_score_bounds = list(itertools.accumulate(reversed(static_scores), max))[::-1]
+            self._static_scores = (generation, static_scores, static_score_bounds)
+        return static_scores, static_score_bounds
+
+    # static score of doc added to its bm25 rank
+    def _static_score(self, docid):
+        if not self.prior_weight:
+            return 0
+        static_scores, static_score_bounds = self._get_static_scores()
+        return static_scores[docid]
+
+    # docids of each query term and how many docs containing it
+    def _get_query_terms_docids(self, query_terms):
+        query_terms_to_docids = dict()
+        query_terms_to_posting_lists_sizes = dict()
+        with metrics.stage("postings"):
+            for query_term in query_terms:
+                # documents containing query term
+                query_terms_to_docids[query_term] = self.indexes.get_document_ids(query_term)
+                # how many documents containing query term
+                query_terms_to_posting_lists_sizes[query_term] = self._document_frequency(
+                    query_term, len(query_terms_to_docids[query_term]))
+        return query_terms_to_docids, query_terms_to_posting_lists_sizes
+
+    # how many docs of collection containing query term (number of docs of its posting list is given)
+    # searcher of shard uses frequency in whole collection instead (see shards.py)
+    def _document_frequency(self, query_term, posting_list_docs_num):
+        return posting_list_docs_num
+
+    # docids of all docs (used for negated boolean queries)
+    def all_document_ids(self):
+        return range(1, self.indexes.total_doc_count() + 1)
+
+    # indexed stems starting with prefix: [(stem, number of docs containing it)], the most frequent first
+    def expand_prefix(self, prefix, limit=None):
+        with metrics.stage("term_lookup"):
+            return term_lookup.expand_prefix(self.indexes.get_term_dictionaries(), prefix, limit)
+
+    # indexed stems within max_edits of term: [(stem, number of docs containing it, edit distance)], the closest first
+    def expand_fuzzy(self, term, max_edits, limit=None):
+        with metrics.stage("term_lookup"):
+            return term_lookup.expand_fuzzy(self.indexes.get_term_dictionaries(), term, max_edits, limit)
+
+    # numbers of occurrences of words of stems in indexed docs: {stem: {word: count}}
+    def word_counts(self, stems):
+        return term_lookup.word_counts((surface_forms.word_counts
+                                        for surface_forms in self.indexes.get_surface_forms()), stems)
+
+    # the most frequent indexed word of each stem (shown to users instead of stem): {stem: word}
+    def surface_forms(self, stems):
+        with metrics.stage("term_lookup"):
+            return term_lookup.most_frequent_words(self.word_counts(stems))
+
+    # sizes of candidate set and number of ranked docs of search
+    @staticmethod
+    def _count_search(candidate_docs_num, scored_docs_num):
+        if metrics.enabled:
+            metrics.increment("searches")
+            metrics.increment("candidate_docs", candidate_docs_num)
+            metrics.increment("documents_scored", scored_docs_num)
+
     # bm25 for all docs
     def find_documents_and_rank_by_bm25(self, query_terms):
+        query_terms_to_docids, query_terms_to_posting_lists_sizes = self._get_query_terms_docids(query_terms)
         docids = set()
-        query_terms_to_posting_lists_sizes = dict()
-        for query_term in query_terms:
-            # documents containing query term
-            posting_list = self.indexes.get_documents(query_term)
-            # how many documents containing query term
-            query_terms_to_posting_lists_sizes[query_term] = len(posting_list)
+        for docids_of_query_term in query_terms_to_docids.values():
             # add docid to all docids
-            for (pos, docid) in posting_list:
-                docids.add(docid)
+            docids.update(docids_of_query_term)
         # create docids and their relevance by bm25 algorithm
         docids_and_relevance = set()
-        # update each doc
-        for docid in docids:
-            docids_and_relevance.add((docid, self._bm25(docid, query_terms_to_posting_lists_sizes)))
+        with metrics.stage("score"):
+            # update each doc
+            for docid in docids:
+                docids_and_relevance.add((docid, self._bm25(docid, query_terms_to_posting_lists_sizes) +
+                                          self._static_score(docid)))
+        self._count_search(len(docids), len(docids))
         # return search results based on their relevance
-        return SearchResults(sorted(list(docids_and_relevance), key=lambda x: x[1], reverse=True))
-
-    # OLD RANKING FUNCTIONS STILL WORKS BUT REDUNDANT
-    # def rank_docids(self, docids):
-    #     return sorted([(docid, self.indexes.get_document_score(docid)) for docid in docids], key=lambda x: x[1],
-    #                   reverse=True)
-    #
-    # # find documents by terms
-    # def find_documents_and_rank_by_score_and(self, query_terms):
-    #     query_term_count = defaultdict(set)
-    #     for query_term in query_terms:
-    #         for (pos, docid) in self.indexes.get_documents(query_term):
-    #             query_term_count[docid].add(query_term)
-    #     return SearchResults(self.rank_docids(
-    #         [doc_id for doc_id, unique_hits in query_term_count.items() if len(unique_hits) == len(query_terms)]))
-    #
-    # def find_documents_and_rank_by_score_or(self, query_terms):
-    #     docids = set()
-    #     for query_term in query_terms:
-    #         for (pos, docid) in self.indexes.get_documents(query_term):
-    #             docids.add(docid)
-    #     return SearchResults(self.rank_docids(docids))
+        return SearchResults(sort_by_relevance(docids_and_relevance))
+
+    # upper bound of bm25 rank of query term in any doc (computed from its max tf / doc len ratio stored in index)
+    def _bm25_upper_bound(self, query_term, nd_containing):
+        upper_bound = bm25_term_rank(self.indexes.get_max_tf_ratio(query_term), nd_containing,
+                                     self.indexes.total_doc_count(), self.indexes.average_doc_len())
+        # rank of term with negative IDF is negative, so 0 bounds it
+        # bound is slightly increased, so float rounding of sums can't make it smaller than real rank
+        return max(upper_bound, 0) * (1 + 1e-9) + 1e-12
+
+    # number of docs containing any of query terms (docids of posting lists are decoded, docs are not ranked)
+    def _count_found_docs(self, query_terms):
+        docids = set()
+        for query_term in dict.fromkeys(query_terms):
+            for docid_block in self.indexes.get_docid_blocks(query_term)[1]:
+                docids.update(docid_block)
+        return len(docids)
+
+    # best k docs by bm25 (same as first k results of find_documents_and_rank_by_bm25)
+    # WAND dynamic pruning: docs which can't get into top k by upper bounds of their terms are not ranked
+    # (with prior weight static scores of docs are bounded too, search stops when remaining docs can't get into top k
+    # and rest of posting lists is not decoded)
+    def find_documents_top_k(self, query_terms, k):
+        query_terms_to_posting_lists_sizes = dict()
+        cursors = []
+        # numbers of docs of posting lists of query terms found in index
+        docs_nums = []
+        with metrics.stage("postings"):
+            for query_term in dict.fromkeys(query_terms):
+                docs_num, docid_blocks = self.indexes.get_docid_blocks(query_term)
+                query_terms_to_posting_lists_sizes[query_term] = self._document_frequency(query_term, docs_num)
+                if docs_num > 0:
+                    docs_nums.append(docs_num)
+                    cursors.append(_PostingCursor(docid_blocks, self._bm25_upper_bound(
+                        query_term, query_terms_to_posting_lists_sizes[query_term])))
+        static_scores, static_score_bounds = self._get_static_scores() if self.prior_weight else (None, None)
+        # min heap of best (relevance, -docid), so the worst of best docs is first
+        # one doc more than k is searched, so it is known whether any doc is left for next page
+        top_k = []
+        heap_size = k + 1
+        scored_docs_num = 0
+        with metrics.stage("score"):
+            while cursors:
+                # rank of doc has to be larger than the worst in top k (docs are visited by increasing docid)
+                threshold = top_k[0][0] if len(top_k) == heap_size else -math.inf
+                cursors.sort(key=lambda cursor: cursor.docid())
+                # find pivot: first cursor where sum of upper bounds can exceed threshold
+                upper_bounds_sum = 0
+                pivot = None
+                for i, cursor in enumerate(cursors):
+                    upper_bounds_sum += cursor.upper_bound
+                    # docs from docid of cursor to docid of next cursor contain only terms of cursors so far
+                    if upper_bounds_sum + (static_score_bounds[cursor.docid()] if static_score_bounds else 0) > \
+                            threshold:
+                        pivot = i
+                        break
+                # no doc can get into top k anymore
+                if pivot is None:
+                    break
+                pivot_docid = cursors[pivot].docid()
+                if cursors[0].docid() == pivot_docid:
+                    # all cursors before pivot point to pivot doc, rank it
+                    relevance = self._bm25(pivot_docid, query_terms_to_posting_lists_sizes)
+                    if static_scores:
+                        relevance += static_scores[pivot_docid]
+                    candidate = (relevance, -pivot_docid)
+                    scored_docs_num += 1
+                    if len(top_k) < heap_size:
+                        heapq.heappush(top_k, candidate)
+                    elif candidate > top_k[0]:
+                        heapq.heapreplace(top_k, candidate)
+                    for cursor in cursors:
+                        if cursor.docid() == pivot_docid:
+                            cursor.advance_to(pivot_docid + 1)
+                else:
+                    # docs before pivot doc can't get into top k, skip them
+                    for cursor in cursors[:pivot]:
+                        cursor.advance_to(pivot_docid)
+                cursors = [cursor for cursor in cursors if not cursor.exhausted()]
+        # number of found docs (used for pagination): when top k + 1 isn't full no doc was pruned, so all found docs
+        # are in it, otherwise union of posting lists is counted (docs skipped by pruning are found too)
+        if len(top_k) < heap_size:
+            total_doc_num = len(top_k)
+        elif len(docs_nums) == 1:
+            total_doc_num = docs_nums[0]
+        else:
+            total_doc_num = self._count_found_docs(query_terms)
+        while len(top_k) > k:
+            heapq.heappop(top_k)
+        self._count_search(total_doc_num, scored_docs_num)
+        return SearchResults(sort_by_relevance([(-docid, relevance) for (relevance, docid) in top_k]), total_doc_num)
+
+    # posting lists of query terms by docid: {query term: {docid: positions}}
+    # docids - only positions of these docs are decoded (whole posting lists are decoded only for phrases)
+    def _get_query_terms_positions(self, query_terms, docids=None):
+        with metrics.stage("postings"):
+            if docids is None:
+                return {query_term: dict(self.indexes.get_postings(query_term)) for query_term in query_terms}
+            docids = sorted(docids)
+            return {query_term: self.indexes.get_positions(query_term, docids) for query_term in query_terms}
+
+    # positions of query terms in given docs: {docid: [positions of each query term found in doc]}
+    def get_query_positions(self, query_terms, docids):
+        query_terms_positions = self._get_query_terms_positions(dict.fromkeys(query_terms), docids).values()
+        return {docid: [positions[docid] for positions in query_terms_positions if docid in positions]
+                for docid in docids}
+
+    # docs containing all phrases of query
+    def _find_phrase_documents(self, phrases, query_terms_positions):
+        docids = intersect([list(query_terms_positions[term]) for phrase in phrases for (offset, term) in phrase])
+        return [docid for docid in docids
+                if all(phrase_starts([query_terms_positions[term][docid] for (offset, term) in phrase],
+                                     [offset for (offset, term) in phrase])
+                       for phrase in phrases)]
+
+    # sorted docids of docs containing phrase (list of (offset in phrase, term))
+    def get_phrase_document_ids(self, phrase):
+        return self._find_phrase_documents([phrase], self._get_query_terms_positions(
+            dict.fromkeys(term for (offset, term) in phrase)))
+
+    # proximity boost of doc by positions of query terms in it
+    def _proximity_boost(self, docid, query_terms_positions):
+        return proximity_boost([positions[docid] for positions in query_terms_positions.values()
+                                if docid in positions], self.proximity_weight)
+
+    # best k docs of parsed query (see lang_proc.parse_query)
+    # * query with phrases: only docs containing all phrases are found, they are ranked by bm25 and proximity boost
+    # * query without phrases: best docs by bm25, first RERANK_DEPTH of them are reordered with proximity boost
+    def find_documents_by_query(self, parsed_query, k):
+        query_terms = list(dict.fromkeys(parsed_query.terms))
+        if parsed_query.phrases:
+            query_terms_positions = self._get_query_terms_positions(query_terms)
+            query_terms_to_posting_lists_sizes = {query_term: self._document_frequency(query_term, len(positions))
+                                                  for query_term, positions in query_terms_positions.items()}
+            with metrics.stage("score"):
+                docids_and_relevance = [(docid, self._bm25(docid, query_terms_to_posting_lists_sizes) +
+                                         self._static_score(docid) +
+                                         self._proximity_boost(docid, query_terms_positions))
+                                        for docid in self._find_phrase_documents(parsed_query.phrases,
+                                                                                 query_terms_positions)]
+            self._count_search(len(docids_and_relevance), len(docids_and_relevance))
+            return SearchResults(sort_by_relevance(docids_and_relevance)[:k], len(docids_and_relevance))
+        search_results = self.find_documents_top_k(query_terms, max(k, RERANK_DEPTH))
+        docids_and_relevance = list(zip(search_results.docids, search_results.relevances))
+        # positions are decoded only for reranked docs
+        query_terms_positions = self._get_query_terms_positions(query_terms, search_results.docids[:RERANK_DEPTH])
+        # rerank depth does not depend on k, so results of next pages continue results of previous ones
+        with metrics.stage("rerank"):
+            reranked = sort_by_relevance([(docid, relevance + self._proximity_boost(docid, query_terms_positions))
+                                          for docid, relevance in docids_and_relevance[:RERANK_DEPTH]])
+        return SearchResults((reranked + docids_and_relevance[RERANK_DEPTH:])[:k], search_results.total_doc_num())
+
+    # best k docs matching boolean query (see boolean_query.py) ranked by bm25 of its terms which are not negated
+    def find_documents_by_boolean_query(self, boolean_query, k):
+        if boolean_query is None:
+            return SearchResults([])
+        with metrics.stage("postings"):
+            docids = boolean_query.evaluate(self)
+        query_terms_to_posting_lists_sizes = {query_term: self.indexes.get_document_frequency(query_term)
+                                              for query_term in dict.fromkeys(boolean_query.positive_terms())}
+        with metrics.stage("score"):
+            docids_and_relevance = heapq.nsmallest(k, ((docid, self._bm25(docid, query_terms_to_posting_lists_sizes) +
+                                                        self._static_score(docid))
+                                                       for docid in docids), key=lambda x: (-x[1], x[0]))
+        self._count_search(len(docids), len(docids))
+        return SearchResults(docids_and_relevance, len(docids))
+
+
+# smallest window (first position, last position) of doc containing all found query terms
+# query_positions are positions of each query term found in doc (see Searcher.get_query_positions)
+def snippet_window(query_positions):
+    return min_window(query_positions) if query_positions else None
 
 
 # generate snippet for given doc and query
-def generate_snippet(query_terms, doc_text):
+# window - best window of doc found by positions of query terms (see snippet_window), doc text is scanned without it
+def generate_snippet(query_terms, doc_text, window=None):
+    if window is not None:
+        window_start, window_end = window
+    else:
+        window_start, window_end = _find_snippet_window(query_terms, doc_text)
+    # find best window
+    doc_len = len(doc_text)
+    snippet_start = max(window_start - 10, 0)
+    snippet_end = min(doc_len, window_end + 1 + 10)
+    # return best window snippet containing all terms from query
+    return shorten_snippet([(term.full_word, term in query_terms) for term in doc_text[snippet_start:snippet_end]])
+
+
+# cut middle of snippet (list of (word, is query term)) if it is too long
+def shorten_snippet(snippet):
+    if len(snippet) > 50:
+        # get excessive length of snippet
+        excessive_len = len(snippet) - 50
+        # cut it
+        snippet = snippet[:int(len(snippet) / 2) - int(excessive_len / 2)] + [("...", False)] + snippet[int(
+            len(snippet) / 2) + int(excessive_len / 2):]
+    return snippet
+
+
+# find window of doc with the most query terms by scanning its text
+def _find_snippet_window(query_terms, doc_text):
     query_terms_in_window = []
     best_window = []
     best_window_len = 100500
@@ -143,17 +437,4 @@ def generate_snippet(query_terms, doc_text):
                 terms_in_best_window = terms_in_window
                 best_window = query_terms_in_window[:]
                 best_window_len = current_window_len
-    # find best window
-    doc_len = len(doc_text)
-    snippet_start = max(best_window[0][1] - 10, 0)
-    snippet_end = min(doc_len, best_window[len(best_window) - 1][1] + 1 + 10)
-    # return best window snippet containing all terms from query
-    snippet = [(term.full_word, term in query_terms) for term in doc_text[snippet_start:snippet_end]]
-    # if snippet is too long
-    if len(snippet) > 50:
-        # get excessive length of snippet
-        excessive_len = len(snippet) - 50
-        # cut it
-        snippet = snippet[:int(len(snippet) / 2) - int(excessive_len / 2)] + [("...", False)] + snippet[int(
-            len(snippet) / 2) + int(excessive_len / 2):]
-    return snippet
+    return best_window[0][1], best_window[len(best_window) - 1][1]
@@ -0,0 +1,684 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+import fcntl
+import heapq
+import itertools
+import logging
+import mmap
+from operator import itemgetter
+import os.path
+import pickle
+import shelve
+import shutil
+import struct
+import threading
+from types import SimpleNamespace
+from document import StemVocabulary, SurfaceForms, read_surface_forms, write_surface_forms
+from index_meta import write_index_meta, read_index_meta
+import metrics
+from postings import encode_postings, decode_postings, decode_docids_and_tfs, decode_positions, posting_list_docs_num, \
+    iter_docid_blocks
+
+# Segmented index is directory "segments" inside index directory with segment directories and
+# index_meta.json of whole collection with list of its segments (manifest), segments have contiguous docid ranges
+# and are listed in docid order. New segments are added by incremental indexing, merges replace adjacent
+# segments with one segment. Manifest is replaced atomically, so searchers see either old or new segments.
+
+# Immutable index segment is a directory with files:
+#   terms - sorted term dictionary: header, table of fixed size entries, utf-8 terms
+#   postings - compact posting lists (see postings.py) of all terms one after another
+#   docs - document store: header, offset table, pickled documents
+#   doc_stats - same record format as docs, pickled (doc length, term frequencies)
+#   doc_lengths - lengths of docs of segment in docid order (unsigned ints)
+#   static_priors - popularity priors of docs of segment in docid order (floats, see document.popularity_prior)
+#   stems - pickled list of stems interned in stored documents
+#   surface_forms - pickled {stem: {word: count}} of words of stems of docs (see document.SurfaceForms)
+#   index_meta.json - collection statistics of segment (see index_meta.py), ordered_by_prior is true when docids
+#                     of segment are assigned in order of decreasing prior, so posting lists are ordered by static
+#                     score too and search of best docs can stop early (merges of such segments keep the order)
+# all binary files are memory mapped by reader, so their pages are shared by all processes using segment
+
+TERMS_MAGIC = b"SFTD"
+RECORDS_MAGIC = b"SFRS"
+# magic, number of terms
+_TERMS_HEADER = struct.Struct("<4sI")
+# term offset in terms blob, term length, postings offset, postings length, document frequency,
+# max ratio of term frequency to doc length
+_TERM_ENTRY = struct.Struct("<IIQIId")
+# magic, first docid, number of records
+_RECORDS_HEADER = struct.Struct("<4sII")
+_OFFSET = struct.Struct("<Q")
+
+# merge policy: when there are more than max segments, merge factor adjacent segments with fewest docs are merged
+DEFAULT_MAX_SEGMENTS = 8
+DEFAULT_MERGE_FACTOR = 4
+
+logger = logging.getLogger("surfearch.segments")
+
+
+# open file as read only memory map (empty files can't be mapped)
+def _map_file(path):
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# write sorted term dictionary and posting lists, terms_and_postings is iterable of
+# (term, [(docid, positions)], max tf / doc len ratio) sorted by term, posting lists are written one by one
+# (only entries of terms are kept in memory)
+def _write_terms_and_postings(segment_dir, terms_and_postings):
+    entries = []
+    terms_blob = bytearray()
+    with open(os.path.join(segment_dir, "postings"), "wb") as postings_file:
+        postings_offset = 0
+        for term, postings, max_tf_ratio in terms_and_postings:
+            encoded_term = term.encode("utf-8")
+            encoded_postings = encode_postings(postings)
+            entries.append((len(terms_blob), len(encoded_term), postings_offset, len(encoded_postings),
+                            len(postings), max_tf_ratio))
+            terms_blob += encoded_term
+            postings_file.write(encoded_postings)
+            postings_offset += len(encoded_postings)
+    _write_term_entries(os.path.join(segment_dir, "terms"), entries, terms_blob)
+
+
+def _write_term_entries(path, entries, terms_blob):
+    with open(path, "wb") as terms_file:
+        terms_file.write(_TERMS_HEADER.pack(TERMS_MAGIC, len(entries)))
+        for entry in entries:
+            terms_file.write(_TERM_ENTRY.pack(*entry))
+        terms_file.write(terms_blob)
+
+
+# write sorted term dictionary without posting lists (used by indexes whose posting lists are stored elsewhere),
+# terms_and_stats is iterable of (term, document frequency, max tf / doc len ratio) sorted by term
+def write_term_dictionary(path, terms_and_stats):
+    entries = []
+    terms_blob = bytearray()
+    for term, nd_containing, max_tf_ratio in terms_and_stats:
+        encoded_term = term.encode("utf-8")
+        entries.append((len(terms_blob), len(encoded_term), 0, 0, nd_containing, max_tf_ratio))
+        terms_blob += encoded_term
+    _write_term_entries(path, entries, terms_blob)
+
+
+# write record store, encoded_records is iterable of records_num pickled objects for docids first_docid,
+# first_docid + 1, ..., records are written as they come and their offsets are written to the table at the end
+def _write_records(path, first_docid, records_num, encoded_records):
+    offsets = array("Q", [0])
+    with open(path, "wb") as records_file:
+        records_file.write(_RECORDS_HEADER.pack(RECORDS_MAGIC, first_docid, records_num))
+        records_file.seek(_RECORDS_HEADER.size + (records_num + 1) * _OFFSET.size)
+        for encoded_record in encoded_records:
+            records_file.write(encoded_record)
+            offsets.append(offsets[-1] + len(encoded_record))
+        assert len(offsets) == records_num + 1
+        records_file.seek(_RECORDS_HEADER.size)
+        records_file.write(struct.pack("<{}Q".format(len(offsets)), *offsets))
+
+
+def _pickle_records(records):
+    return (pickle.dumps(record, pickle.HIGHEST_PROTOCOL) for record in records)
+
+
+# write segment files, encoded_docs and encoded_stats are pickled stored documents and (doc length, term frequencies),
+# doc_lengths and static_priors are arrays of lengths and popularity priors for docids first_docid, first_docid + 1,
+# ..., stems are stems interned in stored documents, surface_forms are words of stems of docs (see
+# document.SurfaceForms), docs, stats and posting lists are streamed to files (segment is never whole in memory)
+def _write_segment(segment_dir, terms_and_postings, first_docid, encoded_docs, encoded_stats, doc_lengths,
+                   static_priors, stems, surface_forms, ordered_by_prior=False):
+    os.mkdir(segment_dir)
+    _write_terms_and_postings(segment_dir, terms_and_postings)
+    _write_records(os.path.join(segment_dir, "docs"), first_docid, len(doc_lengths), encoded_docs)
+    _write_records(os.path.join(segment_dir, "doc_stats"), first_docid, len(doc_lengths), encoded_stats)
+    with open(os.path.join(segment_dir, "doc_lengths"), "wb") as doc_lengths_file:
+        doc_lengths.tofile(doc_lengths_file)
+    with open(os.path.join(segment_dir, "static_priors"), "wb") as static_priors_file:
+        static_priors.tofile(static_priors_file)
+    with open(os.path.join(segment_dir, "stems"), "wb") as stems_file:
+        pickle.dump(stems, stems_file, pickle.HIGHEST_PROTOCOL)
+    write_surface_forms(os.path.join(segment_dir, "surface_forms"), surface_forms)
+    write_index_meta(segment_dir, len(doc_lengths), sum(doc_lengths), ordered_by_prior=ordered_by_prior)
+
+
+# positions of docs ordered by decreasing popularity prior (docs with the same prior keep their order)
+def _order_by_prior(static_priors):
+    return sorted(range(len(static_priors)), key=lambda position: (-static_priors[position], position))
+
+
+# posting list with docids replaced by new docids (new_docids[docid]), sorted by new docids
+def _renumber_postings(postings, new_docids):
+    return sorted(((new_docids[docid], positions) for docid, positions in postings), key=itemgetter(0))
+
+
+# write segment from loaded indexes (ShelveIndexes or CompactIndexes), docids of indexes are 1..doc count,
+# docids in segment are shifted by docid_offset (segments added to existing index continue its docids)
+# order_by_prior - docids of segment are assigned in order of decreasing popularity prior of docs
+# returns array of segment docid of each docid of indexes
+def write_segment(indexes, segment_dir, docid_offset=0, order_by_prior=False):
+    static_priors = indexes.get_static_priors()
+    docids = range(1, indexes.total_doc_count() + 1)
+    if order_by_prior:
+        docids = [docids[position] for position in _order_by_prior(static_priors[1:])]
+    segment_docids = array("I", [0]) * (len(docids) + 1)
+    for segment_docid, docid in enumerate(docids, docid_offset + 1):
+        segment_docids[docid] = segment_docid
+    # stems of sorted term dictionary of indexes, posting lists are read one by one
+    query_terms = (SimpleNamespace(stem=stem) for dictionary in indexes.get_term_dictionaries()
+                   for stem in dictionary.terms())
+    terms_and_postings = ((query_term.stem, _renumber_postings(indexes.get_postings(query_term), segment_docids),
+                           indexes.get_max_tf_ratio(query_term)) for query_term in query_terms)
+    surface_forms = SurfaceForms()
+    for indexes_surface_forms in indexes.get_surface_forms():
+        surface_forms.update(indexes_surface_forms)
+    doc_lengths = indexes.get_doc_lengths()
+    _write_segment(segment_dir, terms_and_postings, docid_offset + 1,
+                   _pickle_records(indexes.forward_index[str(docid)] for docid in docids),
+                   _pickle_records(indexes.get_document_stats(docid) for docid in docids),
+                   array("I", [doc_lengths[docid] for docid in docids]),
+                   array("f", [static_priors[docid] for docid in docids]), indexes.get_stem_vocabulary().stems,
+                   surface_forms, order_by_prior)
+    return segment_docids
+
+
+# name of segment directory by its number
+def segment_name(segment_number):
+    return "segment_{:06d}".format(segment_number)
+
+
+# exclusive lock of segmented index held by its writers (incremental indexing and merges)
+@contextmanager
+def segments_lock(segments_dir):
+    with open(os.path.join(segments_dir, "lock"), "w") as lock_file:
+        # lock is released when file is closed
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+# replace manifest of segmented index (every write gets new generation, so searchers reload it)
+def write_manifest(segments_dir, segments, next_segment, doc_count, total_tokens):
+    return write_index_meta(segments_dir, doc_count, total_tokens, segments=segments, next_segment=next_segment)
+
+
+# create segmented index with one segment from loaded indexes (see write_segment)
+# returns array of segment docid of each docid of indexes
+def create_segments(indexes, segments_dir, order_by_prior=False):
+    os.mkdir(segments_dir)
+    name = segment_name(0)
+    segment_docids = write_segment(indexes, os.path.join(segments_dir, name), order_by_prior=order_by_prior)
+    meta = read_index_meta(os.path.join(segments_dir, name))
+    write_manifest(segments_dir, [name], 1, meta["doc_count"], meta["total_tokens"])
+    return segment_docids
+
+
+# url -> docid shelve of index of segmented index (docids of segmented index, see indexer.py)
+def _url_to_id_path(segments_dir):
+    return os.path.join(os.path.dirname(os.path.normpath(segments_dir)), "url_to_id")
+
+
+# memory mapped sorted term dictionary
+class TermDictionary(object):
+    def __init__(self, path):
+        self._data = _map_file(path)
+        magic, self._terms_num = _TERMS_HEADER.unpack_from(self._data, 0)
+        assert magic == TERMS_MAGIC
+        self._terms_blob_offset = _TERMS_HEADER.size + self._terms_num * _TERM_ENTRY.size
+        self._terms = None
+        self._document_frequencies = None
+
+    def __len__(self):
+        return self._terms_num
+
+    # entry of term by its index in sorted order
+    def _entry(self, index):
+        return _TERM_ENTRY.unpack_from(self._data, _TERMS_HEADER.size + index * _TERM_ENTRY.size)
+
+    # term by its index in sorted order (as utf-8 bytes)
+    def term_bytes(self, index):
+        term_offset, term_len = self._entry(index)[:2]
+        start = self._terms_blob_offset + term_offset
+        return self._data[start:start + term_len]
+
+    # all terms in sorted order (decoded once, used by prefix and fuzzy lookup which bisect them many times)
+    def terms(self):
+        if self._terms is None:
+            self._load_terms()
+        return self._terms
+
+    # numbers of docs containing terms in sorted order of terms
+    def document_frequencies(self):
+        if self._document_frequencies is None:
+            self._load_terms()
+        return self._document_frequencies
+
+    def _load_terms(self):
+        terms_blob = bytes(self._data[self._terms_blob_offset:])
+        terms = []
+        document_frequencies = array("I")
+        for term_offset, term_len, postings_offset, postings_len, nd_containing, max_tf_ratio in \
+                _TERM_ENTRY.iter_unpack(self._data[_TERMS_HEADER.size:self._terms_blob_offset]):
+            terms.append(terms_blob[term_offset:term_offset + term_len].decode("utf-8"))
+            document_frequencies.append(nd_containing)
+        self._terms, self._document_frequencies = terms, document_frequencies
+
+    # binary search of first term index >= given encoded term
+    def lower_bound(self, encoded_term):
+        low, high = 0, self._terms_num
+        while low < high:
+            middle = (low + high) // 2
+            if self.term_bytes(middle) < encoded_term:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # (postings offset, postings length, document frequency, max tf ratio) of term or None if it is not in dictionary
+    def lookup(self, term):
+        encoded_term = term.encode("utf-8")
+        index = self.lower_bound(encoded_term)
+        if index == self._terms_num or self.term_bytes(index) != encoded_term:
+            return None
+        return self._entry(index)[2:]
+
+    # (term, postings offset, postings length, document frequency, max tf ratio) of all terms in sorted order
+    def entries(self):
+        for index in range(self._terms_num):
+            yield (bytes(self.term_bytes(index)),) + self._entry(index)[2:]
+
+
+# memory mapped record store
+class RecordStore(object):
+    def __init__(self, path):
+        self._data = _map_file(path)
+        magic, self.first_docid, self._records_num = _RECORDS_HEADER.unpack_from(self._data, 0)
+        assert magic == RECORDS_MAGIC
+        self._records_offset = _RECORDS_HEADER.size + (self._records_num + 1) * _OFFSET.size
+
+    def __len__(self):
+        return self._records_num
+
+    # raw bytes of record (zero copy view of mapped file)
+    def get_bytes(self, docid):
+        index = docid - self.first_docid
+        if not 0 <= index < self._records_num:
+            raise KeyError(docid)
+        (start, end) = struct.unpack_from("<2Q", self._data, _RECORDS_HEADER.size + index * _OFFSET.size)
+        return memoryview(self._data)[self._records_offset + start:self._records_offset + end]
+
+    def get(self, docid):
+        return pickle.loads(self.get_bytes(docid))
+
+
+# one memory mapped read only segment (written by write_segment)
+class Segment(object):
+    def __init__(self, segment_dir):
+        meta = read_index_meta(segment_dir)
+        self.segment_dir = segment_dir
+        self.terms = TermDictionary(os.path.join(segment_dir, "terms"))
+        self.postings = _map_file(os.path.join(segment_dir, "postings"))
+        self.docs = RecordStore(os.path.join(segment_dir, "docs"))
+        self.doc_stats = RecordStore(os.path.join(segment_dir, "doc_stats"))
+        self.first_docid = self.docs.first_docid
+        self.doc_count = meta["doc_count"]
+        self.total_tokens = meta["total_tokens"]
+        self.ordered_by_prior = meta["ordered_by_prior"]
+        # files which are not mapped are read at once, so segment stays readable after merge removes its directory
+        with open(os.path.join(segment_dir, "stems"), "rb") as stems_file:
+            self.stem_vocabulary = StemVocabulary(pickle.load(stems_file))
+        self.surface_forms = read_surface_forms(os.path.join(segment_dir, "surface_forms"))
+        self.doc_lengths = array("I")
+        with open(os.path.join(segment_dir, "doc_lengths"), "rb") as doc_lengths_file:
+            self.doc_lengths.fromfile(doc_lengths_file, self.doc_count)
+        self.static_priors = array("f")
+        with open(os.path.join(segment_dir, "static_priors"), "rb") as static_priors_file:
+            self.static_priors.fromfile(static_priors_file, self.doc_count)
+
+    # interned stems of stored documents
+    def get_stem_vocabulary(self):
+        return self.stem_vocabulary
+
+    # lengths of docs of segment in docid order
+    def get_doc_lengths(self):
+        return self.doc_lengths
+
+    # popularity priors of docs of segment in docid order
+    def get_static_priors(self):
+        return self.static_priors
+
+    # encoded posting list by its offset and length (zero copy view of mapped file)
+    def posting_list_bytes(self, postings_offset, postings_len):
+        return memoryview(self.postings)[postings_offset:postings_offset + postings_len]
+
+    # (term, segment, postings offset, postings length, document frequency, max tf ratio) of all terms in sorted order
+    def term_entries(self):
+        for entry in self.terms.entries():
+            yield (entry[0], self) + entry[1:]
+
+    # encoded posting list of stem
+    def get_posting_list_bytes(self, stem):
+        entry = self.terms.lookup(stem)
+        if entry is None:
+            return b""
+        if metrics.enabled:
+            metrics.increment("posting_lists_read")
+            metrics.increment("postings_bytes_read", entry[1])
+        return self.posting_list_bytes(entry[0], entry[1])
+
+
+# merge adjacent segments (in docid order) to new segment
+# segments ordered by prior are merged to segment ordered by prior (docids of their docs are assigned again),
+# then urls of docs of new segment in docid order are returned (None when docids are not changed)
+def _merge_segments(segments, segment_dir):
+    # stems of merged segments are interned again in one vocabulary
+    vocabulary = StemVocabulary()
+    surface_forms = SurfaceForms()
+    # stem ids of segment -> stem ids of vocabulary
+    segments_stem_ids = []
+    doc_lengths = array("I")
+    static_priors = array("f")
+    for segment in segments:
+        segments_stem_ids.append(array("I", [vocabulary.get_id(stem) for stem in segment.get_stem_vocabulary().stems]))
+        doc_lengths.extend(segment.get_doc_lengths())
+        static_priors.extend(segment.get_static_priors())
+        surface_forms.update(segment.surface_forms)
+    # docids of adjacent segments are contiguous: doc at position p of merged segments has docid first_docid + p
+    first_docid = segments[0].first_docid
+    first_docids = [segment.first_docid for segment in segments]
+    ordered_by_prior = all(segment.ordered_by_prior for segment in segments)
+    order = range(len(doc_lengths))
+    new_docids = None
+    if ordered_by_prior:
+        order = _order_by_prior(static_priors)
+        doc_lengths, static_priors = (array(values.typecode, [values[position] for position in order])
+                                      for values in (doc_lengths, static_priors))
+        new_docids = {first_docid + position: docid for docid, position in enumerate(order, first_docid)}
+    # urls of docs in new docid order (returned when docids are changed)
+    urls = []
+
+    # docs are read one by one in new docid order, their stem ids are mapped to new vocabulary
+    def encoded_docs():
+        for position in order:
+            docid = first_docid + position
+            segment_index = bisect_right(first_docids, docid) - 1
+            doc = segments[segment_index].docs.get(docid)
+            stem_ids = segments_stem_ids[segment_index]
+            doc.stem_ids = array("I", [stem_ids[stem_id] for stem_id in doc.stem_ids])
+            if new_docids is not None:
+                urls.append(doc.url)
+            yield pickle.dumps(doc, pickle.HIGHEST_PROTOCOL)
+
+    # stats are copied as they are stored
+    def encoded_stats():
+        for position in order:
+            docid = first_docid + position
+            yield segments[bisect_right(first_docids, docid) - 1].doc_stats.get_bytes(docid)
+
+    # posting lists of the same term are concatenated in order of segments, so docids stay sorted
+    def terms_and_postings():
+        entries = heapq.merge(*[segment.term_entries() for segment in segments], key=lambda x: x[0])
+        for term, term_entries in itertools.groupby(entries, key=lambda x: x[0]):
+            postings = []
+            max_tf_ratio = 0
+            for (_, segment, postings_offset, postings_len, doc_freq, tf_ratio) in term_entries:
+                postings.extend(decode_postings(segment.posting_list_bytes(postings_offset, postings_len)))
+                max_tf_ratio = max(max_tf_ratio, tf_ratio)
+            if new_docids is not None:
+                postings = _renumber_postings(postings, new_docids)
+            yield term.decode("utf-8"), postings, max_tf_ratio
+
+    _write_segment(segment_dir, terms_and_postings(), first_docid, encoded_docs(), encoded_stats(), doc_lengths,
+                   static_priors, vocabulary.stems, surface_forms, ordered_by_prior)
+    return urls if new_docids is not None else None
+
+
+# apply merge policy to segmented index: merge segments until there are at most max_segments of them,
+# returns number of merges
+def merge_segments_if_needed(segments_dir, max_segments=DEFAULT_MAX_SEGMENTS, merge_factor=DEFAULT_MERGE_FACTOR):
+    merges_num = 0
+    with segments_lock(segments_dir):
+        manifest = read_index_meta(segments_dir)
+        names = manifest["segments"]
+        next_segment = manifest["next_segment"]
+        while len(names) > max(max_segments, 1):
+            segments = [Segment(os.path.join(segments_dir, name)) for name in names]
+            factor = min(max(merge_factor, 2), len(names))
+            # adjacent segments with the fewest docs (merges stay cheap, big segments are rarely rewritten)
+            start = min(range(len(names) - factor + 1),
+                        key=lambda i: sum(segment.doc_count for segment in segments[i:i + factor]))
+            name = segment_name(next_segment)
+            # segment of merge interrupted before manifest was replaced is not used by anyone
+            shutil.rmtree(os.path.join(segments_dir, name), ignore_errors=True)
+            renumbered_urls = _merge_segments(segments[start:start + factor], os.path.join(segments_dir, name))
+            merged_names = names[start:start + factor]
+            names = names[:start] + [name] + names[start + factor:]
+            next_segment += 1
+            write_manifest(segments_dir, names, next_segment, manifest["doc_count"], manifest["total_tokens"])
+            # docids of renumbered docs stay in range of merged segments, so interrupted update of urls never makes
+            # indexed url look new to incremental indexing
+            if renumbered_urls is not None:
+                with shelve.open(_url_to_id_path(segments_dir)) as url_to_id:
+                    for docid, url in enumerate(renumbered_urls, segments[start].first_docid):
+                        url_to_id[url] = docid
+            # searchers which still use merged segments keep their memory maps and files read by Segment
+            for merged_name in merged_names:
+                shutil.rmtree(os.path.join(segments_dir, merged_name))
+            merges_num += 1
+    return merges_num
+
+
+# thread keeping number of segments bounded by merging them in background
+class BackgroundMerger(threading.Thread):
+    def __init__(self, segments_dir, interval_seconds=60, max_segments=DEFAULT_MAX_SEGMENTS,
+                 merge_factor=DEFAULT_MERGE_FACTOR):
+        super().__init__(daemon=True)
+        self.segments_dir = segments_dir
+        self.interval_seconds = interval_seconds
+        self.max_segments = max_segments
+        self.merge_factor = merge_factor
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval_seconds):
+            try:
+                merge_segments_if_needed(self.segments_dir, self.max_segments, self.merge_factor)
+            except Exception:
+                # merge is tried again at next interval (e.g. after disk space is freed)
+                logger.exception("Merge of segments failed")
+
+    def stop(self):
+        self._stopped.set()
+
+
+# opened segments of one manifest with its collection statistics, never changed after it is created
+# (reload replaces whole snapshot at once, so threads searching meanwhile never see segments of one manifest
+# with first docids or statistics of another)
+class _SegmentsSnapshot(object):
+    def __init__(self, segments, manifest_id, doc_count, average_doc_len, generation):
+        self.segments = segments
+        self.first_docids = [segment.first_docid for segment in segments]
+        self.manifest_id = manifest_id
+        self.doc_count = doc_count
+        self.average_doc_len = average_doc_len
+        self.generation = generation
+
+
+# class used for searching in segmented index (memory mapped read only segments)
+class SegmentIndexes(object):
+    def __init__(self):
+        self._snapshot = _SegmentsSnapshot([], None, 0, 0, "")
+        self._segments_dir = ""
+        # held by thread loading changed segments
+        self._reload_lock = threading.Lock()
+        # snapshot seen by thread since its last reload_if_changed, so all reads of one query (e.g. postings and then
+        # doc stats) see the same segments even when other thread loads merged ones meanwhile
+        self._thread_snapshots = threading.local()
+
+    # directory of segmented index inside index directory
+    @staticmethod
+    def segments_dir(index_dir):
+        return os.path.join(index_dir, "segments")
+
+    # snapshot of thread (see reload_if_changed), threads which never reload see the latest one
+    def _current_snapshot(self):
+        return getattr(self._thread_snapshots, "snapshot", None) or self._snapshot
+
+    # segments in docid order
+    @property
+    def segments(self):
+        return self._current_snapshot().segments
+
+    # total number of docs
+    def total_doc_count(self):
+        return self._current_snapshot().doc_count
+
+    # average length of docs (used in bm25 ranking)
+    def average_doc_len(self):
+        return self._current_snapshot().average_doc_len
+
+    # id of indexes version, it changes when indexes are written again
+    def generation(self):
+        return self._current_snapshot().generation
+
+    # loading (mapping) segments from disk, pages of files are read when they are needed
+    def load_from_disk(self, index_dir):
+        self._segments_dir = self.segments_dir(index_dir)
+        self._load()
+
+    # identity of manifest file (it is replaced by every write)
+    def _read_manifest_id(self):
+        stat = os.stat(os.path.join(self._segments_dir, "index_meta.json"))
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _load(self):
+        opened_segments = {segment.segment_dir: segment for segment in self._snapshot.segments}
+        # segments can be removed by merge after manifest is read, then new manifest is read
+        for attempt in itertools.count():
+            manifest_id = self._read_manifest_id()
+            meta = read_index_meta(self._segments_dir)
+            try:
+                segments = []
+                for name in meta["segments"]:
+                    segment_dir = os.path.join(self._segments_dir, name)
+                    segments.append(opened_segments.get(segment_dir) or Segment(segment_dir))
+                break
+            except (FileNotFoundError, ValueError):
+                if attempt == 2:
+                    raise
+        self._snapshot = _SegmentsSnapshot(segments, manifest_id, meta["doc_count"], meta["average_doc_len"],
+                                           meta.get("generation", ""))
+
+    # load segments again if they were changed on disk (new segment added or segments merged),
+    # called by every thread searching indexes before query: one of them loads segments, others wait for its snapshot,
+    # then thread sees the latest snapshot until its next call (old segments are kept open while threads use them)
+    def reload_if_changed(self):
+        changed = self._read_manifest_id() != self._snapshot.manifest_id
+        if changed:
+            with self._reload_lock:
+                if self._read_manifest_id() != self._snapshot.manifest_id:
+                    self._load()
+        self._thread_snapshots.snapshot = self._snapshot
+        return changed
+
+    # segment containing doc
+    def _segment(self, doc_id):
+        snapshot = self._current_snapshot()
+        return snapshot.segments[bisect_right(snapshot.first_docids, doc_id) - 1]
+
+    # getters
+    def get_documents(self, query_term):
+        return [(position, docid) for docid, positions in self.get_postings(query_term) for position in positions]
+
+    def get_document_ids(self, query_term):
+        docids, tfs = self.get_docids_and_tfs(query_term)
+        return docids
+
+    def get_postings(self, query_term):
+        postings = []
+        for segment in self.segments:
+            postings.extend(decode_postings(segment.get_posting_list_bytes(query_term.stem)))
+        return postings
+
+    # positions of query term in given docs: {docid: positions} of docs of sorted docids containing query term
+    def get_positions(self, query_term, docids):
+        positions_of_docs = {}
+        for segment in self.segments:
+            start = bisect_left(docids, segment.first_docid)
+            end = bisect_left(docids, segment.first_docid + segment.doc_count, start)
+            if start < end:
+                positions_of_docs.update(decode_positions(segment.get_posting_list_bytes(query_term.stem),
+                                                          docids[start:end]))
+        return positions_of_docs
+
+    # number of docs of posting lists of all segments and their docids in blocks (see postings.iter_docid_blocks)
+    def get_docid_blocks(self, query_term):
+        posting_lists = [segment.get_posting_list_bytes(query_term.stem) for segment in self.segments]
+        return (sum(posting_list_docs_num(posting_list) for posting_list in posting_lists),
+                itertools.chain.from_iterable(iter_docid_blocks(posting_list) for posting_list in posting_lists))
+
+    def get_docids_and_tfs(self, query_term):
+        docids, tfs = array("I"), array("I")
+        for segment in self.segments:
+            segment_docids, segment_tfs = decode_docids_and_tfs(segment.get_posting_list_bytes(query_term.stem))
+            docids.extend(segment_docids)
+            tfs.extend(segment_tfs)
+        return docids, tfs
+
+    # lengths of all docs by docid (docid 0 is not used), used by vectorized ranking
+    def get_doc_lengths(self):
+        doc_lengths = array("I", [0])
+        for segment in self.segments:
+            doc_lengths.extend(segment.get_doc_lengths())
+        return doc_lengths
+
+    # popularity priors of all docs by docid (docid 0 is not used), blended with bm25 by searcher
+    def get_static_priors(self):
+        static_priors = array("f", [0])
+        for segment in self.segments:
+            static_priors.extend(segment.get_static_priors())
+        return static_priors
+
+    # sorted dictionaries of stems of segments used for prefix and fuzzy lookup of terms
+    def get_term_dictionaries(self):
+        return [segment.terms for segment in self.segments]
+
+    # words of stems of segments (see document.SurfaceForms)
+    def get_surface_forms(self):
+        return [segment.surface_forms for segment in self.segments]
+
+    def get_document_frequency(self, query_term):
+        entries = [segment.terms.lookup(query_term.stem) for segment in self.segments]
+        return sum(entry[2] for entry in entries if entry)
+
+    def get_max_tf_ratio(self, query_term):
+        entries = [segment.terms.lookup(query_term.stem) for segment in self.segments]
+        return max([entry[3] for entry in entries if entry], default=0)
+
+    def get_document_stats(self, doc_id):
+        return self._segment(doc_id).doc_stats.get(doc_id)
+
+    def get_document_text(self, doc_id):
+        segment = self._segment(doc_id)
+        return segment.docs.get(doc_id).terms(segment.get_stem_vocabulary())
+
+    # stored form of doc (see document.StoredDocument) and vocabulary of its stem ids
+    def get_stored_document(self, doc_id):
+        if metrics.enabled:
+            metrics.increment("documents_loaded")
+        segment = self._segment(doc_id)
+        return segment.docs.get(doc_id), segment.get_stem_vocabulary()
+
+    # stored forms of docs (see get_stored_document) in order of doc_ids, records are read in docid order
+    def get_stored_documents(self, doc_ids):
+        stored_documents = {doc_id: self.get_stored_document(doc_id) for doc_id in sorted(doc_ids)}
+        return [stored_documents[doc_id] for doc_id in doc_ids]
+
+    def get_document_score(self, doc_id):
+        return self._segment(doc_id).docs.get(doc_id).score
+
+    def get_url(self, doc_id):
+        return self._segment(doc_id).docs.get(doc_id).url
+
+    def get_title(self, doc_id):
+        return self._segment(doc_id).docs.get(doc_id).title
@@ -0,0 +1,345 @@
+from array import array
+from bisect import bisect_left
+import multiprocessing
+import os.path
+import shelve
+import shutil
+import threading
+import time
+import traceback
+from crawl_storage import iter_crawled_posts, ChunkedPostsWriter
+from index_meta import write_index_meta, read_index_meta
+from indexer import index_posts, INDEXES_IMPLEMENTATIONS
+from searcher import Searcher, SearchResults, sort_by_relevance, RERANK_DEPTH
+from snippets import SnippetGenerator
+import term_lookup
+
+# Sharded index is directory "shards" inside index directory, docs are partitioned to shards by hash of their docid
+# (docid in whole collection, the same as in unsharded index of the same crawl):
+#   shards/index_meta.json - collection statistics of all shards, number of shards and format of their indexes
+#   shards/document_frequencies - shelve: stem -> number of docs of all shards containing it
+#   shards/shard_NNN/ - indexes of shard (docids 1..n in order of collection docids) and
+#                       global_docids - collection docid of each doc of shard
+# Each shard is searched by its own process with collection statistics of all shards, so bm25 ranks are the same
+# as ranks of unsharded index, coordinator merges best docs of shards.
+
+
+def shards_dir(index_dir):
+    return os.path.join(index_dir, "shards")
+
+
+def shard_name(shard_number):
+    return "shard_{:03d}".format(shard_number)
+
+
+# shard of doc by hash of its docid (multiplicative hash spreads consecutive docids over shards)
+def shard_of(docid, shards_num):
+    return (docid * 2654435761) % 2 ** 32 % shards_num
+
+
+# posts of crawl are partitioned to crawl dirs of shards in one pass (crawl is read once, not once per shard),
+# returns collection docids of posts of each shard
+def _partition_posts(crawled_data_dir, partition_dirs):
+    shards_num = len(partition_dirs)
+    writers = []
+    for partition_dir in partition_dirs:
+        os.mkdir(partition_dir)
+        writers.append(ChunkedPostsWriter(partition_dir))
+    global_docids = [array("I") for _ in range(shards_num)]
+    for docid, post in enumerate(iter_crawled_posts(crawled_data_dir), 1):
+        shard_number = shard_of(docid, shards_num)
+        writers[shard_number].write(post)
+        global_docids[shard_number].append(docid)
+    for writer in writers:
+        writer.close()
+    return global_docids
+
+
+# index crawled data to shards_num shards (shards are indexed one after another, each with workers processes)
+# index_format - name of indexes implementation of shards (see indexer.INDEXES_IMPLEMENTATIONS)
+def create_sharded_index(crawled_data_dir, index_directory, index_format, shards_num, block_size, workers=1):
+    start_time = time.time()  # used for time statistics
+    IndexesImplementation = INDEXES_IMPLEMENTATIONS[index_format]
+    directory = shards_dir(index_directory)
+    os.mkdir(directory)
+    # posts of shards are written to temporary crawl dirs, removed when shards are indexed
+    partitions_dir = os.path.join(directory, "partitions")
+    os.mkdir(partitions_dir)
+    partition_dirs = [os.path.join(partitions_dir, shard_name(shard_number)) for shard_number in range(shards_num)]
+    shards_global_docids = _partition_posts(crawled_data_dir, partition_dirs)
+    for shard_number in range(shards_num):
+        shard_dir = os.path.join(directory, shard_name(shard_number))
+        os.mkdir(shard_dir)
+        index_posts(iter_crawled_posts(partition_dirs[shard_number]), shard_dir, IndexesImplementation, block_size,
+                    workers)
+        with open(os.path.join(shard_dir, "global_docids"), "wb") as global_docids_file:
+            shards_global_docids[shard_number].tofile(global_docids_file)
+        shutil.rmtree(partition_dirs[shard_number])
+    os.rmdir(partitions_dir)
+    # collection statistics are sums of statistics of shards
+    doc_count = 0
+    total_tokens = 0
+    document_frequencies = {}
+    for shard_number in range(shards_num):
+        shard_dir = os.path.join(directory, shard_name(shard_number))
+        meta = read_index_meta(shard_dir)
+        doc_count += meta["doc_count"]
+        total_tokens += meta["total_tokens"]
+        with shelve.open(os.path.join(shard_dir, "term_stats"), "r") as term_stats:
+            for stem, (nd_containing, max_tf_ratio) in term_stats.items():
+                document_frequencies[stem] = document_frequencies.get(stem, 0) + nd_containing
+    with shelve.open(os.path.join(directory, "document_frequencies"), "n") as document_frequencies_shelf:
+        document_frequencies_shelf.update(document_frequencies)
+    write_index_meta(directory, doc_count, total_tokens, shards=shards_num, index_format=index_format)
+    print("Indexed {} docs to {} shards in {:.2f} seconds".format(doc_count, shards_num, time.time() - start_time))
+
+
+# indexes of shard with collection statistics of all shards (used for bm25 ranks)
+class _CollectionStatsIndexes(object):
+    def __init__(self, indexes, collection_meta, document_frequencies):
+        self._indexes = indexes
+        self._doc_count = collection_meta["doc_count"]
+        self._average_doc_len = collection_meta["average_doc_len"]
+        self._document_frequencies = document_frequencies
+
+    def __getattr__(self, name):
+        return getattr(self._indexes, name)
+
+    def total_doc_count(self):
+        return self._doc_count
+
+    def average_doc_len(self):
+        return self._average_doc_len
+
+    def get_document_frequency(self, query_term):
+        return self._document_frequencies.get(query_term.stem, 0)
+
+
+# searcher of one shard: docs of shard are ranked with collection statistics of all shards
+# (max tf ratio of shard still bounds ranks of its docs, so top k pruning uses it)
+class ShardSearcher(Searcher):
+    def __init__(self, shard_dir, IndexesImplementation, collection_dir, prior_weight=0):
+        super().__init__(shard_dir, IndexesImplementation, prior_weight=prior_weight)
+        self.shard_doc_count = self.indexes.total_doc_count()
+        self.indexes = _CollectionStatsIndexes(self.indexes, read_index_meta(collection_dir),
+                                               shelve.open(os.path.join(collection_dir, "document_frequencies"), "r"))
+
+    def _document_frequency(self, query_term, posting_list_docs_num):
+        return self.indexes.get_document_frequency(query_term)
+
+    def all_document_ids(self):
+        return range(1, self.shard_doc_count + 1)
+
+    # best docs of query without phrases before they are reordered with proximity boost: best max(k, RERANK_DEPTH)
+    # docs by bm25 and boosts of first RERANK_DEPTH of them (only they can get into first RERANK_DEPTH of collection)
+    def find_documents_for_rerank(self, query_terms, k):
+        query_terms = list(dict.fromkeys(query_terms))
+        search_results = self.find_documents_top_k(query_terms, max(k, RERANK_DEPTH))
+        query_terms_positions = self._get_query_terms_positions(query_terms, search_results.docids[:RERANK_DEPTH])
+        boosts = [self._proximity_boost(docid, query_terms_positions)
+                  for docid in search_results.docids[:RERANK_DEPTH]]
+        return search_results, boosts
+
+
+# shard searched by worker process, docids of requests and results are collection docids
+class _ShardWorker(object):
+    def __init__(self, shard_dir, IndexesImplementation, collection_dir, prior_weight):
+        self.searcher = ShardSearcher(shard_dir, IndexesImplementation, collection_dir, prior_weight)
+        self.snippet_generator = SnippetGenerator(self.searcher)
+        self.global_docids = array("I")
+        with open(os.path.join(shard_dir, "global_docids"), "rb") as global_docids_file:
+            self.global_docids.frombytes(global_docids_file.read())
+
+    def _results(self, search_results):
+        return ([(self.global_docids[docid - 1], relevance)
+                 for docid, relevance in zip(search_results.docids, search_results.relevances)],
+                search_results.total_doc_num())
+
+    def find_documents_top_k(self, query_terms, k):
+        return self._results(self.searcher.find_documents_top_k(query_terms, k))
+
+    def find_documents_by_query(self, parsed_query, k):
+        return self._results(self.searcher.find_documents_by_query(parsed_query, k))
+
+    def find_documents_by_boolean_query(self, boolean_query, k):
+        return self._results(self.searcher.find_documents_by_boolean_query(boolean_query, k))
+
+    def find_documents_for_rerank(self, query_terms, k):
+        search_results, boosts = self.searcher.find_documents_for_rerank(query_terms, k)
+        return self._results(search_results), boosts
+
+    # best limit matching stems of shard by numbers of docs of shard containing them (summed by coordinator)
+    def expand_prefix(self, prefix, limit):
+        return self.searcher.expand_prefix(prefix, limit)
+
+    def expand_fuzzy(self, term, max_edits, limit):
+        return self.searcher.expand_fuzzy(term, max_edits, limit)
+
+    def word_counts(self, stems):
+        return self.searcher.word_counts(stems)
+
+    def get_snippets(self, query_terms, docids):
+        return self.snippet_generator.get_snippets(query_terms, [bisect_left(self.global_docids, docid) + 1
+                                                                 for docid in docids])
+
+
+# loop of worker process: requests (method name, arguments) are answered with ("ok", result) or ("error", traceback)
+def _serve_shard(connection, shard_dir, IndexesImplementation, collection_dir, prior_weight):
+    worker = _ShardWorker(shard_dir, IndexesImplementation, collection_dir, prior_weight)
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            # coordinator has exited
+            return
+        if request is None:
+            return
+        method, args = request
+        try:
+            connection.send(("ok", getattr(worker, method)(*args)))
+        except Exception:
+            connection.send(("error", traceback.format_exc()))
+
+
+# collection statistics of sharded index (used by caches of results)
+class _ShardedCollection(object):
+    def __init__(self, meta):
+        self._meta = meta
+
+    def total_doc_count(self):
+        return self._meta["doc_count"]
+
+    def average_doc_len(self):
+        return self._meta["average_doc_len"]
+
+    def generation(self):
+        return self._meta["generation"]
+
+    # shards are not changed after indexing
+    def reload_if_changed(self):
+        return False
+
+
+# coordinator: each query is sent to all shard worker processes (searched in parallel), best docs of shards are merged
+# results are the same as results of Searcher of unsharded index
+class ShardedSearcher(object):
+    def __init__(self, index_dir, prior_weight=0):
+        directory = shards_dir(index_dir)
+        meta = read_index_meta(directory)
+        self.indexes = _ShardedCollection(meta)
+        self.shards_num = meta["shards"]
+        self._connections = []
+        for shard_number in range(self.shards_num):
+            connection, worker_connection = multiprocessing.Pipe()
+            multiprocessing.Process(target=_serve_shard,
+                                    args=(worker_connection, os.path.join(directory, shard_name(shard_number)),
+                                          INDEXES_IMPLEMENTATIONS[meta["index_format"]], directory, prior_weight),
+                                    daemon=True).start()
+            worker_connection.close()
+            self._connections.append(connection)
+        # lock of each connection is held from request to its reply, so replies of concurrent queries are not mixed
+        self._locks = [threading.Lock() for _ in self._connections]
+
+    # send request (method name, arguments) to each shard and return their results
+    # connections are locked in shard order (no deadlock) and each is unlocked as soon as its shard replies,
+    # so next query is sent to shards which have answered while this query waits for slower ones
+    def _call_shards(self, requests):
+        locked = []
+        replies = []
+        try:
+            for lock, connection, request in zip(self._locks, self._connections, requests):
+                lock.acquire()
+                locked.append(lock)
+                connection.send(request)
+            for connection in self._connections:
+                replies.append(connection.recv())
+                locked.pop(0).release()
+        finally:
+            for lock in locked:
+                lock.release()
+        for status, result in replies:
+            if status == "error":
+                raise RuntimeError("Shard search failed:\n" + result)
+        return [result for status, result in replies]
+
+    def _call_all_shards(self, method, *args):
+        return self._call_shards([(method, args)] * self.shards_num)
+
+    # best k docs of results of shards
+    @staticmethod
+    def _merge(shard_results, k):
+        docids_and_relevance = [result for results, total_doc_num in shard_results for result in results]
+        return SearchResults(sort_by_relevance(docids_and_relevance)[:k],
+                             sum(total_doc_num for results, total_doc_num in shard_results))
+
+    def find_documents_top_k(self, query_terms, k):
+        return self._merge(self._call_all_shards("find_documents_top_k", query_terms, k), k)
+
+    def find_documents_by_boolean_query(self, boolean_query, k):
+        if boolean_query is None:
+            return SearchResults([])
+        return self._merge(self._call_all_shards("find_documents_by_boolean_query", boolean_query, k), k)
+
+    # the same as Searcher.find_documents_by_query: best docs of all shards by bm25 are reordered with proximity boost
+    def find_documents_by_query(self, parsed_query, k):
+        if parsed_query.phrases:
+            return self._merge(self._call_all_shards("find_documents_by_query", parsed_query, k), k)
+        boosts = {}
+        shard_results = []
+        for (results, total_doc_num), shard_boosts in self._call_all_shards("find_documents_for_rerank",
+                                                                            parsed_query.terms, k):
+            shard_results.append((results, total_doc_num))
+            boosts.update(zip((docid for docid, relevance in results), shard_boosts))
+        search_results = self._merge(shard_results, max(k, RERANK_DEPTH))
+        docids_and_relevance = list(zip(search_results.docids, search_results.relevances))
+        reranked = sort_by_relevance([(docid, relevance + boosts[docid])
+                                      for docid, relevance in docids_and_relevance[:RERANK_DEPTH]])
+        return SearchResults((reranked + docids_and_relevance[RERANK_DEPTH:])[:k], search_results.total_doc_num())
+
+    # the same as Searcher.expand_prefix: numbers of docs containing stems of shards are summed
+    # each shard returns only its best limit stems, so stem just below limit of every shard can be missed
+    # (docs are spread over shards by hash, so frequencies of stems are similar in all shards)
+    def expand_prefix(self, prefix, limit=None):
+        return term_lookup.most_frequent_terms((term_and_frequency
+                                                for shard_terms in self._call_all_shards("expand_prefix", prefix,
+                                                                                         limit)
+                                                for term_and_frequency in shard_terms), limit)
+
+    def expand_fuzzy(self, term, max_edits, limit=None):
+        return term_lookup.closest_terms((fuzzy_term
+                                          for shard_terms in self._call_all_shards("expand_fuzzy", term, max_edits,
+                                                                                   limit)
+                                          for fuzzy_term in shard_terms), limit)
+
+    # the same as Searcher.surface_forms: words of stems are counted in all shards
+    def surface_forms(self, stems):
+        return term_lookup.most_frequent_words(term_lookup.word_counts(self._call_all_shards("word_counts", stems),
+                                                                       stems))
+
+    # snippets of docs (see snippets.SnippetGenerator), each doc is read by its shard
+    def get_snippets(self, query_terms, docids):
+        shards_docids = [[] for _ in range(self.shards_num)]
+        for docid in docids:
+            shards_docids[shard_of(docid, self.shards_num)].append(docid)
+        snippets = {}
+        for shard_docids, shard_snippets in zip(shards_docids, self._call_shards(
+                [("get_snippets", (query_terms, shard_docids)) for shard_docids in shards_docids])):
+            snippets.update(zip(shard_docids, shard_snippets))
+        return [snippets[docid] for docid in docids]
+
+    # stop worker processes
+    def close(self):
+        for lock, connection in zip(self._locks, self._connections):
+            with lock:
+                connection.send(None)
+                connection.close()
+
+
+# snippets of results of sharded index, the same interface as snippets.SnippetGenerator (snippets are not cached)
+class ShardedSnippetGenerator(object):
+    def __init__(self, sharded_searcher):
+        self.searcher = sharded_searcher
+        self.cache = None
+
+    def get_snippets(self, query_terms, docids, searcher=None):
+        return self.searcher.get_snippets(list(dict.fromkeys(query_terms)), docids)
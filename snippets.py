@@ -0,0 +1,69 @@
+import metrics
+from query_cache import LRUCache
+from searcher import snippet_window, shorten_snippet
+
+# number of words around best window of query terms in snippet
+SNIPPET_CONTEXT_WORDS = 10
+
+
+# result of search shown on page
+class SearchResultSnippet(object):
+    __slots__ = ("title", "url", "snippet")
+
+    def __init__(self, title, url, snippet):
+        self.title = title
+        self.url = url
+        # list of (word, is query term)
+        self.snippet = snippet
+
+
+# snippets of search results: record of each doc is read once, best window is found by positions of query terms
+# (from posting lists) and only words of window are decoded from stored utf-8 text of doc
+class SnippetGenerator(object):
+    # cache_size - max number of cached snippets (0 disables cache)
+    def __init__(self, searcher, cache_size=0, cache_ttl_seconds=600):
+        self.searcher = searcher
+        self.cache = LRUCache(cache_size, cache_ttl_seconds) if cache_size > 0 else None
+
+    # snippet of stored doc for window (first position, last position) of query terms in it
+    @staticmethod
+    def _snippet(stored_document, stem_vocabulary, query_terms, window):
+        # stems of query are compared with stem ids of doc, so terms of doc are not rebuilt
+        query_stem_ids = {stem_vocabulary.find_id(query_term.stem) for query_term in query_terms}
+        window_start, window_end = window if window is not None else (0, 0)
+        snippet_start = max(window_start - SNIPPET_CONTEXT_WORDS, 0)
+        snippet_end = min(len(stored_document), window_end + 1 + SNIPPET_CONTEXT_WORDS)
+        return shorten_snippet([(stored_document.word(position), stored_document.stem_ids[position] in query_stem_ids)
+                                for position in range(snippet_start, snippet_end)])
+
+    def _get_snippet(self, stored_document, stem_vocabulary, query_terms, query_positions):
+        return SearchResultSnippet(stored_document.title, stored_document.url,
+                                   self._snippet(stored_document, stem_vocabulary, query_terms,
+                                                 snippet_window(query_positions)))
+
+    # snippets of docs of page (searcher of batch of queries can be given, so posting lists are shared)
+    def get_snippets(self, query_terms, docids, searcher=None):
+        with metrics.stage("snippets"):
+            return self._get_snippets(query_terms, docids, searcher or self.searcher)
+
+    def _get_snippets(self, query_terms, docids, searcher):
+        query_terms = list(dict.fromkeys(query_terms))
+        key_prefix = (searcher.indexes.generation(), tuple(sorted(query_term.stem for query_term in query_terms)))
+        snippets = {}
+        if self.cache is not None:
+            for docid in docids:
+                snippet = self.cache.get(key_prefix + (docid,))
+                if snippet is not None:
+                    snippets[docid] = snippet
+        missing_docids = [docid for docid in docids if docid not in snippets]
+        if missing_docids:
+            # positions of query terms are read from posting lists once for all docs of page
+            query_positions = searcher.get_query_positions(query_terms, missing_docids)
+            # records of all docs of page are read in one pass (from document cache when it is used)
+            stored_documents = searcher.indexes.get_stored_documents(missing_docids)
+            for docid, (stored_document, stem_vocabulary) in zip(missing_docids, stored_documents):
+                snippets[docid] = self._get_snippet(stored_document, stem_vocabulary, query_terms,
+                                                    query_positions[docid])
+                if self.cache is not None:
+                    self.cache.put(key_prefix + (docid,), snippets[docid])
+        return [snippets[docid] for docid in docids]
@@ -0,0 +1,159 @@
+from bisect import bisect_left
+import heapq
+
+# Prefix and fuzzy lookup of indexed stems in sorted term dictionaries (see segment.TermDictionary).
+# Sorted array of terms is walked as implicit trie: terms starting with the same prefix are one range of indexes,
+# found by two binary searches, so prefix lookup reads only terms of the prefix and fuzzy lookup visits only branches
+# of trie which Levenshtein automaton of term can still accept.
+
+# char greater than any char of text: prefix + MAX_CHAR is bound of range of terms starting with prefix
+MAX_CHAR = chr(0x10ffff)
+
+
+# max number of edits of fuzzy lookup of term: short terms have too many neighbours to be corrected
+def default_max_edits(term):
+    if len(term) < 3:
+        return 0
+    if len(term) < 6:
+        return 1
+    return 2
+
+
+# Levenshtein automaton of term: state is sparse row of edit distances of prefix of looked up word to prefixes of term,
+# (indexes of term prefixes, their distances), only distances <= max_edits are kept
+# Many branches of trie reach the same states, so transitions are memoized (automaton becomes DFA lazily).
+class LevenshteinAutomaton(object):
+    def __init__(self, term, max_edits):
+        self.term = term
+        self.max_edits = max_edits
+        self._transitions = {}
+
+    def start(self):
+        indexes = tuple(range(min(self.max_edits, len(self.term)) + 1))
+        return indexes, indexes
+
+    def step(self, state, char):
+        transition = (state, char)
+        if transition not in self._transitions:
+            self._transitions[transition] = self._step(state, char)
+        return self._transitions[transition]
+
+    def _step(self, state, char):
+        indexes, values = state
+        new_indexes, new_values = [], []
+        if indexes and indexes[0] == 0 and values[0] < self.max_edits:
+            new_indexes.append(0)
+            new_values.append(values[0] + 1)
+        for j, (i, value) in enumerate(zip(indexes, values)):
+            if i == len(self.term):
+                break
+            cost = 0 if self.term[i] == char else 1
+            new_value = value + cost
+            if new_indexes and new_indexes[-1] == i:
+                new_value = min(new_value, new_values[-1] + 1)
+            if j + 1 < len(indexes) and indexes[j + 1] == i + 1:
+                new_value = min(new_value, values[j + 1] + 1)
+            if new_value <= self.max_edits:
+                new_indexes.append(i + 1)
+                new_values.append(new_value)
+        return tuple(new_indexes), tuple(new_values)
+
+    # edit distance of word to term or None if it is greater than max_edits
+    def distance(self, state):
+        indexes, values = state
+        if indexes and indexes[-1] == len(self.term):
+            return values[-1]
+        return None
+
+    # whether some continuation of word can be accepted
+    def can_match(self, state):
+        return bool(state[0])
+
+
+# (term, number of docs containing it) of terms of dictionary starting with prefix in sorted order
+def prefix_terms(dictionary, prefix):
+    terms = dictionary.terms()
+    low = bisect_left(terms, prefix)
+    high = bisect_left(terms, prefix + MAX_CHAR, low)
+    return zip(terms[low:high], dictionary.document_frequencies()[low:high])
+
+
+# (term, number of docs containing it, edit distance) of terms of dictionary within max_edits of term
+def fuzzy_terms(dictionary, term, max_edits):
+    automaton = LevenshteinAutomaton(term, max_edits)
+    terms = dictionary.terms()
+    document_frequencies = dictionary.document_frequencies()
+    # nodes of implicit trie: (prefix, state of automaton after prefix, range of terms starting with prefix)
+    stack = [("", automaton.start(), 0, len(terms))]
+    while stack:
+        prefix, state, low, high = stack.pop()
+        index = low
+        # term equal to prefix is the first term of range
+        if index < high and len(terms[index]) == len(prefix):
+            distance = automaton.distance(state)
+            if distance is not None:
+                yield prefix, document_frequencies[index], distance
+            index += 1
+        # each child of node is range of terms with the same next char
+        while index < high:
+            child_prefix = terms[index][:len(prefix) + 1]
+            child_high = bisect_left(terms, child_prefix + MAX_CHAR, index, high)
+            child_state = automaton.step(state, child_prefix[-1])
+            if automaton.can_match(child_state):
+                stack.append((child_prefix, child_state, index, child_high))
+            index = child_high
+
+
+# most frequent limit terms of (term, number of docs containing it) of several dictionaries (e.g. segments of index),
+# number of docs containing term is sum of its numbers in dictionaries: [(term, number of docs containing it)]
+def most_frequent_terms(terms_and_frequencies, limit=None):
+    document_frequencies = {}
+    for term, document_frequency in terms_and_frequencies:
+        document_frequencies[term] = document_frequencies.get(term, 0) + document_frequency
+    key = lambda term_and_frequency: (-term_and_frequency[1], term_and_frequency[0])
+    if limit is None:
+        return sorted(document_frequencies.items(), key=key)
+    return heapq.nsmallest(limit, document_frequencies.items(), key=key)
+
+
+# closest limit terms of (term, number of docs containing it, edit distance) of several dictionaries,
+# terms of the same distance are ordered by number of docs containing them
+def closest_terms(fuzzy_terms_of_dictionaries, limit=None):
+    distances = {}
+    document_frequencies = {}
+    for term, document_frequency, distance in fuzzy_terms_of_dictionaries:
+        distances[term] = distance
+        document_frequencies[term] = document_frequencies.get(term, 0) + document_frequency
+    terms = sorted(distances, key=lambda term: (distances[term], -document_frequencies[term], term))
+    if limit is not None:
+        terms = terms[:limit]
+    return [(term, document_frequencies[term], distances[term]) for term in terms]
+
+
+# numbers of occurrences of words of stems summed over several indexes (e.g. segments or shards),
+# word_counts_of_indexes are {stem: {word: count}} (see document.SurfaceForms): {stem: {word: count}} of stems
+def word_counts(word_counts_of_indexes, stems):
+    stems_word_counts = {stem: {} for stem in stems}
+    for index_word_counts in word_counts_of_indexes:
+        for stem, counts in stems_word_counts.items():
+            for word, count in index_word_counts.get(stem, {}).items():
+                counts[word] = counts.get(word, 0) + count
+    return stems_word_counts
+
+
+# the most frequent word of each stem of {stem: {word: count}}: {stem: word}, stem is its own word when it has none
+def most_frequent_words(stems_word_counts):
+    return {stem: min(counts, key=lambda word: (-counts[word], word)) if counts else stem
+            for stem, counts in stems_word_counts.items()}
+
+
+# indexed terms starting with prefix: [(term, number of docs containing it)], the most frequent first
+def expand_prefix(dictionaries, prefix, limit=None):
+    return most_frequent_terms((term_and_frequency for dictionary in dictionaries
+                                for term_and_frequency in prefix_terms(dictionary, prefix)), limit)
+
+
+# indexed terms within max_edits of term: [(term, number of docs containing it, edit distance)], the closest first
+def expand_fuzzy(dictionaries, term, max_edits, limit=None):
+    return closest_terms((fuzzy_term for dictionary in dictionaries
+                          for fuzzy_term in fuzzy_terms(dictionary, term, max_edits)), limit)
@@ -0,0 +1,147 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import aiohttp
+import pytest
+
+from crawler import RedditCrawler
+from crawl_storage import _iter_stored_posts
+
+# stub API has one post per 10 seconds after START_EPOCH, pages have at most PAGE_SIZE posts
+START_EPOCH = 1600000000
+POSTS_NUM = 300
+PAGE_SIZE = 25
+END_EPOCH = START_EPOCH + 10 * POSTS_NUM
+
+
+# stub of pushshift search API in thread: posts created in (after, before) newest first,
+# statuses of failures are returned instead of data by the next requests (e.g. 429 of rate limit),
+# after healthy_requests answered requests every request fails (API goes down)
+class _StubApi(object):
+    def __init__(self):
+        self.posts = [{"title": "post {}".format(i),
+                       "selftext": "text of post {}".format(i),
+                       "full_link": "https://reddit.com/r/test/{}".format(i),
+                       "score": i,
+                       "created_utc": START_EPOCH + 10 * i + 5}
+                      for i in range(POSTS_NUM)]
+        self.failures = []
+        self.healthy_requests = None
+        self.answered = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = stub._respond(parse_qs(urlparse(self.path).query))
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}".format(self.server.server_port)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def _respond(self, query):
+        with self._lock:
+            if self.failures or (self.healthy_requests is not None and self.answered >= self.healthy_requests):
+                self.failed += 1
+                return (self.failures.pop(0) if self.failures else 503), b"{}"
+            self.answered += 1
+        after, before = int(query["after"][0]), int(query["before"][0])
+        limit = min(int(query["limit"][0]), PAGE_SIZE)
+        page = sorted((post for post in self.posts if after < post["created_utc"] < before),
+                      key=lambda post: -post["created_utc"])[:limit]
+        return 200, json.dumps({"data": page}).encode()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_api():
+    stub = _StubApi()
+    yield stub
+    stub.close()
+
+
+def _crawl(stub_api, storage_dir, num_of_posts, resume=False, max_retries=5):
+    crawler = RedditCrawler("test", str(storage_dir), stub_api.url, resume)
+    crawler.crawl_async(num_of_posts, windows_num=4, rate=1000, concurrency=4, after_epoch=START_EPOCH,
+                        before_epoch=END_EPOCH, max_retries=max_retries, backoff_seconds=0.001)
+    return crawler
+
+
+# urls of all stored posts (with duplicates)
+def _stored_urls(storage_dir):
+    return [post["url"] for post in _iter_stored_posts(str(storage_dir))]
+
+
+def _checkpoint_count(crawler):
+    with open(crawler.checkpoint_path, encoding="utf-8") as checkpoint_file:
+        return json.load(checkpoint_file)["count"]
+
+
+# windows crawled in parallel stop exactly at the quota, which is not multiple of page size
+def test_crawl_stops_at_quota(stub_api, tmp_path):
+    crawler = _crawl(stub_api, tmp_path / "crawl", 110)
+    urls = _stored_urls(tmp_path / "crawl")
+    assert len(urls) == 110
+    assert len(set(urls)) == 110
+    assert _checkpoint_count(crawler) == 110
+
+
+# all posts are crawled when there are less of them than the quota
+def test_crawl_all_posts(stub_api, tmp_path):
+    _crawl(stub_api, tmp_path / "crawl", 1000)
+    assert sorted(_stored_urls(tmp_path / "crawl")) == sorted(post["full_link"] for post in stub_api.posts)
+
+
+# requests failing with server errors and rate limit are retried
+def test_crawl_retries_failed_requests(stub_api, tmp_path):
+    stub_api.failures = [500, 429, 503, 429]
+    _crawl(stub_api, tmp_path / "crawl", 100)
+    urls = _stored_urls(tmp_path / "crawl")
+    assert stub_api.failed == 4
+    assert len(urls) == 100
+    assert len(set(urls)) == 100
+
+
+# crawl interrupted by API failure continues from its checkpoint, posts are not crawled twice
+def test_crawl_resumes_from_checkpoint(stub_api, tmp_path):
+    stub_api.healthy_requests = 3
+    with pytest.raises(aiohttp.ClientResponseError):
+        _crawl(stub_api, tmp_path / "crawl", 150, max_retries=0)
+    interrupted_urls = _stored_urls(tmp_path / "crawl")
+    assert 0 < len(interrupted_urls) < 150
+    stub_api.healthy_requests = None
+    crawler = _crawl(stub_api, tmp_path / "crawl", 150, resume=True)
+    urls = _stored_urls(tmp_path / "crawl")
+    assert len(urls) == 150
+    assert len(set(urls)) == 150
+    assert set(interrupted_urls) <= set(urls)
+    assert _checkpoint_count(crawler) == 150
+
+
+# posts created in the same second are crawled once when page ends in the middle of their second
+def test_crawl_posts_created_in_the_same_second(stub_api, tmp_path):
+    # 10 posts per second, pages of PAGE_SIZE posts end in the middle of second
+    for i, post in enumerate(stub_api.posts):
+        post["created_utc"] = START_EPOCH + 10 * (i // 10) + 5
+    _crawl(stub_api, tmp_path / "all", 1000)
+    assert sorted(_stored_urls(tmp_path / "all")) == sorted(post["full_link"] for post in stub_api.posts)
+    crawler = _crawl(stub_api, tmp_path / "quota", 110)
+    urls = _stored_urls(tmp_path / "quota")
+    assert len(urls) == 110
+    assert len(set(urls)) == 110
+    assert _checkpoint_count(crawler) == 110
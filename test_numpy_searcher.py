@@ -0,0 +1,62 @@
+import os.path
+
+import pytest
+
+from benchmark_suite import generate_posts, synthetic_query_log
+from indexer import CompactIndexes, create_index_from_dir
+from lang_proc import parse_query
+from numpy_searcher import NumpySearcher
+from searcher import Searcher
+from segment import SegmentIndexes, create_segments
+
+POSTS_NUM = 1500
+QUERIES_NUM = 100
+K = 20
+
+
+# compact index of synthetic posts with segmented index ordered by prior (top k search of it stops early)
+@pytest.fixture(scope="module")
+def index_dir(tmp_path_factory):
+    work_dir = tmp_path_factory.mktemp("numpy_searcher")
+    crawl_dir = os.path.join(str(work_dir), "crawl")
+    index_dir = os.path.join(str(work_dir), "index")
+    generate_posts(crawl_dir, POSTS_NUM)
+    os.mkdir(index_dir)
+    create_index_from_dir(crawl_dir, index_dir, CompactIndexes)
+    indexes = CompactIndexes()
+    indexes.load_from_disk(index_dir)
+    create_segments(indexes, SegmentIndexes.segments_dir(index_dir), order_by_prior=True)
+    return index_dir
+
+
+def _assert_same_results(results, expected_results):
+    assert results.total_doc_num() == expected_results.total_doc_num()
+    assert results.docids == expected_results.docids
+    assert results.relevances == pytest.approx(expected_results.relevances, rel=1e-9, abs=1e-12)
+
+
+# vectorized ranking finds the same best docs with the same ranks and the same number of found docs as ranking doc by
+# doc (k larger than number of posts finds all docs, so none of them is pruned)
+@pytest.mark.parametrize("IndexesImplementation", [CompactIndexes, SegmentIndexes])
+@pytest.mark.parametrize("prior_weight", [0, 1])
+@pytest.mark.parametrize("k", [K, POSTS_NUM + 1])
+def test_top_k_is_the_same_as_searcher(index_dir, IndexesImplementation, prior_weight, k):
+    searcher = Searcher(index_dir, IndexesImplementation, prior_weight=prior_weight)
+    numpy_searcher = NumpySearcher(index_dir, IndexesImplementation, prior_weight=prior_weight)
+    for raw_query in synthetic_query_log(QUERIES_NUM):
+        query_terms = parse_query(raw_query).terms
+        _assert_same_results(numpy_searcher.find_documents_top_k(query_terms, k),
+                             searcher.find_documents_top_k(query_terms, k))
+
+
+# ranks of all matching docs are the same, so results reordered with proximity boost are the same too
+@pytest.mark.parametrize("prior_weight", [0, 1])
+def test_results_of_query_are_the_same_as_searcher(index_dir, prior_weight):
+    searcher = Searcher(index_dir, SegmentIndexes, prior_weight=prior_weight)
+    numpy_searcher = NumpySearcher(index_dir, SegmentIndexes, prior_weight=prior_weight)
+    for raw_query in synthetic_query_log(QUERIES_NUM):
+        query_terms = parse_query(raw_query).terms
+        _assert_same_results(numpy_searcher.find_documents_and_rank_by_bm25(query_terms),
+                             searcher.find_documents_and_rank_by_bm25(query_terms))
+        _assert_same_results(numpy_searcher.find_documents_by_query(parse_query(raw_query), K),
+                             searcher.find_documents_by_query(parse_query(raw_query), K))
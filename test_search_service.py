@@ -0,0 +1,59 @@
+import os.path
+
+import pytest
+
+import metrics
+from benchmark_suite import generate_posts
+from indexer import CompactIndexes, create_index_from_dir
+from search_api import SearchApi
+from search_service import SearchService
+from segment import SegmentIndexes, create_segments
+
+POSTS_NUM = 1000
+# queries of batch share their terms
+BATCH_QUERIES = ["game play", "play music", "game music", "game play music", "music"]
+BATCH_TERMS_NUM = 3
+LIMIT = 10
+
+
+# segmented index of synthetic posts
+@pytest.fixture(scope="module")
+def index_dir(tmp_path_factory):
+    work_dir = tmp_path_factory.mktemp("search_service")
+    crawl_dir = os.path.join(str(work_dir), "crawl")
+    index_dir = os.path.join(str(work_dir), "index")
+    generate_posts(crawl_dir, POSTS_NUM)
+    os.mkdir(index_dir)
+    create_index_from_dir(crawl_dir, index_dir, CompactIndexes)
+    indexes = CompactIndexes()
+    indexes.load_from_disk(index_dir)
+    create_segments(indexes, SegmentIndexes.segments_dir(index_dir))
+    return index_dir
+
+
+# search API of new search service (its caches are empty), segments are not merged in background
+@pytest.fixture
+def search_api(index_dir, monkeypatch):
+    monkeypatch.setenv("SURFEARCH_MERGE_INTERVAL", "0")
+    monkeypatch.setattr(metrics, "enabled", True)
+    return SearchApi(SearchService(index_dir))
+
+
+def _posting_lists_read():
+    return metrics.get_counters().get("posting_lists_read", 0)
+
+
+# posting lists of terms shared by queries of batch are read once for the whole batch (docids and positions of
+# reranked docs and snippets), while each query searched alone reads them again
+def test_batch_reads_posting_list_of_each_term_once(search_api, index_dir):
+    reads_before = _posting_lists_read()
+    batch_results = search_api.search_batch(BATCH_QUERIES, LIMIT)["results"]
+    batch_reads = _posting_lists_read() - reads_before
+    single_search_api = SearchApi(SearchService(index_dir))
+    reads_before = _posting_lists_read()
+    single_results = [single_search_api.search(raw_query, None, LIMIT) for raw_query in BATCH_QUERIES]
+    single_reads = _posting_lists_read() - reads_before
+    assert all(results["results"] for results in batch_results)
+    assert batch_results == single_results
+    assert batch_reads <= 2 * BATCH_TERMS_NUM
+    assert batch_reads < single_reads
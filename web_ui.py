@@ -1,12 +1,11 @@
 from datetime import datetime
-from flask import Flask, render_template, redirect, url_for, request, abort
+from flask import Flask, Response, render_template, redirect, url_for, request, abort, jsonify
 from flask_bootstrap import Bootstrap
 from flask_wtf import Form
 from wtforms import StringField, SubmitField
 from wtforms.validators import DataRequired
-from indexer import ShelveIndexes
-from searcher import Searcher, generate_snippet
-from lang_proc import to_query_terms
+from search_service import SearchService, AnalyzedQuery, suggestions_json
+import metrics
 
 app = Flask(__name__)
 Bootstrap(app)
@@ -22,7 +21,9 @@ def about():
     return render_template("about.html")
 
 
-searcher = Searcher("indexes", ShelveIndexes)
+# searcher, cache of results and snippets (configured with environment variables, see README)
+search_service = SearchService("indexes")
+snippet_generator = search_service.snippet_generator
 
 
 def url_for_other_page(page):
@@ -47,16 +48,42 @@ def search():
     return render_template("search.html", form=search_form)
 
 
+# metrics of search service in Prometheus text format (SURFEARCH_METRICS=1 enables stage timers and counters)
+@app.route("/metrics")
+def metrics_page():
+    search_service.collect_metrics()
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+# suggestions for last word of query typed so far in search box (JSON)
+@app.route("/autocomplete")
+def autocomplete():
+    search_service.reload_if_changed()
+    raw_query = request.args.get("q", "")
+    return jsonify(suggestions_json(raw_query, search_service.autocomplete(raw_query)))
+
+
 @app.route("/search_results/<query>", defaults={'page': 1})
 @app.route("/search_results/<query>/<int:page>")
 def search_results(query, page):
+    # time of each stage of request is traced, slow requests are logged with it
+    metrics.start_request()
+    try:
+        return _search_results(query, page)
+    finally:
+        metrics.finish_request("{} (page {})".format(query, page))
+
+
+def _search_results(query, page):
     start_time = datetime.now()  # used for time statistics
-    # get terms from query
-    query_terms = to_query_terms(query)
+    # see segments added or merged since last query
+    search_service.reload_if_changed()
     # give page size
     page_size = 25
-    # search and store results with bm25
-    search_result = searcher.find_documents_and_rank_by_bm25(query_terms)
+    # get terms and quoted phrases (or boolean operators) from query
+    analyzed_query = AnalyzedQuery(query)
+    # search and store best results with bm25 (deep pages need larger number of best results)
+    search_result = search_service.search(analyzed_query, page * page_size)
     # get docs from search results
     docs = search_result.get_page(page, page_size)
     # create pagination class for proper paging
@@ -64,18 +91,16 @@ def search_results(query, page):
     # if page is larger than actual number of pages
     if page > pagination.pages:
         abort(404)
-    # get texts, urls, titles from docid
+    # get texts, urls, titles of docs (record of each doc is read once)
     texts = []
     urls = []
     titles = []
-    for docid in docs:
-        title = searcher.indexes.get_title(docid)
-        text = searcher.indexes.get_document_text(docid)
-        url = searcher.indexes.get_url(docid)
-
-        titles.append(title)
-        texts.append(generate_snippet(query_terms, text))
-        urls.append(url)
+    for search_result_snippet in snippet_generator.get_snippets(analyzed_query.terms, docs):
+        titles.append(search_result_snippet.title)
+        texts.append(search_result_snippet.snippet)
+        urls.append(search_result_snippet.url)
+    # docs of next page are loaded to document cache in background
+    search_service.prefetch_documents(search_result.get_page(page + 1, page_size))
     # zip everything
     titles_texts_and_urls = zip(titles, texts, urls)
     finish_time = datetime.now()  # used for time statistics